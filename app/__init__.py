@@ -1,3 +1,4 @@
+import click
 from flask import Flask
 from flask_socketio import SocketIO
 from flask_cors import CORS
@@ -26,14 +27,50 @@ def create_app():
     app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
     app.config['SESSION_COOKIE_SECURE'] = False  # Set to True if using HTTPS
     
-    # Initialize Firebase
+    # Under a gevent worker, gRPC must be set up to yield to the hub before
+    # the first Firestore client exists
+    from .utils.concurrency import init_grpc_for_gevent
+    init_grpc_for_gevent()
+    
+    # Firebase is initialized lazily on first use; connectivity is probed
+    # in the background so startup never waits on Firestore
     try:
-        from .utils.firebase_utils import initialize_firebase
-        initialize_firebase()
-        print("✅ Firebase Admin SDK initialized successfully")
+        from .utils.firebase_health import start_health_monitor
+        start_health_monitor()
     except Exception as e:
-        print(f"❌ Failed to initialize Firebase: {e}")
-        # You can decide whether to continue without Firebase or exit
+        print(f"❌ Failed to start Firebase health monitor: {e}")
+    
+    # Keep the in-memory index of active device codes warm from Firestore
+    try:
+        from .utils.code_index import start_code_index_warmer
+        start_code_index_warmer()
+    except Exception as e:
+        print(f"❌ Failed to start device code index warmer: {e}")
+    
+    # Periodically clear out expired device codes
+    try:
+        from .utils.code_sweeper import start_code_sweeper
+        start_code_sweeper()
+    except Exception as e:
+        print(f"❌ Failed to start device code sweeper: {e}")
+    
+    # Periodically drop telemetry history past its retention window
+    try:
+        from .utils.history_pruner import start_history_pruner
+        start_history_pruner()
+    except Exception as e:
+        print(f"❌ Failed to start telemetry history pruner: {e}")
+    
+    # Optional in-memory mirror of user_devices (DEVICE_MIRROR_ENABLED)
+    try:
+        from .utils.device_mirror import start_device_mirror
+        start_device_mirror()
+    except Exception as e:
+        print(f"❌ Failed to start device mirror: {e}")
+    
+    # Pooled SQLite connections are returned at the end of each request
+    from .utils import database
+    database.init_app(app)
     
     # Register blueprints
     from .routes import devices, main, api, auth
@@ -42,6 +79,37 @@ def create_app():
     app.register_blueprint(api.bp)
     app.register_blueprint(auth.bp)
     
+    @app.cli.command('backfill-device-codes')
+    @click.option('--dry-run', is_flag=True, help='Only report what would change')
+    def backfill_device_codes(dry_run):
+        """Re-key user_device_codes documents by their code"""
+        from .utils.firebase_utils import backfill_device_code_ids
+        stats = backfill_device_code_ids(dry_run=dry_run)
+        click.echo(f"Scanned {stats['scanned']}, migrated {stats['migrated']}, "
+                   f"deleted {stats['deleted']} legacy, skipped {stats['skipped']} malformed")
+    
+    @app.cli.command('sweep-device-codes')
+    @click.option('--mode', type=click.Choice(['delete', 'deactivate']), default=None,
+                  help='Delete expired codes or only mark them inactive')
+    def sweep_device_codes(mode):
+        """Run one expiry sweep over user_device_codes now"""
+        from .utils.code_sweeper import sweep_expired_codes
+        result = sweep_expired_codes(mode=mode)
+        click.echo(f"{result['mode']}: {result['handled']} expired codes in {result['batches']} batches "
+                   f"({result['duration_ms']} ms){' - error: ' + result['error'] if result['error'] else ''}")
+    
+    @app.cli.command('prune-telemetry-history')
+    @click.option('--days', type=int, default=None, help='Days of history to keep; 0 keeps everything')
+    def prune_telemetry_history(days):
+        """Delete telemetry history older than the retention window now"""
+        from .utils.history_pruner import prune_expired_history
+        result = prune_expired_history(retention_days=days)
+        if result['cutoff_day'] is None:
+            click.echo('Retention is off (0 days); all history kept')
+            return
+        click.echo(f"Deleted {result['deleted']} history rows before {result['cutoff_day']} "
+                   f"({result['duration_ms']} ms){' - error: ' + result['error'] if result['error'] else ''}")
+    
     # Make config available to templates
     @app.context_processor
     def inject_config():
@@ -9,9 +9,10 @@ class Config:
     # Flask Configuration
     SECRET_KEY = os.environ.get('SECRET_KEY') or secrets.token_hex(32)
     
-    # Database Configuration - Firebase only, no local SQLite
+    # Database Configuration - Firestore for accounts, codes and devices;
+    # local SQLite (pooled in utils/database.py) for connected devices and telemetry
     BASE_DIR = os.path.dirname(os.path.dirname(__file__))
-    # Removed DATABASE and SCHEMA_PATH - using Firebase Firestore only
+    DATABASE = os.environ.get('DATABASE_PATH') or os.path.join(BASE_DIR, 'instance', 'unilocator.db')
     
     # Firebase Configuration
     FIREBASE_API_KEY = os.environ.get('FIREBASE_API_KEY')
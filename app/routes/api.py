@@ -1,24 +1,49 @@
 from flask import Blueprint, request, jsonify
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
 from ..utils.database import get_db
 from datetime import datetime
+import time
+from ..utils.owner_cache import lookup_device_owners
+from ..utils.telemetry import append_history, ensure_history_schema, mirror_locations, parse_reports
+from ..utils.telemetry_buffer import telemetry_buffer
 
 bp = Blueprint('api', __name__, url_prefix='/api')
 
 @bp.route('/location/<device_id>', methods=['POST'])
 def update_location(device_id):
-    data = request.get_json()
-    if not data or 'lat' not in data or 'lng' not in data:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'lat' not in data or 'lng' not in data:
         return jsonify({'status': 'error', 'message': 'Invalid data'}), 400
+    try:
+        report = parse_reports({'device_code': device_id, 'lat': data['lat'], 'lng': data['lng']})[0]
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
 
-    lat = data['lat']
-    lng = data['lng']
+    lat = report['lat']
+    lng = report['lng']
 
+    # Devices post without a token, so only connected devices are accepted;
+    # a caller that does send a token must own the device
+    verify_jwt_in_request(optional=True)
+    user_id = get_jwt_identity()
     db = get_db()
-    db.execute(
-        'UPDATE connected_devices SET last_latitude = ?, last_longitude = ?, last_seen = CURRENT_TIMESTAMP WHERE device_code = ?',
-        (lat, lng, device_id)
-    )
-    db.commit()
+    owners = lookup_device_owners(db, [device_id]).get(device_id)
+    if not owners:
+        return jsonify({'status': 'error', 'message': 'Unknown device'}), 404
+    if user_id is not None and user_id not in owners:
+        return jsonify({'status': 'error', 'message': 'Unauthorized'}), 403
+
+    if telemetry_buffer is None or not telemetry_buffer.add([report]):
+        ensure_history_schema(db)
+        db.execute(
+            'UPDATE connected_devices SET last_latitude = ?, last_longitude = ?, last_seen = CURRENT_TIMESTAMP WHERE device_code = ?',
+            (lat, lng, device_id)
+        )
+        append_history(db, [report])
+        db.commit()
+    
+    mirror_locations([(lat, lng, device_id)])
+    
     return jsonify({'status': 'ok'})
 
 @bp.route('/fetch-devices-debug', methods=['POST'])
@@ -29,7 +54,8 @@ def fetch_devices_debug():
     """
     from flask import session
     from ..utils.firebase_utils import fetch_user_devices_debug
-    from ..utils.firebase_rest import get_rest_client
+    from ..utils.firebase_rest import get_rest_client, json_safe
+    from ..utils.tracing import Trace
     import logging
     from datetime import datetime
     
@@ -58,7 +84,9 @@ def fetch_devices_debug():
             logging.info("[DEBUG API] Trying Strategy 1: Firebase REST API")
             rest_client = get_rest_client()
             if rest_client and rest_client.credentials:
-                rest_result = rest_client.fetch_user_devices(user_id)
+                rest_result = json_safe(rest_client.fetch_user_devices(
+                    user_id, use_cache=False, trace=Trace('rest_fetch_user_devices')
+                ))
                 strategies_results['rest_api'] = rest_result
                 logging.info(f"[DEBUG API] REST API result: {rest_result['success']}")
             else:
@@ -438,7 +466,7 @@ def fetch_devices_production():
     Returns devices in format ready for dashboard display
     """
     from flask import session
-    from ..utils.firebase_rest import get_rest_client
+    from ..utils.firebase_rest import get_rest_client, json_safe, DASHBOARD_DEVICE_FIELDS
     import logging
     from datetime import datetime
     
@@ -462,12 +490,11 @@ def fetch_devices_production():
                 'error': 'Firebase REST client not available'
             }), 500
         
-        result = rest_client.fetch_user_devices(user_id)
-        
-        if result['success']:
-            # Format devices for dashboard display using the correct Firebase structure
-            formatted_devices = []
-            for device in result['devices']:
+        # Served from the device list cache, or streamed page by page on a miss
+        formatted_devices = []
+        try:
+            for device in rest_client.iter_user_devices(user_id, field_mask=DASHBOARD_DEVICE_FIELDS):
+                device = json_safe(device)
                 device_info = device.get('deviceInfo', {})
                 formatted_device = {
                     'id': device.get('deviceId', 'Unknown'),
@@ -492,22 +519,21 @@ def fetch_devices_production():
                     'status': 'connected' if device.get('isActive', False) else 'offline'
                 }
                 formatted_devices.append(formatted_device)
-            
-            logging.info(f"[PRODUCTION] Successfully formatted {len(formatted_devices)} devices")
-            
-            return jsonify({
-                'success': True,
-                'devices': formatted_devices,
-                'count': len(formatted_devices),
-                'user_id': user_id
-            })
-        else:
-            logging.error(f"[PRODUCTION] Device fetch failed: {result['error']}")
+        except Exception as fetch_error:
+            logging.error(f"[PRODUCTION] Device fetch failed: {fetch_error}")
             return jsonify({
                 'success': False,
-                'error': result['error'],
-                'logs': result.get('logs', [])
+                'error': str(fetch_error)
             }), 500
+        
+        logging.info(f"[PRODUCTION] Successfully formatted {len(formatted_devices)} devices")
+        
+        return jsonify({
+            'success': True,
+            'devices': formatted_devices,
+            'count': len(formatted_devices),
+            'user_id': user_id
+        })
             
     except Exception as e:
         logging.error(f"[PRODUCTION] Critical error: {e}")
@@ -522,7 +548,7 @@ def debug_device_data():
     Debug endpoint to see the raw Firebase device data structure
     """
     from flask import session
-    from ..utils.firebase_rest import get_rest_client
+    from ..utils.firebase_rest import get_rest_client, json_safe
     import logging
     from datetime import datetime
     
@@ -537,7 +563,7 @@ def debug_device_data():
         if not rest_client or not rest_client.credentials:
             return jsonify({'success': False, 'error': 'REST client not available'}), 500
         
-        result = rest_client.fetch_user_devices(user_id)
+        result = json_safe(rest_client.fetch_user_devices(user_id, use_cache=False))
         
         if result['success']:
             # Return the raw device data for inspection
@@ -558,3 +584,47 @@ def debug_device_data():
     except Exception as e:
         logging.error(f"[DEBUG DATA] Error: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
+
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    In-process performance counters for the Firebase data path
+    Only for signed-in sessions, since the counters carry backend error messages
+    """
+    from flask import session
+    from ..utils.firebase_rest import rest_client
+    from ..utils.device_cache import device_list_cache
+    from ..utils.firebase_health import get_firebase_health
+    from ..utils.firestore_executor import firestore_executor
+    from ..utils.code_index import active_code_index
+    from ..utils.code_sweeper import get_sweeper_stats
+    from ..utils.bulk_writer import bulk_writer
+    from ..utils.device_mirror import get_mirror_stats
+    from ..utils.circuit_breaker import firestore_breaker
+    from ..utils.telemetry_buffer import get_buffer_stats
+    from ..utils.database import get_pool_stats
+    from ..utils.owner_cache import device_owner_cache
+    from ..utils.history_pruner import get_pruner_stats
+    
+    if not session.get('user_id'):
+        return jsonify({'success': False, 'error': 'Not authenticated'}), 401
+    
+    return jsonify({
+        'timestamp': datetime.now().isoformat(),
+        'rest_client': {
+            'token': rest_client.get_token_stats() if rest_client else None,
+            'http': rest_client.get_http_stats() if rest_client else None
+        },
+        'device_list_cache': device_list_cache.stats(),
+        'firestore_health': get_firebase_health(),
+        'firestore_executor': firestore_executor.stats(),
+        'active_code_index': active_code_index.stats(),
+        'code_sweeper': get_sweeper_stats(),
+        'bulk_writer': bulk_writer.stats(),
+        'device_mirror': get_mirror_stats(),
+        'circuit_breaker': firestore_breaker.stats(),
+        'telemetry_buffer': get_buffer_stats(),
+        'sqlite_pool': get_pool_stats(),
+        'device_owner_cache': device_owner_cache.stats(),
+        'history_pruner': get_pruner_stats()
+    })
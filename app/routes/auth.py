@@ -1,10 +1,12 @@
 from flask import Blueprint, request, redirect, url_for, session, jsonify, Response
 from datetime import datetime
-import sqlite3
 import json
-import sqlite3
 import json
 from datetime import datetime
+from ..utils.database import db_connection
+from ..utils.owner_cache import invalidate_device_owners
+from ..utils.telemetry import delete_user_history, export_user_history
+from ..utils.telemetry_buffer import telemetry_buffer
 
 bp = Blueprint('auth', __name__)
 
@@ -38,29 +40,34 @@ def download_data():
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
     
     try:
-        conn = sqlite3.connect('instance/unilocator.db')
-        cursor = conn.cursor()
-        
-        # Get user data
-        cursor.execute("SELECT * FROM users WHERE firebase_uid = ?", (firebase_uid,))
-        user_data = cursor.fetchone()
-        
-        # Get devices data
-        cursor.execute("SELECT * FROM connected_devices WHERE user_id = ?", (firebase_uid,))
-        devices_data = cursor.fetchall()
-        
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Get user data
+            cursor.execute("SELECT * FROM users WHERE firebase_uid = ?", (firebase_uid,))
+            user_data = cursor.fetchone()
+            
+            # Get devices data
+            cursor.execute("SELECT * FROM connected_devices WHERE user_id = ?", (firebase_uid,))
+            devices_data = cursor.fetchall()
+            
+            # Get the location/battery/network history of those devices
+            if telemetry_buffer is not None:
+                telemetry_buffer.flush()
+            history_data = export_user_history(conn, firebase_uid)
         
         # Format data for download
         export_data = {
             'user_id': firebase_uid,
             'export_date': str(datetime.now()),
             'user_info': user_data,
-            'devices': devices_data
+            'devices': devices_data,
+            'telemetry_history': history_data
         }
         
+        # Pooled connections parse TIMESTAMP columns; export them as text
         response = Response(
-            json.dumps(export_data, indent=2),
+            json.dumps(export_data, indent=2, default=str),
             mimetype='application/json',
             headers={"Content-Disposition": "attachment;filename=unilocator-data.json"}
         )
@@ -93,17 +100,24 @@ def delete_account():
         return jsonify({'success': False, 'error': 'Not authenticated'}), 401
     
     try:
-        conn = sqlite3.connect('instance/unilocator.db')
-        cursor = conn.cursor()
-        
-        # Delete user's devices
-        cursor.execute("DELETE FROM connected_devices WHERE user_id = ?", (firebase_uid,))
-        
-        # Delete user
-        cursor.execute("DELETE FROM users WHERE firebase_uid = ?", (firebase_uid,))
+        # Commit buffered reports first so none land after the purge
+        if telemetry_buffer is not None:
+            telemetry_buffer.flush()
         
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Delete the history of devices no other account has connected
+            delete_user_history(conn, firebase_uid)
+            
+            # Delete user's devices
+            cursor.execute("DELETE FROM connected_devices WHERE user_id = ?", (firebase_uid,))
+            
+            # Delete user
+            cursor.execute("DELETE FROM users WHERE firebase_uid = ?", (firebase_uid,))
+            
+            conn.commit()
+        invalidate_device_owners(user_ids=[firebase_uid])
         
         # Clear session
         session.pop('user_id', None)
@@ -3,6 +3,9 @@ from flask_socketio import emit
 from app import socketio
 from functools import wraps
 from ..utils.database import get_db
+from ..utils.device_cache import invalidate_user_devices
+from ..utils.owner_cache import invalidate_device_owners
+from ..utils.code_index import active_code_index
 import logging
 import secrets
 import string
@@ -11,7 +14,8 @@ import io
 import base64
 import json
 import os
-from datetime import datetime
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from datetime import datetime, timedelta
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from flask import request, jsonify
 from datetime import datetime
@@ -58,6 +62,8 @@ def connect_device():
     # Remove from pending_devices
     db.execute('DELETE FROM pending_devices WHERE device_code = ?', (device_code,))
     db.commit()
+    invalidate_user_devices(user_id)
+    invalidate_device_owners(device_codes=[device_code])
     logging.info(f"[CONNECT] Device {device_code} connected successfully for user {user_id}")
     # Emit socket event for real-time update
     socketio.emit('device_connected', {
@@ -96,6 +102,8 @@ def remove_device():
     
     db.execute('DELETE FROM connected_devices WHERE device_code = ? AND user_id = ?', (device_code, firebase_uid))
     db.commit()
+    invalidate_user_devices(firebase_uid)
+    invalidate_device_owners(device_codes=[device_code])
     
     logging.info(f"[REMOVE] Device {device_code} removed for user {firebase_uid}")
     
@@ -112,64 +120,59 @@ def remove_device():
 @bp.route('/location/<device_code>', methods=['POST'])
 @jwt_required()
 def update_location(device_code):
-    user_id = get_jwt_identity()
     data = request.get_json()
-    lat = data.get('lat')
-    lng = data.get('lng')
-    db = get_db()
-    cursor = db.execute('SELECT user_id FROM connected_devices WHERE device_code = ?', (device_code,))
-    row = cursor.fetchone()
-    if not row or row[0] != user_id:
-        return jsonify({'success': False, 'error': 'Unauthorized or device not found.'}), 403
-    db.execute(
-        '''UPDATE connected_devices
-           SET last_latitude = ?, last_longitude = ?, last_seen = CURRENT_TIMESTAMP
-           WHERE device_code = ?''',
-        (lat, lng, device_code)
-    )
-    db.commit()
-    return jsonify({'success': True})
+    return _ingest_single(device_code, {'lat': data.get('lat'), 'lng': data.get('lng')})
 
 @bp.route('/battery/<device_code>', methods=['POST'])
 @jwt_required()
 def update_battery(device_code):
-    user_id = get_jwt_identity()
     data = request.get_json()
-    battery = data.get('battery')
-    db = get_db()
-    cursor = db.execute('SELECT user_id FROM connected_devices WHERE device_code = ?', (device_code,))
-    row = cursor.fetchone()
-    if not row or row[0] != user_id:
-        return jsonify({'success': False, 'error': 'Unauthorized or device not found.'}), 403
-    db.execute(
-        '''UPDATE connected_devices
-           SET last_battery = ?, last_seen = CURRENT_TIMESTAMP
-           WHERE device_code = ?''',
-        (battery, device_code)
-    )
-    db.commit()
-    return jsonify({'success': True})
+    return _ingest_single(device_code, {'battery': data.get('battery')})
 
 @bp.route('/network/<device_code>', methods=['POST'])
 @jwt_required()
 def update_network(device_code):
-    user_id = get_jwt_identity()
     data = request.get_json()
-    network = data.get('network')
-    db = get_db()
-    cursor = db.execute('SELECT user_id FROM connected_devices WHERE device_code = ?', (device_code,))
-    row = cursor.fetchone()
-    if not row or row[0] != user_id:
+    return _ingest_single(device_code, {'network': data.get('network')})
+
+def _ingest_single(device_code, values):
+    """Apply one report through the batched ingestion path"""
+    from ..utils.telemetry import parse_reports, ingest_reports
+    from ..utils.telemetry_buffer import telemetry_buffer
+
+    try:
+        reports = parse_reports({'device_code': device_code, **values})
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    result = ingest_reports(get_db(), get_jwt_identity(), reports, buffer=telemetry_buffer)
+    if not result['accepted']:
         return jsonify({'success': False, 'error': 'Unauthorized or device not found.'}), 403
-    db.execute(
-        '''UPDATE connected_devices
-           SET last_network = ?, last_seen = CURRENT_TIMESTAMP
-           WHERE device_code = ?''',
-        (network, device_code)
-    )
-    db.commit()
     return jsonify({'success': True})
 
+@bp.route('/telemetry', methods=['POST'])
+@jwt_required()
+def ingest_telemetry():
+    """
+    Batched telemetry ingestion: one report or a list of buffered reports
+
+    Each report carries a device_code and any of lat/lng, battery and
+    network. Replaces separate calls to /location, /battery and /network.
+    """
+    from ..utils.telemetry import parse_reports, ingest_reports
+    from ..utils.telemetry_buffer import telemetry_buffer
+
+    user_id = get_jwt_identity()
+    try:
+        reports = parse_reports(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    result = ingest_reports(get_db(), user_id, reports, buffer=telemetry_buffer)
+    if not result['accepted']:
+        return jsonify({'success': False, 'error': 'Unauthorized or device not found.', **result}), 403
+
+    return jsonify({'success': True, **result})
+
 @bp.route('/list', methods=['GET'])
 @jwt_required()
 def list_devices():
@@ -191,22 +194,20 @@ def list_devices():
 @bp.route('/disconnect-all', methods=['POST'])
 def disconnect_all_devices():
     from flask import session
-    import sqlite3
     
     try:
         firebase_uid = session.get('user_id')
         if not firebase_uid:
             return jsonify({'success': False, 'error': 'Not authenticated'}), 401
         
-        conn = sqlite3.connect('instance/unilocator.db')
-        cursor = conn.cursor()
+        db = get_db()
         
         # Delete all devices for the user
-        cursor.execute("DELETE FROM connected_devices WHERE user_id = ?", (firebase_uid,))
-        deleted_count = cursor.rowcount
+        deleted_count = db.execute("DELETE FROM connected_devices WHERE user_id = ?", (firebase_uid,)).rowcount
         
-        conn.commit()
-        conn.close()
+        db.commit()
+        invalidate_user_devices(firebase_uid)
+        invalidate_device_owners(user_ids=[firebase_uid])
         
         return jsonify({
             'success': True, 
@@ -221,9 +222,7 @@ def disconnect_all_devices():
 def generate_code():
     """Generate a new device connection code and QR code"""
     from flask import session
-    import string
-    import secrets
-    import threading
+    from ..utils.firebase_utils import reserve_device_code
     
     try:
         # Use session authentication
@@ -236,9 +235,9 @@ def generate_code():
         
         logging.info(f"[GENERATE-CODE] Starting code generation for user: {firebase_uid}, email: {user_email}")
         
-        # Generate simple code immediately (no Firebase blocking)
-        chars = string.ascii_uppercase + string.digits
-        code = ''.join(secrets.choice(chars) for _ in range(4)) + '-' + ''.join(secrets.choice(chars) for _ in range(4))
+        # Reserve a code no one else holds; Firestore's create() is awaited
+        # briefly and queued instead when it is slow or unavailable
+        code = reserve_device_code(firebase_uid, user_email)
         logging.info(f"[GENERATE-CODE] Generated code: {code}")
         
         # Generate QR code
@@ -264,9 +263,9 @@ def generate_code():
         
         logging.info(f"[GENERATE-CODE] QR code generated successfully for code: {code}")
         
-        # ALWAYS store in local backup first (immediate, no waiting)
-        def store_locally_and_firebase():
-            # 1. Store locally immediately
+        # ALWAYS store in local backup (immediate, no waiting)
+        def store_locally():
+            # Store locally immediately
             try:
                 import json
                 import os
@@ -304,38 +303,11 @@ def generate_code():
                 
             except Exception as backup_error:
                 logging.error(f"[LOCAL-BACKUP] ❌ Failed to store code {code} locally: {backup_error}")
-            
-            # 2. Then try Firebase (optional, can fail)
-            try:
-                from ..utils.firebase_utils import get_firestore_db
-                from firebase_admin import firestore
-                from datetime import datetime, timedelta
-                
-                db = get_firestore_db()
-                
-                expiration_time = datetime.now() + timedelta(hours=24)
-                doc_data = {
-                    'deviceCode': code,
-                    'userId': firebase_uid,
-                    'userEmail': user_email,
-                    'generatedAt': firestore.SERVER_TIMESTAMP,
-                    'expiresAt': expiration_time,
-                    'isActive': True,
-                    'maxUsage': 1,
-                    'usageCount': 0,
-                    'qrCodeData': f'unilocator://connect?code={code}&user={firebase_uid}&email={user_email}'
-                }
-                
-                db.collection('user_device_codes').add(doc_data)
-                logging.info(f"[FIREBASE-BG] ✅ Also stored code {code} in Firebase")
-                
-            except Exception as e:
-                logging.warning(f"[FIREBASE-BG] ⚠️ Firebase storage failed for code {code}: {e} (but local backup exists)")
         
-        # Start background storage (local + Firebase)
-        storage_thread = threading.Thread(target=store_locally_and_firebase, daemon=True)
-        storage_thread.start()
-        logging.info(f"[GENERATE-CODE] Started background storage for code: {code}")
+        # The backup is a local file write, and the Firestore write already
+        # happened (or was queued) when the code was reserved
+        store_locally()
+        logging.info(f"[GENERATE-CODE] Stored code locally: {code}")
         
         response = {
             'success': True,
@@ -415,6 +387,10 @@ def verify_code_mobile():
             logging.warning(f"[MOBILE-VERIFY] Timeout for code: {device_code}")
             return jsonify(result), 408  # Request Timeout
         
+        if result.get('unavailable'):
+            logging.warning(f"[MOBILE-VERIFY] Firebase unavailable (circuit open) for code: {device_code}")
+            return jsonify(result), 503  # Service Unavailable
+        
         if result['success']:
             logging.info(f"[MOBILE-VERIFY] Success for code: {device_code}")
             return jsonify(result), 200
@@ -447,11 +423,48 @@ def check_code_exists():
         
         logging.info(f"[CODE-CHECK] Checking existence of code: {device_code}")
         
-        # For now, return optimistic response since reads are problematic
-        # The actual verification happens in verify-code-mobile
+        from ..utils.firebase_utils import get_device_code, device_code_doc_id
+        from ..utils.firestore_executor import firestore_executor
+        
+        code_key = device_code_doc_id(device_code)
+        if code_key is None:
+            return jsonify({
+                'exists': False,
+                'message': 'Code not found or no longer active'
+            }), 200
+        
+        # Codes generated or recently seen by this process answer from memory
+        if active_code_index.get(code_key) is not None:
+            return jsonify({
+                'exists': True,
+                'message': 'Code found, proceed to verification'
+            }), 200
+        
+        # Codes are keyed by the code itself, so this is one document read
+        try:
+            code_data = firestore_executor.run(
+                lambda deadline: get_device_code(device_code, timeout=deadline.remaining()),
+                timeout=5.0
+            )
+        except Exception as e:
+            # Reads can still be slow; stay optimistic and let verification decide
+            logging.warning(f"[CODE-CHECK] Lookup failed for {device_code}: {e}")
+            return jsonify({
+                'exists': True,
+                'message': 'Code format valid, proceed to verification'
+            }), 200
+        
+        if code_data and code_data.get('isActive'):
+            if code_data.get('expiresAt'):
+                active_code_index.add(code_key, code_data.get('userId'), code_data.get('userEmail'), code_data['expiresAt'])
+            return jsonify({
+                'exists': True,
+                'message': 'Code found, proceed to verification'
+            }), 200
+        
         return jsonify({
-            'exists': True,  # Assume it exists, let verification handle the details
-            'message': 'Code format valid, proceed to verification'
+            'exists': False,
+            'message': 'Code not found or no longer active'
         }), 200
         
     except Exception as e:
@@ -525,17 +538,16 @@ def check_firebase_codes():
     """Debug endpoint to see what codes are stored in Firebase - with timeout protection"""
     try:
         from ..utils.firebase_utils import get_firestore_db
-        import threading
-        import time
+        from ..utils.firestore_executor import firestore_executor
         
         logging.info("[DEBUG-CODES] Checking Firebase codes")
         
         result = {'codes': [], 'error': None}
         
-        def firebase_list():
+        def firebase_list(deadline):
             try:
                 db = get_firestore_db()
-                codes = db.collection('user_device_codes').limit(10).get()
+                codes = db.collection('user_device_codes').limit(10).get(timeout=deadline.remaining())
                 
                 for doc in codes:
                     data = doc.to_dict()
@@ -551,15 +563,10 @@ def check_firebase_codes():
             except Exception as e:
                 result['error'] = str(e)
         
-        # Run Firebase read in background thread with timeout
-        list_thread = threading.Thread(target=firebase_list)
-        list_thread.daemon = True
-        list_thread.start()
-        
-        # Wait maximum 10 seconds for read operation
-        list_thread.join(timeout=10.0)
-        
-        if list_thread.is_alive():
+        # Run Firebase read on the shared executor; wait maximum 10 seconds
+        try:
+            firestore_executor.run(firebase_list, timeout=10.0)
+        except FuturesTimeoutError:
             logging.warning("[DEBUG-CODES] List timeout")
             return jsonify({
                 'timeout': True,
@@ -589,30 +596,22 @@ def check_firebase_codes():
 def test_code_debug(code):
     """Debug endpoint to test if a specific code can be found - with timeout protection"""
     try:
-        from ..utils.firebase_utils import get_firestore_db
-        import threading
-        import time
+        from ..utils.firebase_utils import get_device_code
+        from ..utils.firestore_executor import firestore_executor
         
         logging.info(f"[DEBUG-CODE] Testing code: {code}")
         
         result = {'found': False, 'error': None, 'data': None}
         
-        def firebase_read():
+        def firebase_read(deadline):
             try:
-                db = get_firestore_db()
+                data = get_device_code(code, timeout=deadline.remaining())
                 
-                # Use simpler query approach
-                collection_ref = db.collection('user_device_codes')
-                query_result = collection_ref.where('deviceCode', '==', code).where('isActive', '==', True).get()
-                
-                if len(query_result) == 0:
+                if not data or not data.get('isActive'):
                     result['found'] = False
                     result['message'] = f'No code {code} found in Firebase'
                     return
                 
-                doc = query_result[0]
-                data = doc.to_dict()
-                
                 result['found'] = True
                 result['data'] = {
                     'userId': data.get('userId'),
@@ -625,15 +624,10 @@ def test_code_debug(code):
             except Exception as e:
                 result['error'] = str(e)
         
-        # Run Firebase read in background thread with timeout
-        read_thread = threading.Thread(target=firebase_read)
-        read_thread.daemon = True
-        read_thread.start()
-        
-        # Wait maximum 10 seconds for read operation
-        read_thread.join(timeout=10.0)
-        
-        if read_thread.is_alive():
+        # Run Firebase read on the shared executor; wait maximum 10 seconds
+        try:
+            firestore_executor.run(firebase_read, timeout=10.0)
+        except FuturesTimeoutError:
             logging.warning(f"[DEBUG-CODE] Read timeout for code: {code}")
             return jsonify({
                 'found': False,
@@ -725,11 +719,16 @@ def verify_code_firebase():
 
 @bp.route('/health', methods=['GET'])
 def health_check():
-    """Simple health check - no Firebase operations"""
+    """Simple health check - no Firebase operations, reports the cached background probe"""
+    from ..utils.firebase_health import get_firebase_health
+    from ..utils.circuit_breaker import firestore_breaker
+    
     return jsonify({
         'status': 'healthy',
         'message': 'Server is running',
         'timestamp': datetime.now().isoformat(),
+        'firebase': get_firebase_health(),
+        'circuit_breaker': firestore_breaker.stats(),
         'firebase_note': 'Android app should connect directly to Firebase for reads'
     })
 
@@ -740,7 +739,7 @@ def device_info():
         'connection_method': 'direct_firebase',
         'instructions': {
             'step1': 'Android app connects directly to Firebase',
-            'step2': 'Query user_device_codes collection where deviceCode == your_code',
+            'step2': 'Read user_device_codes/<your_code> (documents are keyed by the code)',
             'step3': 'Create connection in device_connections collection',
             'step4': 'No server API needed for verification'
         },
@@ -758,16 +757,23 @@ def test_firebase_read(device_code):
     try:
         logging.info(f"[TEST-READ] Testing Firebase read for code: {device_code}")
         
-        from ..utils.firebase_utils import query_firebase_with_timeout
+        from ..utils.firebase_utils import get_device_code
+        from ..utils.firestore_executor import firestore_executor
         
-        # Test the same query your Android app would make
-        success, docs, error = query_firebase_with_timeout(
-            'user_device_codes', 'deviceCode', device_code, timeout_seconds=10
-        )
+        # Same single-document lookup the verification path makes
+        try:
+            doc_data = firestore_executor.run(
+                lambda deadline: get_device_code(device_code, timeout=deadline.remaining()),
+                timeout=10
+            )
+            success, error = True, None
+        except FuturesTimeoutError:
+            success, error = False, "Firebase read timed out after 10 seconds"
+        except Exception as e:
+            success, error = False, str(e)
         
         if success:
-            if docs and len(docs) > 0:
-                doc_data = docs[0].to_dict()
+            if doc_data:
                 logging.info(f"[TEST-READ] ✅ Found code: {device_code}")
                 return jsonify({
                     'success': True,
@@ -1,9 +1,23 @@
 from flask import Blueprint, render_template, redirect, url_for, request, g, jsonify, session
-import sqlite3
+from functools import wraps
+import time
+from ..utils.database import db_connection
+from ..utils.owner_cache import lookup_device_owners
+from ..utils.telemetry_buffer import get_buffered_state
 
 bp = Blueprint('main', __name__)
 
 
+def login_required(view):
+    """Answer JSON endpoints with 401 unless there is a signed-in session"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not session.get('user_id'):
+            return jsonify({'error': 'Not authenticated'}), 401
+        return view(*args, **kwargs)
+    return wrapped
+
+
 # Route for /index to render the landing page (now index.html)
 @bp.route('/index')
 def index_page():
@@ -17,9 +31,75 @@ def index():
 
 
 
+def _load_local_devices(firebase_uid):
+    """Read the user's devices from the local SQLite database"""
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT device_code, device_name, connected_at
+            FROM connected_devices
+            WHERE user_id = ?
+            ORDER BY connected_at DESC
+        """, (firebase_uid,))
+        devices = cursor.fetchall()
+    
+    device_list = []
+    for device in devices:
+        device_data = {
+            "code": device[0],
+            "name": device[1],
+            "device_name": device[1],
+            "connected_at": device[2],
+            "location": {"lat": 0.0, "lng": 0.0},
+            "status": "connected"
+        }
+        device_list.append(device_data)
+    return device_list
+
+
+def _load_firebase_devices(firebase_uid):
+    """Read the user's devices from Firestore, formatted for the dashboard"""
+    from ..utils.firebase_rest import get_rest_client, json_safe, DASHBOARD_DEVICE_FIELDS
+    
+    rest_client = get_rest_client()
+    if not rest_client or not rest_client.credentials:
+        print("[DEBUG] Firebase REST client not available")
+        return []
+    
+    device_list = []
+    # Served from the device list cache, or streamed page by page on a miss
+    for device in rest_client.iter_user_devices(firebase_uid, field_mask=DASHBOARD_DEVICE_FIELDS):
+        device = json_safe(device)
+        device_info = device.get('deviceInfo', {})
+        firebase_device = {
+            'code': device.get('deviceId', 'Unknown'),
+            'name': device.get('deviceName', 'Unknown Device'),  # Direct field
+            'device_name': device.get('deviceName', 'Unknown Device'),  # Direct field
+            'model': device.get('deviceModel', 'Unknown Model'),  # Direct field
+            'brand': device_info.get('brand', 'Unknown').title(),  # From deviceInfo
+            'manufacturer': device_info.get('manufacturer', 'Unknown').title(),
+            'android_version': device.get('androidVersion', 'Unknown'),  # Direct field
+            'app_version': device.get('appVersion', 'Unknown'),  # Direct field
+            'device_type': device.get('deviceType', 'android'),
+            'is_active': device.get('isActive', False),
+            'connected_at': device.get('registeredAt', 'Recently'),  # registeredAt field
+            'last_seen': device.get('lastSeenAt', 'Recently'),  # lastSeenAt field
+            'location': {
+                'lat': device.get('lastLocation', {}).get('latitude', 0),
+                'lng': device.get('lastLocation', {}).get('longitude', 0)
+            },
+            'status': 'connected' if device.get('isActive', False) else 'offline',
+            'source': 'firebase'
+        }
+        device_list.append(firebase_device)
+    return device_list
+
+
 # Dashboard route: Only show if authenticated, else redirect to home
 @bp.route('/dashboard')
 def dashboard():
+    from ..utils.concurrency import fan_out
+    
     # Use session for authentication
     firebase_uid = session.get('user_id')
     print(f"[DEBUG] /dashboard session['user_id']: {firebase_uid}")
@@ -27,87 +107,31 @@ def dashboard():
         print("[DEBUG] /dashboard: Not authenticated, redirecting to landing page.")
         return redirect(url_for('main.index'))
     
-    device_list = []
-    
     try:
-        # First, try to get devices from local SQLite database
-        conn = sqlite3.connect('instance/unilocator.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT device_code, device_name, connected_at
-            FROM connected_devices
-            WHERE user_id = ?
-            ORDER BY connected_at DESC
-        """, (firebase_uid,))
-        devices = cursor.fetchall()
-        
-        for device in devices:
-            device_data = {
-                "code": device[0],
-                "name": device[1],
-                "device_name": device[1],
-                "connected_at": device[2],
-                "location": {"lat": 0.0, "lng": 0.0},
-                "status": "connected"
-            }
-            device_list.append(device_data)
-            
+        # Local database first; Firebase is only queried when it has no
+        # devices for this user
+        device_list = _load_local_devices(firebase_uid)
         print(f"[DEBUG] Found {len(device_list)} devices in local database")
         
-        # If no devices in local DB, try Firebase (but don't wait for it)
         if len(device_list) == 0:
-            try:
-                from ..utils.firebase_rest import get_rest_client
-                print("[DEBUG] No local devices, checking Firebase...")
-                
-                rest_client = get_rest_client()
-                if rest_client and rest_client.credentials:
-                    result = rest_client.fetch_user_devices(firebase_uid)
-                    if result['success'] and result['devices']:
-                        print(f"[DEBUG] Found {len(result['devices'])} devices in Firebase")
-                        
-                        # Format Firebase devices for display using correct structure
-                        for device in result['devices']:
-                            device_info = device.get('deviceInfo', {})
-                            firebase_device = {
-                                'code': device.get('deviceId', 'Unknown'),
-                                'name': device.get('deviceName', 'Unknown Device'),  # Direct field
-                                'device_name': device.get('deviceName', 'Unknown Device'),  # Direct field
-                                'model': device.get('deviceModel', 'Unknown Model'),  # Direct field
-                                'brand': device_info.get('brand', 'Unknown').title(),  # From deviceInfo
-                                'manufacturer': device_info.get('manufacturer', 'Unknown').title(),
-                                'android_version': device.get('androidVersion', 'Unknown'),  # Direct field
-                                'app_version': device.get('appVersion', 'Unknown'),  # Direct field
-                                'device_type': device.get('deviceType', 'android'),
-                                'is_active': device.get('isActive', False),
-                                'connected_at': device.get('registeredAt', 'Recently'),  # registeredAt field
-                                'last_seen': device.get('lastSeenAt', 'Recently'),  # lastSeenAt field
-                                'location': {
-                                    'lat': device.get('lastLocation', {}).get('latitude', 0),
-                                    'lng': device.get('lastLocation', {}).get('longitude', 0)
-                                },
-                                'status': 'connected' if device.get('isActive', False) else 'offline',
-                                'source': 'firebase'
-                            }
-                            device_list.append(firebase_device)
-                    else:
-                        print("[DEBUG] No devices found in Firebase")
+            print("[DEBUG] No local devices, checking Firebase...")
+            # The REST client checks the circuit breaker on each request itself
+            result = fan_out({'firebase': lambda: _load_firebase_devices(firebase_uid)}, timeout=10, guarded=False)['firebase']
+            if result['success']:
+                device_list = result['value']
+                if device_list:
+                    print(f"[DEBUG] Found {len(device_list)} devices in Firebase")
                 else:
-                    print("[DEBUG] Firebase REST client not available")
-            except Exception as firebase_error:
-                print(f"[DEBUG] Firebase fetch error (non-critical): {firebase_error}")
+                    print("[DEBUG] No devices found in Firebase")
+            else:
                 # Continue with empty list - Firebase fetch is optional
+                print(f"[DEBUG] Firebase fetch error (non-critical): {result['error']}")
         
         return render_template('dashboard.html', devices=device_list, user_name='User')
         
     except Exception as e:
         print(f"[DEBUG] Error loading dashboard: {e}")
         return render_template('dashboard.html', devices=[], user_name='User', error="Failed to load dashboard. Please try again later."), 500
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
 
 
 
@@ -133,16 +157,16 @@ def show_map(device_id):
 def get_location(device_id):
     # Fetch the latest location for the device from the database
     try:
-        conn = sqlite3.connect('instance/unilocator.db')
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT last_latitude, last_longitude, last_battery, last_network
-            FROM connected_devices
-            WHERE device_code = ?
-            ORDER BY connected_at DESC
-            LIMIT 1
-        """, (device_id,))
-        row = cursor.fetchone()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT last_latitude, last_longitude, last_battery, last_network
+                FROM connected_devices
+                WHERE device_code = ?
+                ORDER BY connected_at DESC
+                LIMIT 1
+            """, (device_id,))
+            row = cursor.fetchone()
         if row:
             lat = row[0] if row[0] is not None else 0.0
             lng = row[1] if row[1] is not None else 0.0
@@ -150,6 +174,15 @@ def get_location(device_id):
             network = row[3] if row[3] is not None else '--'
         else:
             lat, lng, battery, network = 0.0, 0.0, '--', '--'
+        
+        # Reports acknowledged but not yet group-committed are newer than the row
+        buffered = get_buffered_state(device_id) if row else {}
+        if 'location' in buffered:
+            lat, lng = buffered['location']
+        if 'battery' in buffered:
+            battery = buffered['battery'][0]
+        if 'network' in buffered:
+            network = buffered['network'][0]
         return jsonify({
             'lat': lat,
             'lng': lng,
@@ -159,11 +192,42 @@ def get_location(device_id):
     except Exception as e:
         print(f"Error getting location for device {device_id}: {e}")
         return jsonify({'error': 'Failed to get device location.'}), 500
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+
+@bp.route('/get_location_history/<device_id>')
+@login_required
+def get_location_history(device_id):
+    """
+    Location trail for the map, oldest first, paged with a cursor
+    
+    Only the device's owners can read it. Query args: start / end (epoch
+    seconds, default the last 24 hours), limit (page size) and cursor
+    (next_cursor of the previous page).
+    """
+    from ..utils.telemetry import query_history
+    
+    try:
+        end = request.args.get('end', type=float)
+        start = request.args.get('start', type=float)
+        if start is None:
+            start = (end or time.time()) - 24 * 3600
+        
+        with db_connection() as conn:
+            # Someone else's device looks the same as a missing one
+            if session['user_id'] not in lookup_device_owners(conn, [device_id]).get(device_id, ()):
+                return jsonify({'error': 'Device not found.'}), 404
+            page = query_history(
+                conn, device_id,
+                start=start,
+                end=end,
+                limit=request.args.get('limit', 500, type=int),
+                cursor=request.args.get('cursor')
+            )
+        return jsonify(page)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"Error getting location history for device {device_id}: {e}")
+        return jsonify({'error': 'Failed to get location history.'}), 500
 
 
 # Authentication routes - serve Firebase auth pages
@@ -200,24 +264,22 @@ def profile():
         return redirect(url_for('main.index'))
     
     try:
-        conn = sqlite3.connect('instance/unilocator.db')
-        cursor = conn.cursor()
-        
-        # Get user info if available
-        cursor.execute("""
-            SELECT firebase_uid, created_at
-            FROM users
-            WHERE firebase_uid = ?
-        """, (firebase_uid,))
-        user_data = cursor.fetchone()
-        
-        # Get device count for the user
-        cursor.execute("""
-            SELECT COUNT(*) FROM connected_devices WHERE user_id = ?
-        """, (firebase_uid,))
-        device_count = cursor.fetchone()[0]
-        
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            
+            # Get user info if available
+            cursor.execute("""
+                SELECT firebase_uid, created_at
+                FROM users
+                WHERE firebase_uid = ?
+            """, (firebase_uid,))
+            user_data = cursor.fetchone()
+            
+            # Get device count for the user
+            cursor.execute("""
+                SELECT COUNT(*) FROM connected_devices WHERE user_id = ?
+            """, (firebase_uid,))
+            device_count = cursor.fetchone()[0]
         
         profile_data = {
             'user_id': firebase_uid,
@@ -86,9 +86,44 @@
             alert('This feature will be implemented soon!');
         });
         
-        // History button (placeholder functionality)
-        document.getElementById('historyBtn').addEventListener('click', function() {
-            alert('Location history will be available soon!');
+        // History button: draw the last 24 hours as a trail, page by page
+        let historyTrail = null;
+        document.getElementById('historyBtn').addEventListener('click', async function() {
+            if (historyTrail) {
+                map.removeLayer(historyTrail);
+                historyTrail = null;
+                return;
+            }
+            
+            document.getElementById('locationStatus').textContent = 'Loading history...';
+            const points = [];
+            let cursor = null;
+            try {
+                do {
+                    const params = new URLSearchParams({ limit: 1000 });
+                    if (cursor) params.set('cursor', cursor);
+                    const res = await fetch(`/get_location_history/${window.deviceId}?${params}`);
+                    if (!res.ok) {
+                        throw new Error('Failed to fetch history');
+                    }
+                    const page = await res.json();
+                    page.points
+                        .filter(p => p.lat !== null && p.lng !== null)
+                        .forEach(p => points.push([p.lat, p.lng]));
+                    cursor = page.next_cursor;
+                } while (cursor);
+                
+                if (points.length === 0) {
+                    document.getElementById('locationStatus').textContent = 'No history for the last 24 hours';
+                    return;
+                }
+                historyTrail = L.polyline(points, { color: '#2196F3', weight: 3 }).addTo(map);
+                map.fitBounds(historyTrail.getBounds());
+                document.getElementById('locationStatus').textContent = `Showing ${points.length} history points`;
+            } catch (err) {
+                document.getElementById('locationStatus').textContent = 'Failed to load history';
+                console.error("❌ Failed to fetch history", err);
+            }
         });
         
         // Initial update
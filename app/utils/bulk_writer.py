@@ -0,0 +1,301 @@
+"""
+Coalescing bulk writer for Firestore in UniLocator
+Queues fire-and-forget writes and commits them in batches
+"""
+
+import atexit
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+# Firestore accepts at most 500 writes per batch commit
+MAX_BATCH_WRITES = 500
+
+
+class _PendingWrite:
+    """One queued write; later writes to the same document may be folded into it"""
+
+    __slots__ = ('kind', 'data', 'merge', 'callbacks', 'queued_at')
+
+    def __init__(self, kind, data, merge, callback):
+        self.kind = kind  # create | set | update | delete
+        self.data = data
+        self.merge = merge
+        self.callbacks = [callback] if callback else []
+        self.queued_at = time.monotonic()
+
+    def absorb(self, kind, data, merge, callback):
+        """Fold a later write into this one; returns False if it must stay separate"""
+        if kind == 'create' or self.kind == 'create':
+            # A create must reach Firestore as a create to detect an existing document
+            return False
+        if kind == 'delete' or (kind == 'set' and not merge):
+            # Replaces whatever was pending for the document
+            self.kind, self.data, self.merge = kind, data, merge
+        elif kind == 'set' and self.kind == 'set' and self.merge:
+            self.data.update(data)
+        elif kind == 'update' and self.kind == 'update':
+            self.data.update(data)
+        else:
+            return False
+        if callback:
+            self.callbacks.append(callback)
+        return True
+
+
+class FirestoreBulkWriter:
+    """
+    Background writer that batches and coalesces Firestore writes
+
+    Writes are queued per document path. A write to a document that already
+    has a compatible pending write replaces or merges into it, so a document
+    updated many times between flushes costs one write. The queue is flushed
+    when it reaches max_batch_size writes or when its oldest write has waited
+    flush_interval seconds. A failed batch is retried with backoff; callbacks
+    are called as callback(success, error) once the write is durable or has
+    finally failed.
+
+    Creates are committed one at a time ahead of the batch, because a batch
+    is atomic and one create hitting an existing document would fail every
+    other write in it. A create that finds its document already there is
+    not retried; its callback gets the AlreadyExists error.
+    """
+
+    def __init__(self, max_batch_size=MAX_BATCH_WRITES, flush_interval=1.0, max_queue=10000,
+                 max_retries=3, backoff_base=0.5, commit_timeout=30.0):
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_WRITES)
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.commit_timeout = commit_timeout
+        self._pending = OrderedDict()  # doc path -> [_PendingWrite, ...]
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._stats = {
+            'enqueued': 0, 'coalesced': 0, 'rejected': 0, 'written': 0, 'failed': 0,
+            'batches': 0, 'failed_batches': 0, 'retries': 0,
+            'last_flush_ms': None, 'max_flush_ms': None, 'total_flush_ms': 0.0
+        }
+
+    def create(self, doc_path, data, callback=None):
+        """Queue a create() of doc_path, which fails if it exists; returns False if the queue is full"""
+        return self._enqueue(doc_path, 'create', dict(data), False, callback)
+
+    def set(self, doc_path, data, merge=False, callback=None):
+        """Queue a set() of doc_path; returns False if the queue is full"""
+        return self._enqueue(doc_path, 'set', dict(data), merge, callback)
+
+    def update(self, doc_path, data, callback=None):
+        """Queue an update() of doc_path; returns False if the queue is full"""
+        return self._enqueue(doc_path, 'update', dict(data), False, callback)
+
+    def delete(self, doc_path, callback=None):
+        """Queue a delete() of doc_path; returns False if the queue is full"""
+        return self._enqueue(doc_path, 'delete', None, False, callback)
+
+    def flush(self):
+        """Commit everything queued so far on the calling thread"""
+        while self._flush_once(force=True):
+            pass
+
+    def close(self):
+        """Stop the background thread after flushing what is queued"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=self.commit_timeout)
+        self.flush()
+
+    def stats(self):
+        """Queue depth, coalescing and flush latency counters"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = self._queued
+            stats['queued_documents'] = len(self._pending)
+        batches = stats['batches'] + stats['failed_batches']
+        total_ms = stats.pop('total_flush_ms')
+        stats['avg_flush_ms'] = round(total_ms / batches, 2) if batches else None
+        stats['max_batch_size'] = self.max_batch_size
+        stats['flush_interval'] = self.flush_interval
+        return stats
+
+    def _enqueue(self, doc_path, kind, data, merge, callback):
+        with self._cond:
+            if self._closed:
+                self._stats['rejected'] += 1
+                error = RuntimeError("Bulk writer is closed")
+            else:
+                error = None
+                writes = self._pending.get(doc_path)
+                if writes and writes[-1].absorb(kind, data, merge, callback):
+                    self._stats['coalesced'] += 1
+                elif self._queued >= self.max_queue:
+                    self._stats['rejected'] += 1
+                    error = RuntimeError("Bulk writer queue is full")
+                else:
+                    self._pending.setdefault(doc_path, []).append(_PendingWrite(kind, data, merge, callback))
+                    self._queued += 1
+                if error is None:
+                    self._stats['enqueued'] += 1
+                    self._ensure_started()
+                    self._cond.notify()
+
+        if error is not None:
+            logging.warning(f"[BULK-WRITER] Dropped {kind} of {doc_path}: {error}")
+            _notify([callback] if callback else [], False, error)
+            return False
+        return True
+
+    def _ensure_started(self):
+        # Caller holds the condition
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='firestore-bulk-writer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    self._cond.wait(timeout=self._wait_time())
+                if self._closed:
+                    return
+            self._flush_once(force=False)
+
+    def _due(self):
+        # Caller holds the condition
+        if not self._pending:
+            return False
+        if self._queued >= self.max_batch_size:
+            return True
+        oldest = next(iter(self._pending.values()))[0]
+        return time.monotonic() - oldest.queued_at >= self.flush_interval
+
+    def _wait_time(self):
+        # Caller holds the condition
+        if not self._pending:
+            return None
+        oldest = next(iter(self._pending.values()))[0]
+        return max(0.0, self.flush_interval - (time.monotonic() - oldest.queued_at))
+
+    def _take_batch(self):
+        # Caller holds the condition; takes whole documents so per-document
+        # write order is kept within one commit
+        batch = []
+        while self._pending:
+            doc_path, writes = next(iter(self._pending.items()))
+            if batch and len(batch) + len(writes) > self.max_batch_size:
+                break
+            del self._pending[doc_path]
+            self._queued -= len(writes)
+            batch.extend((doc_path, write) for write in writes)
+        return batch
+
+    def _flush_once(self, force):
+        """Commit one batch; returns True if there may be more to flush"""
+        with self._flush_lock:
+            with self._cond:
+                if not self._pending or not (force or self._due()):
+                    return False
+                batch = self._take_batch()
+
+            start = time.perf_counter()
+            errors = {}
+            for doc_path, write in batch:
+                if write.kind == 'create':
+                    errors[id(write)] = self._create_with_retry(doc_path, write)
+            batched = [(doc_path, write) for doc_path, write in batch if write.kind != 'create']
+            error = self._commit_with_retry(batched) if batched else None
+            for _, write in batched:
+                errors[id(write)] = error
+            elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+            failed = sum(1 for write_error in errors.values() if write_error is not None)
+
+            with self._cond:
+                self._stats['last_flush_ms'] = elapsed_ms
+                self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'] or 0, elapsed_ms)
+                self._stats['total_flush_ms'] += elapsed_ms
+                if error is None:
+                    self._stats['batches'] += 1
+                else:
+                    self._stats['failed_batches'] += 1
+                self._stats['written'] += len(batch) - failed
+                self._stats['failed'] += failed
+
+            for _, write in batch:
+                write_error = errors[id(write)]
+                _notify(write.callbacks, write_error is None, write_error)
+            return True
+
+    def _commit_with_retry(self, batch):
+        from .firebase_utils import get_firestore_db
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                db = get_firestore_db()
+                write_batch = db.batch()
+                for doc_path, write in batch:
+                    doc_ref = db.document(doc_path)
+                    if write.kind == 'set':
+                        write_batch.set(doc_ref, write.data, merge=write.merge)
+                    elif write.kind == 'update':
+                        write_batch.update(doc_ref, write.data)
+                    else:
+                        write_batch.delete(doc_ref)
+                write_batch.commit(timeout=self.commit_timeout)
+                return None
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logging.error(f"[BULK-WRITER] Batch of {len(batch)} writes failed after {attempt + 1} attempts: {e}")
+                    return e
+                with self._cond:
+                    self._stats['retries'] += 1
+                delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+                logging.warning(f"[BULK-WRITER] Batch commit failed ({e}); retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+
+    def _create_with_retry(self, doc_path, write):
+        from google.api_core.exceptions import AlreadyExists
+        from .firebase_utils import get_firestore_db
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                get_firestore_db().document(doc_path).create(write.data, timeout=self.commit_timeout)
+                return None
+            except AlreadyExists as e:
+                logging.warning(f"[BULK-WRITER] Not creating {doc_path}: it already exists")
+                return e
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logging.error(f"[BULK-WRITER] Create of {doc_path} failed after {attempt + 1} attempts: {e}")
+                    return e
+                with self._cond:
+                    self._stats['retries'] += 1
+                time.sleep(random.uniform(0, self.backoff_base * (2 ** attempt)))
+
+
+def _notify(callbacks, success, error):
+    for callback in callbacks:
+        try:
+            callback(success, error)
+        except Exception as e:
+            logging.error(f"[BULK-WRITER] Write callback raised: {e}")
+
+
+# Global instance shared by all fire-and-forget Firestore writes
+bulk_writer = FirestoreBulkWriter(
+    max_batch_size=int(os.environ.get('BULK_WRITER_BATCH_SIZE', MAX_BATCH_WRITES)),
+    flush_interval=float(os.environ.get('BULK_WRITER_FLUSH_INTERVAL_SECONDS', 1.0)),
+    max_queue=int(os.environ.get('BULK_WRITER_MAX_QUEUE', 10000))
+)
+
+# Commit what is still queued when the process exits normally
+atexit.register(bulk_writer.close)
@@ -0,0 +1,183 @@
+"""
+Circuit breaker for Firestore calls in UniLocator
+Fails fast while Firestore is unhealthy instead of waiting out every timeout
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling Firestore while the breaker is open"""
+
+
+def is_backend_failure(error):
+    """
+    True for errors that say Firestore is slow or unavailable
+
+    Application-level outcomes (not found, permission denied, a rejected
+    device code) mean Firestore answered, so they do not trip the breaker.
+    """
+    if isinstance(error, (FuturesTimeoutError, TimeoutError, ConnectionError)):
+        return True
+    try:
+        from google.api_core import exceptions as api_exceptions
+        if isinstance(error, (api_exceptions.ServerError, api_exceptions.DeadlineExceeded,
+                              api_exceptions.TooManyRequests, api_exceptions.ResourceExhausted,
+                              api_exceptions.RetryError)):
+            return True
+    except ImportError:
+        pass
+    try:
+        import requests
+        if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+            return True
+    except ImportError:
+        pass
+    return False
+
+
+class CircuitBreaker:
+    """
+    Closed / open / half-open breaker
+
+    Closed: calls go through; failure_threshold consecutive backend failures
+    open the breaker. Open: calls fail immediately with CircuitOpenError for
+    recovery_timeout seconds. Half-open: up to half_open_max_calls trial calls
+    go through; a success closes the breaker, a failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold=5, recovery_timeout=30.0, half_open_max_calls=1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trials = 0
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'successes': 0, 'failures': 0, 'short_circuited': 0, 'opened': 0, 'last_error': None}
+
+    @property
+    def state(self):
+        with self._lock:
+            self._advance()
+            return self._state
+
+    def before_call(self):
+        """
+        Admit a call or raise CircuitOpenError
+
+        Returns:
+            bool: True if the call is a half-open trial; pass it back to
+            record_success / record_failure
+        """
+        with self._lock:
+            self._advance()
+            if self._state == self.OPEN or (self._state == self.HALF_OPEN and self._trials >= self.half_open_max_calls):
+                self._stats['short_circuited'] += 1
+                raise CircuitOpenError(f"Circuit '{self.name}' is open; Firestore is unavailable")
+            self._stats['calls'] += 1
+            if self._state == self.HALF_OPEN:
+                self._trials += 1
+                return True
+            return False
+
+    def record_success(self, trial=False):
+        with self._lock:
+            self._stats['successes'] += 1
+            self._consecutive_failures = 0
+            if trial:
+                self._trials -= 1
+            if self._state == self.HALF_OPEN:
+                self._state = self.CLOSED
+                self._opened_at = None
+                logging.info(f"[CIRCUIT-{self.name.upper()}] Closed after a successful trial call")
+
+    def record_failure(self, error, trial=False):
+        with self._lock:
+            self._stats['failures'] += 1
+            self._stats['last_error'] = str(error)
+            self._consecutive_failures += 1
+            if trial:
+                self._trials -= 1
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and self._consecutive_failures >= self.failure_threshold):
+                self._open()
+
+    def release(self, trial=False):
+        """Give back an admitted call's trial slot without a verdict on Firestore"""
+        if trial:
+            with self._lock:
+                self._trials -= 1
+
+    def record(self, error, trial=False):
+        """
+        Record the outcome of an admitted call; error is None on success
+
+        Interruptions (BaseExceptions such as a killed greenlet) and calls
+        refused by a breaker further down never reached Firestore, so they
+        only release the trial slot.
+        """
+        if error is None:
+            self.record_success(trial)
+        elif not isinstance(error, Exception) or isinstance(error, CircuitOpenError):
+            self.release(trial)
+        elif is_backend_failure(error):
+            self.record_failure(error, trial)
+        else:
+            self.record_success(trial)
+
+    def call(self, fn, *args, **kwargs):
+        """Run fn through the breaker"""
+        trial = self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self.record(e, trial)
+            raise
+        self.record_success(trial)
+        return result
+
+    def stats(self):
+        with self._lock:
+            self._advance()
+            stats = dict(self._stats)
+            stats['state'] = self._state
+            stats['consecutive_failures'] = self._consecutive_failures
+            stats['open_for_seconds'] = round(time.monotonic() - self._opened_at, 3) if self._opened_at else None
+        stats['failure_threshold'] = self.failure_threshold
+        stats['recovery_timeout'] = self.recovery_timeout
+        return stats
+
+    def _open(self):
+        # Caller holds the lock
+        if self._state != self.OPEN:
+            self._stats['opened'] += 1
+            logging.warning(f"[CIRCUIT-{self.name.upper()}] Opened after {self._consecutive_failures} consecutive failures")
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._trials = 0
+
+    def _advance(self):
+        # Caller holds the lock; open -> half-open once the recovery timeout passes
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._trials = 0
+            logging.info(f"[CIRCUIT-{self.name.upper()}] Half-open; allowing trial calls")
+
+
+# Global breaker shared by the Admin SDK helpers and the REST client
+firestore_breaker = CircuitBreaker(
+    'firestore',
+    failure_threshold=int(os.environ.get('FIRESTORE_BREAKER_FAILURE_THRESHOLD', 5)),
+    recovery_timeout=float(os.environ.get('FIRESTORE_BREAKER_RECOVERY_SECONDS', 30))
+)
@@ -0,0 +1,174 @@
+"""
+Process-local index of active device codes for UniLocator
+Answers code lookups from memory before going to Firestore
+"""
+
+import heapq
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# Seconds between reloads of active codes from Firestore
+WARM_INTERVAL_SECONDS = float(os.environ.get('ACTIVE_CODE_WARM_INTERVAL_SECONDS', 300))
+
+
+def _to_epoch(value):
+    # Firestore returns aware datetimes; locally generated ones are naive local time
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return float(value)
+
+
+class ActiveCodeIndex:
+    """
+    Active device codes keyed by code, with a min-heap on expiry
+
+    Expired codes are evicted from the top of the heap in O(log n) each.
+    Entries replaced or removed before they expire leave a stale heap node
+    behind, which is skipped when it reaches the top.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._codes = {}  # code -> entry dict
+        self._heap = []  # (expires_at, code, version)
+        self._version = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'added': 0, 'expired': 0, 'evicted': 0, 'removed': 0}
+
+    def add(self, code, user_id, user_email, expires_at):
+        """Index a newly generated (or freshly read) active code"""
+        if self.max_entries <= 0:
+            return
+
+        expires_at = _to_epoch(expires_at)
+        with self._lock:
+            self._evict_expired(time.time())
+            if expires_at <= time.time():
+                return
+
+            self._version += 1
+            self._codes[code] = {
+                'userId': user_id,
+                'userEmail': user_email,
+                'expiresAt': expires_at,
+                'version': self._version
+            }
+            heapq.heappush(self._heap, (expires_at, code, self._version))
+            self._stats['added'] += 1
+
+            # Over capacity: drop the codes closest to expiry first
+            while len(self._codes) > self.max_entries:
+                if self._pop_top():
+                    self._stats['evicted'] += 1
+
+    def get(self, code):
+        """Return a copy of the entry for an unexpired code, or None"""
+        with self._lock:
+            self._evict_expired(time.time())
+            entry = self._codes.get(code)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            return dict(entry)
+
+    def discard(self, code):
+        """Forget a code once it has been redeemed or found inactive"""
+        with self._lock:
+            if self._codes.pop(code, None) is not None:
+                self._stats['removed'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._codes.clear()
+            self._heap.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._codes)
+            stats['heap_size'] = len(self._heap)
+        stats['max_entries'] = self.max_entries
+        return stats
+
+    def _evict_expired(self, now):
+        # Caller holds the lock
+        while self._heap and self._heap[0][0] <= now:
+            if self._pop_top():
+                self._stats['expired'] += 1
+        # Rebuild when stale nodes dominate the heap
+        if len(self._heap) > 2 * len(self._codes) + 64:
+            self._heap = [(entry['expiresAt'], code, entry['version']) for code, entry in self._codes.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_top(self):
+        # Caller holds the lock; returns True if a live entry was removed
+        _, code, version = heapq.heappop(self._heap)
+        entry = self._codes.get(code)
+        if entry is not None and entry['version'] == version:
+            del self._codes[code]
+            return True
+        return False
+
+
+# Global instance used by code generation and verification
+active_code_index = ActiveCodeIndex(
+    max_entries=int(os.environ.get('ACTIVE_CODE_INDEX_MAX_ENTRIES', 10000))
+)
+
+_warmer_thread = None
+_warmer_lock = threading.Lock()
+
+
+def warm_active_code_index(timeout=30.0):
+    """
+    Load active, unexpired codes from Firestore into the index
+
+    Expired codes are filtered out by the query, so they are never streamed.
+    The isActive equality plus the expiresAt range needs a composite index
+    on (isActive, expiresAt) for user_device_codes.
+
+    Returns:
+        int: Number of codes indexed
+    """
+    from google.cloud.firestore_v1.base_query import FieldFilter
+    from .firebase_utils import get_firestore_db
+
+    db = get_firestore_db()
+    query = (db.collection('user_device_codes')
+             .where(filter=FieldFilter('isActive', '==', True))
+             .where(filter=FieldFilter('expiresAt', '>', datetime.now(timezone.utc))))
+    loaded = 0
+    for doc in query.stream(timeout=timeout):
+        data = doc.to_dict()
+        if not data.get('deviceCode') or not data.get('expiresAt'):
+            continue
+        active_code_index.add(data['deviceCode'], data.get('userId'), data.get('userEmail'), data['expiresAt'])
+        loaded += 1
+    logging.info(f"[CODE-INDEX] Warmed index with {loaded} active codes")
+    return loaded
+
+
+def start_code_index_warmer(interval=None):
+    """Reload active codes in the background once per process; returns immediately"""
+    global _warmer_thread
+
+    with _warmer_lock:
+        if _warmer_thread is not None and _warmer_thread.is_alive():
+            return _warmer_thread
+
+        def warm_loop():
+            while True:
+                try:
+                    warm_active_code_index()
+                except Exception as e:
+                    logging.warning(f"[CODE-INDEX] Warm-up failed: {e}")
+                time.sleep(interval or WARM_INTERVAL_SECONDS)
+
+        _warmer_thread = threading.Thread(target=warm_loop, name='code-index-warmer', daemon=True)
+        _warmer_thread.start()
+        return _warmer_thread
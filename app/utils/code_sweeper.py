@@ -0,0 +1,146 @@
+"""
+Background expiry sweeper for device codes in UniLocator
+Deletes or deactivates expired user_device_codes documents in batches
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+# Seconds between sweeps
+SWEEP_INTERVAL_SECONDS = float(os.environ.get('CODE_SWEEP_INTERVAL_SECONDS', 3600))
+
+# 'delete' removes expired codes; 'deactivate' only sets isActive to False
+SWEEP_MODE = os.environ.get('CODE_SWEEP_MODE', 'delete')
+
+# Writes per commit (Firestore allows up to 500) and the write rate ceiling,
+# so a large backlog is worked off without crowding out live traffic
+SWEEP_BATCH_SIZE = int(os.environ.get('CODE_SWEEP_BATCH_SIZE', 500))
+SWEEP_MAX_WRITES_PER_SECOND = float(os.environ.get('CODE_SWEEP_MAX_WRITES_PER_SECOND', 100))
+
+# Upper bound on codes handled by one sweep; the rest wait for the next one
+SWEEP_MAX_CODES = int(os.environ.get('CODE_SWEEP_MAX_CODES', 20000))
+
+# Deadline for each page read and batch commit
+SWEEP_RPC_TIMEOUT_SECONDS = 30.0
+
+_state_lock = threading.Lock()
+_state = {
+    'sweeps': 0,
+    'total_handled': 0,
+    'last_sweep_at': None,
+    'last_handled': 0,
+    'last_batches': 0,
+    'last_duration_ms': None,
+    'last_error': None,
+    'mode': SWEEP_MODE
+}
+_sweeper_thread = None
+
+
+def sweep_expired_codes(mode=None, batch_size=None, max_writes_per_second=None, max_codes=None):
+    """
+    Run one sweep over expired device codes
+
+    Args:
+        mode (str): 'delete' or 'deactivate' (default SWEEP_MODE)
+        batch_size (int): Writes per batch commit, at most 500
+        max_writes_per_second (float): Write rate ceiling across batches
+        max_codes (int): Stop after handling this many codes
+
+    Returns:
+        dict: Codes handled, batches committed, duration and any error
+    """
+    from .firebase_utils import get_firestore_db
+
+    mode = mode or SWEEP_MODE
+    batch_size = min(batch_size or SWEEP_BATCH_SIZE, 500)
+    max_writes_per_second = max_writes_per_second or SWEEP_MAX_WRITES_PER_SECOND
+    max_codes = max_codes or SWEEP_MAX_CODES
+
+    handled = 0
+    batches = 0
+    error = None
+    start = time.perf_counter()
+
+    try:
+        db = get_firestore_db()
+        now = datetime.now(timezone.utc)
+        query = db.collection('user_device_codes').where('expiresAt', '<', now).order_by('expiresAt')
+        if mode == 'deactivate':
+            # Handled codes drop out of the query, so every page starts from
+            # the top (needs the composite index isActive + expiresAt)
+            query = query.where('isActive', '==', True)
+        # Only document names are needed to write or delete
+        query = query.select(['expiresAt'])
+
+        while handled < max_codes:
+            docs = query.limit(min(batch_size, max_codes - handled)).get(timeout=SWEEP_RPC_TIMEOUT_SECONDS)
+            if not docs:
+                break
+
+            batch_start = time.perf_counter()
+            batch = db.batch()
+            for doc in docs:
+                if mode == 'deactivate':
+                    batch.update(doc.reference, {'isActive': False})
+                else:
+                    batch.delete(doc.reference)
+            batch.commit(timeout=SWEEP_RPC_TIMEOUT_SECONDS)
+
+            handled += len(docs)
+            batches += 1
+
+            if len(docs) < batch_size:
+                break
+
+            # Rate limit: a batch of n writes occupies at least n / rate seconds
+            pause = len(docs) / max_writes_per_second - (time.perf_counter() - batch_start)
+            if pause > 0:
+                time.sleep(pause)
+
+    except Exception as e:
+        error = str(e)
+        logging.error(f"[CODE-SWEEP] Sweep failed after {handled} codes: {e}")
+
+    duration_ms = round((time.perf_counter() - start) * 1000, 2)
+    result = {'handled': handled, 'batches': batches, 'duration_ms': duration_ms, 'mode': mode, 'error': error}
+
+    with _state_lock:
+        _state['sweeps'] += 1
+        _state['total_handled'] += handled
+        _state['last_sweep_at'] = datetime.now().isoformat()
+        _state['last_handled'] = handled
+        _state['last_batches'] = batches
+        _state['last_duration_ms'] = duration_ms
+        _state['last_error'] = error
+        _state['mode'] = mode
+
+    logging.info(f"[CODE-SWEEP] {mode} {handled} expired codes in {batches} batches ({duration_ms} ms)")
+    return result
+
+
+def get_sweeper_stats():
+    """Return counters and the result of the latest sweep"""
+    with _state_lock:
+        return dict(_state)
+
+
+def start_code_sweeper(interval=None):
+    """Start the background sweep loop once per process; returns immediately"""
+    global _sweeper_thread
+
+    with _state_lock:
+        if _sweeper_thread is not None and _sweeper_thread.is_alive():
+            return _sweeper_thread
+
+        def sweep_loop():
+            while True:
+                time.sleep(interval or SWEEP_INTERVAL_SECONDS)
+                sweep_expired_codes()
+
+        _sweeper_thread = threading.Thread(target=sweep_loop, name='code-sweeper', daemon=True)
+        _sweeper_thread.start()
+        return _sweeper_thread
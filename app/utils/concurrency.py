@@ -0,0 +1,142 @@
+"""
+Concurrent fan-out helpers for UniLocator
+Runs independent Firestore reads side by side under a single deadline
+"""
+
+import logging
+import threading
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import wait
+
+_grpc_gevent_ready = False
+_grpc_gevent_lock = threading.Lock()
+
+
+def gevent_active():
+    """True when running under a monkey-patched gevent worker"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def init_grpc_for_gevent():
+    """
+    Make gRPC, the Admin SDK's transport, cooperate with the gevent hub
+
+    Without it a Firestore RPC blocks the whole worker, so greenlets cannot
+    overlap and a deadline cannot interrupt them. Call before the first
+    Firestore client is created; does nothing outside a gevent worker.
+
+    Returns:
+        bool: True if gRPC yields to the hub
+    """
+    global _grpc_gevent_ready
+
+    if not gevent_active():
+        return False
+    with _grpc_gevent_lock:
+        if not _grpc_gevent_ready:
+            try:
+                from grpc.experimental import gevent as grpc_gevent
+                grpc_gevent.init_gevent()
+                _grpc_gevent_ready = True
+            except Exception as e:
+                logging.warning(f"[FAN-OUT] gRPC not initialised for gevent; Firestore calls will use native threads: {e}")
+        return _grpc_gevent_ready
+
+
+def fan_out(calls, timeout, guarded=True):
+    """
+    Run several Firestore reads concurrently and collect their results under one deadline
+
+    Under a monkey-patched gevent worker each call runs as a greenlet, so the
+    reads overlap on the worker's hub instead of occupying OS threads; if gRPC
+    could not be set up for gevent, each greenlet hands its call to the hub's
+    native thread pool instead. Without gevent the calls go to the shared
+    Firestore executor. Either way the circuit breaker applies when guarded.
+
+    Args:
+        calls (dict): Name -> zero-argument callable
+        timeout (float): Seconds to wait for all calls together
+        guarded (bool): Pass False when the calls go through the circuit
+            breaker themselves (e.g. the REST client)
+
+    Returns:
+        dict: Name -> {'success', 'value', 'error', 'timeout'}
+    """
+    if not calls:
+        return {}
+    if gevent_active():
+        return _fan_out_greenlets(calls, timeout, guarded)
+    return _fan_out_threads(calls, timeout, guarded)
+
+
+def _fan_out_greenlets(calls, timeout, guarded):
+    import gevent
+    from .circuit_breaker import firestore_breaker
+
+    threadpool = None if init_grpc_for_gevent() else gevent.get_hub().threadpool
+
+    def run(fn):
+        if threadpool is not None:
+            return threadpool.apply(fn)
+        return fn()
+
+    greenlets = {}
+    for name, fn in calls.items():
+        if guarded:
+            # The breaker sees the deadline kill below as a timeout
+            greenlets[name] = gevent.spawn(firestore_breaker.call, run, fn)
+        else:
+            greenlets[name] = gevent.spawn(run, fn)
+    gevent.joinall(list(greenlets.values()), timeout=timeout)
+
+    results = {}
+    for name, greenlet in greenlets.items():
+        if not greenlet.ready():
+            greenlet.kill(FuturesTimeoutError(f"Deadline of {timeout}s expired"), block=False)
+            results[name] = _timed_out(name, timeout)
+        elif greenlet.successful():
+            results[name] = {'success': True, 'value': greenlet.value, 'error': None, 'timeout': False}
+        else:
+            results[name] = _failed(name, greenlet.exception)
+    return results
+
+
+def _fan_out_threads(calls, timeout, guarded):
+    from .firestore_executor import firestore_executor
+
+    futures = {}
+    results = {}
+    for name, fn in calls.items():
+        try:
+            futures[name] = firestore_executor.submit(lambda deadline, fn=fn: fn(), timeout, guarded=guarded)
+        except Exception as e:
+            results[name] = _failed(name, e)
+
+    wait(list(futures.values()), timeout=timeout)
+
+    for name, future in futures.items():
+        if not future.done():
+            # Queued work is dropped; running work ends at its own RPC deadline
+            firestore_executor.cancel(future)
+            results[name] = _timed_out(name, timeout)
+        elif future.cancelled():
+            results[name] = _timed_out(name, timeout)
+        elif future.exception() is not None:
+            results[name] = _failed(name, future.exception())
+        else:
+            results[name] = {'success': True, 'value': future.result(), 'error': None, 'timeout': False}
+    return results
+
+
+def _timed_out(name, timeout):
+    logging.warning(f"[FAN-OUT] {name} did not finish within {timeout}s")
+    return {'success': False, 'value': None, 'error': f'Timed out after {timeout} seconds', 'timeout': True}
+
+
+def _failed(name, error):
+    logging.error(f"[FAN-OUT] {name} failed: {error}")
+    return {'success': False, 'value': None, 'error': str(error), 'timeout': False}
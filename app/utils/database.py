@@ -1,24 +1,184 @@
 import sqlite3
 import click
-from flask import current_app, g
+import logging
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app, g, has_app_context
 import os
 
+from ..config import Config
+
+# Connection tuning; page cache is in KiB, mmap in bytes
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+POOL_TIMEOUT_SECONDS = float(os.environ.get('DB_POOL_TIMEOUT_SECONDS', 10))
+CACHE_SIZE_KIB = int(os.environ.get('DB_CACHE_SIZE_KIB', 16384))
+MMAP_SIZE_BYTES = int(os.environ.get('DB_MMAP_SIZE_BYTES', 256 * 1024 * 1024))
+STATEMENT_CACHE_SIZE = int(os.environ.get('DB_STATEMENT_CACHE_SIZE', 256))
+BUSY_TIMEOUT_SECONDS = 5.0
+
+
+class ConnectionPool:
+    """
+    Fixed-size pool of tuned SQLite connections for one database file
+
+    Connections are opened in WAL mode with synchronous=NORMAL, so readers
+    do not block the writer and commits skip the per-transaction fsync of
+    the main file. Because connections outlive a request, their page cache,
+    memory map and prepared-statement cache stay warm. A connection is
+    rolled back and reset to plain tuple rows when it is returned.
+    """
+
+    def __init__(self, path, size=POOL_SIZE, timeout=POOL_TIMEOUT_SECONDS):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._stats = {'acquired': 0, 'created': 0, 'discarded': 0, 'waits': 0, 'timeouts': 0, 'total_wait_ms': 0.0}
+
+    def acquire(self):
+        """
+        Take a connection, opening one if the pool is not yet full
+
+        Raises:
+            TimeoutError: If no connection is free within the pool timeout
+        """
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+
+        if conn is None:
+            with self._lock:
+                can_open = self._created < self.size
+                if can_open:
+                    self._created += 1
+            if can_open:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._created -= 1
+                    raise
+            else:
+                start = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    raise TimeoutError(f"No SQLite connection free within {self.timeout}s")
+                finally:
+                    with self._lock:
+                        self._stats['waits'] += 1
+                        self._stats['total_wait_ms'] += (time.perf_counter() - start) * 1000
+
+        with self._lock:
+            self._stats['acquired'] += 1
+        return conn
+
+    def release(self, conn):
+        """Return a connection; an open transaction is rolled back"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+        except sqlite3.Error as e:
+            logging.warning(f"[DB-POOL] Discarding broken connection: {e}")
+            with self._lock:
+                self._created -= 1
+                self._stats['discarded'] += 1
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['open'] = self._created
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['open'] - stats['idle']
+        waits = stats['waits']
+        total_ms = stats.pop('total_wait_ms')
+        stats['avg_wait_ms'] = round(total_ms / waits, 2) if waits else None
+        stats['size'] = self.size
+        return stats
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT_SECONDS,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,  # the pool hands each connection to one thread at a time
+            cached_statements=STATEMENT_CACHE_SIZE
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KIB}')
+        conn.execute(f'PRAGMA mmap_size={MMAP_SIZE_BYTES}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        with self._lock:
+            self._stats['created'] += 1
+        return conn
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    """Pool for path; defaults to the app's DATABASE setting"""
+    if path is None:
+        path = current_app.config['DATABASE'] if has_app_context() else Config.DATABASE
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+def db_connection(path=None):
+    """Context manager lending a pooled connection with tuple rows"""
+    return get_pool(path).connection()
+
+
+def get_pool_stats():
+    with _pools_lock:
+        pools = list(_pools.values())
+    return [pool.stats() for pool in pools]
+
+
 def get_db():
     if 'db' not in g:
-        # Ensure instance directory exists
-        os.makedirs(os.path.dirname(current_app.config['DATABASE']), exist_ok=True)
-        
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
+        # Borrowed from the pool for the rest of the request
+        g.db_pool = get_pool()
+        g.db = g.db_pool.acquire()
         g.db.row_factory = sqlite3.Row
     return g.db
 
 def close_db(e=None):
     db = g.pop('db', None)
+    pool = g.pop('db_pool', None)
     if db is not None:
-        db.close()
+        pool.release(db)
 
 def init_db():
     db = get_db()
@@ -0,0 +1,146 @@
+"""
+Per-user device list cache for UniLocator
+Bounded LRU with a TTL so rapid dashboard reloads don't go back to Firestore
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class DeviceListCache:
+    """
+    LRU + TTL cache of device lists keyed by user id
+
+    Each user can have several cached variants of their list (e.g. the REST
+    dashboard projection and the Admin SDK full documents). Invalidating a
+    user drops all of them and moves only that user's generation on.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=30.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # (user_id, variant) -> (stored_at, devices)
+        self._variants = {}  # user_id -> set of cached variants
+        # Users invalidated recently -> generation stamped by their last
+        # invalidation; every other user is at the floor
+        self._generations = OrderedDict()
+        self._generation_floor = 0
+        self._counter = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale_hits': 0, 'expirations': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get(self, user_id, variant, allow_stale=False):
+        """
+        Return a copy of the cached device list, or None on a miss
+
+        With allow_stale, an expired entry is still returned (and kept); used
+        as a fallback while Firestore is unavailable.
+        """
+        key = (user_id, variant)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+
+            stored_at, devices = entry
+            if allow_stale:
+                self._stats['stale_hits'] += 1
+                return list(devices)
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return list(devices)
+
+    def generation(self, user_id):
+        """Generation of a user's lists; read it before fetching and pass it to set()"""
+        with self._lock:
+            return self._generations.get(user_id, self._generation_floor)
+
+    def set(self, user_id, variant, devices, generation=None):
+        """
+        Store a device list, evicting the least recently used entries past the size limit
+
+        Pass the user's generation read before fetching; the list is discarded
+        if that user was invalidated in between, since it may predate the change.
+        """
+        if self.max_entries <= 0:
+            return
+
+        key = (user_id, variant)
+        with self._lock:
+            if generation is not None and generation != self._generations.get(user_id, self._generation_floor):
+                return
+            self._entries[key] = (time.monotonic(), list(devices))
+            self._entries.move_to_end(key)
+            self._variants.setdefault(user_id, set()).add(variant)
+
+            while len(self._entries) > self.max_entries:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+    def invalidate(self, *user_ids):
+        """Drop every cached list for the given users"""
+        with self._lock:
+            for user_id in user_ids:
+                self._counter += 1
+                self._generations[user_id] = self._counter
+                self._generations.move_to_end(user_id)
+                for variant in self._variants.pop(user_id, ()):
+                    self._entries.pop((user_id, variant), None)
+                    self._stats['invalidations'] += 1
+
+            # Forget the oldest stamps; raising the floor past them keeps any
+            # fetch that started before those invalidations from being stored
+            while len(self._generations) > max(self.max_entries, 1024):
+                _, stamp = self._generations.popitem(last=False)
+                self._generation_floor = max(self._generation_floor, stamp)
+
+    def clear(self):
+        with self._lock:
+            self._counter += 1
+            self._generation_floor = self._counter
+            self._generations.clear()
+            self._entries.clear()
+            self._variants.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['ttl_seconds'] = self.ttl_seconds
+        return stats
+
+    def _remove(self, key):
+        # Caller holds the lock
+        self._entries.pop(key, None)
+        user_id, variant = key
+        variants = self._variants.get(user_id)
+        if variants is not None:
+            variants.discard(variant)
+            if not variants:
+                del self._variants[user_id]
+
+
+# Global instance shared by the REST client and the Admin SDK helpers
+device_list_cache = DeviceListCache(
+    max_entries=int(os.environ.get('DEVICE_CACHE_MAX_ENTRIES', 1024)),
+    ttl_seconds=float(os.environ.get('DEVICE_CACHE_TTL_SECONDS', 30))
+)
+
+
+def invalidate_user_devices(*user_ids):
+    """Invalidate cached device lists after a device is connected, removed or verified"""
+    device_list_cache.invalidate(*[user_id for user_id in user_ids if user_id])
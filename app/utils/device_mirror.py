@@ -0,0 +1,237 @@
+"""
+Optional in-memory mirror of the user_devices collection for UniLocator
+Kept current by a Firestore snapshot listener so dashboard reads skip the network
+"""
+
+import logging
+import os
+import threading
+import time
+
+# Off unless explicitly enabled: the listener holds every user_devices document in memory
+MIRROR_ENABLED = os.environ.get('DEVICE_MIRROR_ENABLED', 'false').lower() == 'true'
+
+# Seconds between listener health checks, and between full resyncs
+MIRROR_CHECK_INTERVAL_SECONDS = float(os.environ.get('DEVICE_MIRROR_CHECK_INTERVAL_SECONDS', 15))
+MIRROR_RESYNC_INTERVAL_SECONDS = float(os.environ.get('DEVICE_MIRROR_RESYNC_INTERVAL_SECONDS', 3600))
+
+
+def _plain(value):
+    # Match the REST client's decoding: geo points become latitude/longitude dicts
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    if hasattr(value, 'latitude') and hasattr(value, 'longitude'):
+        return {'latitude': value.latitude, 'longitude': value.longitude}
+    return value
+
+
+def _project(data, field_mask):
+    # Keep only the given dotted field paths, like a Firestore field mask
+    projected = {}
+    for path in field_mask:
+        source, target = data, projected
+        parts = path.split('.')
+        for part in parts[:-1]:
+            source = source.get(part) if isinstance(source, dict) else None
+            if not isinstance(source, dict):
+                break
+            target = target.setdefault(part, {})
+        else:
+            if isinstance(source, dict) and parts[-1] in source:
+                target[parts[-1]] = source[parts[-1]]
+    return projected
+
+
+class DeviceMirror:
+    """
+    user_devices documents indexed by userId, fed by an on_snapshot listener
+
+    The first snapshot of each listener replaces the whole mirror; later
+    snapshots apply only the changed documents. A supervisor thread restarts
+    the listener when it stops and resyncs periodically. Until the first
+    snapshot arrives, and whenever the listener is down, get_user_devices()
+    returns None so callers fall back to reading Firestore.
+    """
+
+    def __init__(self, check_interval=MIRROR_CHECK_INTERVAL_SECONDS, resync_interval=MIRROR_RESYNC_INTERVAL_SECONDS):
+        self.check_interval = check_interval
+        self.resync_interval = resync_interval
+        self._docs = {}  # doc id -> userId
+        self._by_user = {}  # userId -> {doc id: document}
+        self._lock = threading.Lock()
+        self._watch = None
+        self._generation = 0
+        self._synced_generation = None
+        self._subscribed_at = None
+        self._last_snapshot_at = None
+        self._supervisor = None
+        self._stats = {'snapshots': 0, 'changes': 0, 'resyncs': 0, 'restarts': 0, 'hits': 0, 'fallbacks': 0, 'last_error': None}
+
+    @property
+    def ready(self):
+        """True while the listener is up and has delivered its first snapshot"""
+        watch = self._watch
+        return (watch is not None and watch.is_active
+                and self._synced_generation is not None and self._synced_generation == self._generation)
+
+    def get_user_devices(self, user_id, field_mask=None):
+        """
+        Return a user's devices from memory, or None if the mirror can't serve them
+
+        Args:
+            user_id (str): Firebase UID of the user
+            field_mask (list): Optional dotted field paths to keep
+
+        Returns:
+            list: Device documents with 'firebase_doc_id', or None
+        """
+        if not self.ready:
+            with self._lock:
+                self._stats['fallbacks'] += 1
+            return None
+
+        with self._lock:
+            self._stats['hits'] += 1
+            documents = list(self._by_user.get(user_id, {}).items())
+
+        devices = []
+        for doc_id, data in documents:
+            device = _project(data, field_mask) if field_mask else dict(data)
+            device['firebase_doc_id'] = doc_id
+            devices.append(device)
+        return devices
+
+    def start(self):
+        """Subscribe and start the supervisor once per process; returns immediately"""
+        with self._lock:
+            if self._supervisor is not None and self._supervisor.is_alive():
+                return self._supervisor
+            self._supervisor = threading.Thread(target=self._supervise, name='device-mirror', daemon=True)
+            self._supervisor.start()
+            return self._supervisor
+
+    def stats(self):
+        """Listener state, sizes and the staleness gauge"""
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats['documents'] = len(self._docs)
+            stats['users'] = len(self._by_user)
+        stats['enabled'] = True
+        stats['ready'] = self.ready
+        # Seconds since the listener last delivered a snapshot; grows while
+        # nothing changes, so read it together with 'ready'
+        stats['staleness_seconds'] = round(now - self._last_snapshot_at, 3) if self._last_snapshot_at else None
+        stats['listener_age_seconds'] = round(now - self._subscribed_at, 3) if self._subscribed_at else None
+        return stats
+
+    def _supervise(self):
+        while True:
+            try:
+                watch = self._watch
+                if watch is None or not watch.is_active:
+                    if watch is not None:
+                        logging.warning("[DEVICE-MIRROR] Listener stopped; resubscribing")
+                        self._stats['restarts'] += 1
+                    self._subscribe()
+                elif time.monotonic() - self._subscribed_at >= self.resync_interval:
+                    logging.info("[DEVICE-MIRROR] Periodic resync")
+                    self._stats['resyncs'] += 1
+                    self._subscribe()
+            except Exception as e:
+                self._stats['last_error'] = str(e)
+                logging.error(f"[DEVICE-MIRROR] Supervisor error: {e}")
+            time.sleep(self.check_interval)
+
+    def _subscribe(self):
+        from .firebase_utils import get_firestore_db
+
+        old_watch = self._watch
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+
+        db = get_firestore_db()
+        self._watch = db.collection('user_devices').on_snapshot(
+            lambda snapshot, changes, read_time: self._on_snapshot(generation, snapshot, changes)
+        )
+        self._subscribed_at = time.monotonic()
+
+        if old_watch is not None:
+            try:
+                old_watch.unsubscribe()
+            except Exception as e:
+                logging.debug(f"[DEVICE-MIRROR] Closing previous listener: {e}")
+
+    def _on_snapshot(self, generation, snapshot, changes):
+        try:
+            with self._lock:
+                if generation != self._generation:
+                    return  # A replaced listener delivering late
+
+                if self._synced_generation != generation:
+                    # First snapshot of this listener: rebuild from scratch
+                    self._docs = {}
+                    self._by_user = {}
+                    for doc in snapshot:
+                        self._put(doc)
+                    self._synced_generation = generation
+                    logging.info(f"[DEVICE-MIRROR] Synced {len(self._docs)} devices for {len(self._by_user)} users")
+                else:
+                    for change in changes:
+                        if change.type.name == 'REMOVED':
+                            self._drop(change.document.id)
+                        else:
+                            self._put(change.document)
+                    self._stats['changes'] += len(changes)
+
+                self._stats['snapshots'] += 1
+                self._last_snapshot_at = time.monotonic()
+        except Exception as e:
+            self._stats['last_error'] = str(e)
+            logging.error(f"[DEVICE-MIRROR] Failed to apply snapshot: {e}")
+
+    def _put(self, doc):
+        # Caller holds the lock
+        data = _plain(doc.to_dict() or {})
+        self._drop(doc.id)
+        user_id = data.get('userId')
+        if user_id:
+            self._docs[doc.id] = user_id
+            self._by_user.setdefault(user_id, {})[doc.id] = data
+
+    def _drop(self, doc_id):
+        # Caller holds the lock
+        user_id = self._docs.pop(doc_id, None)
+        if user_id is None:
+            return
+        user_docs = self._by_user.get(user_id)
+        if user_docs is not None:
+            user_docs.pop(doc_id, None)
+            if not user_docs:
+                del self._by_user[user_id]
+
+
+# Global instance; None unless DEVICE_MIRROR_ENABLED is set
+device_mirror = DeviceMirror() if MIRROR_ENABLED else None
+
+
+def get_mirrored_devices(user_id, field_mask=None):
+    """Devices from the mirror, or None when the mirror is off or not ready"""
+    if device_mirror is None:
+        return None
+    return device_mirror.get_user_devices(user_id, field_mask)
+
+
+def get_mirror_stats():
+    if device_mirror is None:
+        return {'enabled': False}
+    return device_mirror.stats()
+
+
+def start_device_mirror():
+    """Start the listener if the mirror is enabled"""
+    if device_mirror is not None:
+        device_mirror.start()
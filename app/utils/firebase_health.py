@@ -0,0 +1,103 @@
+"""
+Background Firestore health monitor for UniLocator
+Probes connectivity off the request path and caches the latest result
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+# Seconds between connectivity probes
+PROBE_INTERVAL_SECONDS = float(os.environ.get('FIREBASE_HEALTH_INTERVAL_SECONDS', 60))
+
+# Deadline for each probe RPC
+PROBE_TIMEOUT_SECONDS = 10.0
+
+_state_lock = threading.Lock()
+_state = {
+    'status': 'unknown',  # unknown | healthy | unhealthy
+    'last_probe_at': None,
+    'last_success_at': None,
+    'consecutive_failures': 0,
+    'probes': 0,
+    'error': None,
+    'latency_ms': None  # {'init', 'write', 'delete', 'total'}
+}
+_monitor_thread = None
+
+
+def probe_firestore():
+    """
+    Run one connectivity probe: write and delete connection_test/test_connection
+
+    Returns:
+        dict: The updated health state
+    """
+    from firebase_admin import firestore
+    from .firebase_utils import get_firestore_db
+
+    latency = {}
+    error = None
+    start = time.perf_counter()
+
+    try:
+        step = time.perf_counter()
+        db = get_firestore_db()
+        latency['init'] = round((time.perf_counter() - step) * 1000, 2)
+
+        test_doc_ref = db.collection('connection_test').document('test_connection')
+
+        step = time.perf_counter()
+        test_doc_ref.set({'test': True, 'timestamp': firestore.SERVER_TIMESTAMP}, timeout=PROBE_TIMEOUT_SECONDS)
+        latency['write'] = round((time.perf_counter() - step) * 1000, 2)
+
+        step = time.perf_counter()
+        test_doc_ref.delete(timeout=PROBE_TIMEOUT_SECONDS)
+        latency['delete'] = round((time.perf_counter() - step) * 1000, 2)
+
+    except Exception as e:
+        error = str(e)
+        logging.warning(f"[FIREBASE-HEALTH] Connectivity probe failed: {e}")
+
+    latency['total'] = round((time.perf_counter() - start) * 1000, 2)
+    now = datetime.now().isoformat()
+
+    with _state_lock:
+        _state['probes'] += 1
+        _state['last_probe_at'] = now
+        _state['latency_ms'] = latency
+        _state['error'] = error
+        if error is None:
+            _state['status'] = 'healthy'
+            _state['last_success_at'] = now
+            _state['consecutive_failures'] = 0
+        else:
+            _state['status'] = 'unhealthy'
+            _state['consecutive_failures'] += 1
+        return dict(_state)
+
+
+def get_firebase_health():
+    """Return the cached result of the latest probe (never touches Firestore)"""
+    with _state_lock:
+        return dict(_state)
+
+
+def start_health_monitor(interval=None):
+    """Start the background probe loop once per process; returns immediately"""
+    global _monitor_thread
+
+    with _state_lock:
+        if _monitor_thread is not None and _monitor_thread.is_alive():
+            return _monitor_thread
+
+        def monitor_loop():
+            while True:
+                probe_firestore()
+                time.sleep(interval or PROBE_INTERVAL_SECONDS)
+
+        _monitor_thread = threading.Thread(target=monitor_loop, name='firebase-health', daemon=True)
+        _monitor_thread.start()
+        return _monitor_thread
@@ -3,18 +3,74 @@ Firebase REST API Client - Alternative to Admin SDK
 This bypasses the Admin SDK completely and uses direct HTTP requests
 """
 import requests
+import base64
 import json
 import logging
-from typing import Dict, List, Optional
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Optional
 from google.oauth2 import service_account
 from google.auth.transport.requests import Request
+from requests.adapters import HTTPAdapter
+from .device_cache import device_list_cache
+from .device_mirror import get_mirrored_devices
+from .circuit_breaker import CircuitBreaker, firestore_breaker
+from .tracing import NULL_TRACE
 
 logger = logging.getLogger(__name__)
 
+# Refresh the OAuth token this long before it actually expires
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
+# Firestore signals overload with these; they are safe to retry after a pause
+RETRYABLE_STATUS_CODES = (429, 503)
+
+# Fields the dashboard and /api/fetch-devices-production actually render from
+# a user_devices document; everything else the phone uploads is left behind
+DASHBOARD_DEVICE_FIELDS = [
+    'deviceId',
+    'deviceName',
+    'deviceModel',
+    'deviceType',
+    'androidVersion',
+    'appVersion',
+    'isActive',
+    'registeredAt',
+    'lastSeenAt',
+    'lastLocation',
+    'deviceInfo.brand',
+    'deviceInfo.manufacturer',
+    'deviceInfo.product',
+]
+
 class FirebaseRestClient:
-    def __init__(self, project_id: str, service_account_path: str):
+    def __init__(self, project_id: str, service_account_path: str, pool_size: int = 10,
+                 max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 breaker: Optional[CircuitBreaker] = None):
         self.project_id = project_id
-        self.base_url = f"https://firestore.googleapis.com/v1/projects/{project_id}/databases/(default)/documents"
+        self.documents_root = f"projects/{project_id}/databases/(default)/documents"
+        self.base_url = f"https://firestore.googleapis.com/v1/{self.documents_root}"
+        
+        # Keep-alive session shared by every request from this client. The
+        # pool blocks instead of opening extra sockets, and the semaphore caps
+        # how many requests are in flight at once.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._connection_slots = threading.BoundedSemaphore(pool_size)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._http_stats = {'requests': 0, 'retries': 0, 'errors': 0}
+        self.breaker = breaker
+        
+        # Access token cache state; refresh is single-flight under _token_lock
+        self._token_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._token_stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'failures': 0}
         
         # Initialize credentials
         try:
@@ -29,17 +85,57 @@ class FirebaseRestClient:
             self.credentials = None
     
     def get_access_token(self) -> Optional[str]:
-        """Get a fresh access token"""
-        try:
-            if self.credentials:
-                self.credentials.refresh(Request())
-                return self.credentials.token
-        except Exception as e:
-            logger.error(f"Failed to get access token: {e}")
-        return None
+        """Get a cached access token, refreshing it shortly before expiry"""
+        if not self.credentials:
+            return None
+        
+        if self._token_is_fresh():
+            self._count_token('hits')
+            return self.credentials.token
+        
+        # Only one caller refreshes; the others wait and reuse its token
+        with self._token_lock:
+            self._count_token('misses')
+            if not self._token_is_fresh():
+                try:
+                    self.credentials.refresh(Request())
+                    self._count_token('refreshes')
+                except Exception as e:
+                    self._count_token('failures')
+                    logger.error(f"Failed to get access token: {e}")
+                    return None
+            return self.credentials.token
     
-    def fetch_user_devices(self, user_id: str) -> Dict:
-        """Fetch devices for a specific user using REST API"""
+    def get_token_stats(self) -> Dict:
+        """Return access token cache counters"""
+        with self._stats_lock:
+            stats = dict(self._token_stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['expires_at'] = self.credentials.expiry.isoformat() if self.credentials and self.credentials.expiry else None
+        return stats
+    
+    def _token_is_fresh(self) -> bool:
+        """Check whether the current token is valid beyond the refresh margin"""
+        # google-auth stores expiry as a naive UTC datetime
+        expiry = self.credentials.expiry
+        if not self.credentials.token or expiry is None:
+            return False
+        return datetime.utcnow() < expiry - TOKEN_REFRESH_MARGIN
+    
+    def _count_token(self, counter: str):
+        with self._stats_lock:
+            self._token_stats[counter] += 1
+    
+    def fetch_user_devices(self, user_id: str, field_mask: Optional[List[str]] = None,
+                           use_cache: bool = True, trace=None) -> Dict:
+        """
+        Fetch devices for a specific user using REST API
+        
+        Pass a Trace to record per-phase timings; the result then carries the
+        structured trace under 'trace' and its rendered lines under 'logs'.
+        """
+        trace = trace or NULL_TRACE
         result = {
             'success': False,
             'devices': [],
@@ -48,116 +144,391 @@ class FirebaseRestClient:
         }
         
         try:
-            result['logs'].append("🔄 Starting REST API device fetch...")
+            result['devices'] = list(self.iter_user_devices(
+                user_id, field_mask=field_mask, use_cache=use_cache, trace=trace
+            ))
+            result['success'] = True
+            trace.event("Fetched devices", user_id=user_id, count=len(result['devices']))
+                
+        except requests.exceptions.Timeout:
+            result['error'] = "Request timeout after 10 seconds"
+        except Exception as e:
+            result['error'] = str(e)
+        
+        if trace.enabled:
+            if result['error']:
+                trace.event("Fetch failed", error=result['error'])
+            result['trace'] = trace.to_dict()
+            result['logs'] = trace.render()
+        
+        return result
+    
+    def iter_user_devices(self, user_id: str, field_mask: Optional[List[str]] = None,
+                          use_cache: bool = True, trace=NULL_TRACE) -> Iterator[Dict]:
+        """
+        Yield a user's user_devices documents, served from memory when possible
+        
+        The snapshot mirror is used when it is enabled and listening, then
+        the device list cache. On a miss the documents are streamed from
+        Firestore and the list is cached once the caller has consumed all of them.
+        """
+        variant = ('rest', tuple(field_mask) if field_mask else None)
+        if use_cache:
+            with trace.span('mirror') as span:
+                mirrored = get_mirrored_devices(user_id, field_mask)
+                span.set(hit=mirrored is not None)
+            if mirrored is not None:
+                yield from mirrored
+                return
             
-            # Get access token
-            token = self.get_access_token()
-            if not token:
-                result['error'] = "Failed to get access token"
-                return result
+            with trace.span('cache') as span:
+                cached = device_list_cache.get(user_id, variant)
+                span.set(hit=cached is not None)
+            if cached is not None:
+                yield from cached
+                return
             
-            result['logs'].append("✅ Got access token")
+            # Firestore is failing: an expired list beats an error
+            if self.breaker is not None and self.breaker.state == CircuitBreaker.OPEN:
+                stale = device_list_cache.get(user_id, variant, allow_stale=True)
+                if stale is not None:
+                    trace.event('served stale device list; circuit open')
+                    yield from stale
+                    return
+        
+        generation = device_list_cache.generation(user_id)
+        devices = []
+        for doc_data in self.iter_documents('user_devices', {'userId': user_id},
+                                            field_mask=field_mask, trace=trace):
+            devices.append(doc_data)
+            yield doc_data
+        
+        device_list_cache.set(user_id, variant, devices, generation)
+    
+    def iter_documents(self, collection: str, filters: Optional[Dict] = None,
+                       page_size: int = 300, field_mask: Optional[List[str]] = None,
+                       trace=NULL_TRACE) -> Iterator[Dict]:
+        """
+        Lazily yield parsed documents from a collection, one page at a time
+        
+        Args:
+            collection (str): Collection id, e.g. 'user_devices'
+            filters (dict): Optional field -> value equality filters
+            page_size (int): Documents requested per round trip
+            field_mask (list): Optional field paths to return instead of whole documents
+            trace (Trace): Optional trace to record token/http/decode spans in
             
-            # Construct query URL
-            collection_url = f"{self.base_url}/user_devices"
+        Raises:
+            RuntimeError: If no access token is available or a page request fails
+        """
+        if filters:
+            pages = self._iter_query_pages(collection, filters, page_size, field_mask, trace)
+        else:
+            pages = self._iter_list_pages(collection, page_size, field_mask, trace)
+        
+        for documents in pages:
+            with trace.span('decode', documents=len(documents)):
+                parsed = [self._parse_document(doc) for doc in documents]
+            for doc_data in parsed:
+                if doc_data:
+                    yield doc_data
+    
+    def batch_get(self, doc_paths: List[str], field_mask: Optional[List[str]] = None) -> Dict[str, Optional[Dict]]:
+        """
+        Fetch many known documents in one batchGet round trip
+        
+        Args:
+            doc_paths (list): Paths relative to the database root, e.g. 'user_devices/abc'
+            field_mask (list): Optional field paths to return instead of whole documents
             
-            headers = {
-                'Authorization': f'Bearer {token}',
-                'Content-Type': 'application/json'
-            }
+        Returns:
+            dict: Path -> parsed document, or None when the document does not exist,
+            in the order the paths were given
+            
+        Raises:
+            RuntimeError: If no access token is available or the request fails
+        """
+        results = {path: None for path in doc_paths}
+        if not doc_paths:
+            return results
+        
+        prefix = f"{self.documents_root}/"
+        body = {'documents': [prefix + path for path in doc_paths]}
+        if field_mask:
+            body['mask'] = {'fieldPaths': list(field_mask)}
+        
+        response = self._request('POST', f"{self.base_url}:batchGet", headers=self._auth_headers(), json=body)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
+        
+        # One entry per requested document, each either 'found' or 'missing'
+        for entry in response.json():
+            found = entry.get('found')
+            if found:
+                path = found['name'][len(prefix):]
+                results[path] = decode_fields(found.get('fields', {}))
+        
+        return results
+    
+    def _iter_list_pages(self, collection: str, page_size: int,
+                         field_mask: Optional[List[str]] = None,
+                         trace=NULL_TRACE) -> Iterator[List[Dict]]:
+        """Yield raw document pages from a collection listing, following nextPageToken"""
+        url = f"{self.base_url}/{collection}"
+        params = {'pageSize': page_size}
+        if field_mask:
+            params['mask.fieldPaths'] = list(field_mask)
+        
+        page = 0
+        while True:
+            page += 1
+            with trace.span('token'):
+                headers = self._auth_headers()
+            with trace.span('http', page=page) as span:
+                response = self._request('GET', url, headers=headers, params=params)
+                span.set(status=response.status_code)
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
             
-            result['logs'].append(f"🔄 Querying: {collection_url}")
+            data = response.json()
+            yield data.get('documents', [])
             
-            # Make request with timeout
-            response = requests.get(collection_url, headers=headers, timeout=10)
+            page_token = data.get('nextPageToken')
+            if not page_token:
+                return
+            params['pageToken'] = page_token
+    
+    def _iter_query_pages(self, collection: str, filters: Dict, page_size: int,
+                          field_mask: Optional[List[str]] = None,
+                          trace=NULL_TRACE) -> Iterator[List[Dict]]:
+        """Yield raw document pages from runQuery, paging with a __name__ cursor"""
+        url = f"{self.base_url}:runQuery"
+        query = self._build_structured_query(collection, filters, field_mask)
+        structured_query = query['structuredQuery']
+        structured_query['orderBy'] = [{'field': {'fieldPath': '__name__'}, 'direction': 'ASCENDING'}]
+        structured_query['limit'] = page_size
+        
+        page = 0
+        while True:
+            page += 1
+            with trace.span('token'):
+                headers = self._auth_headers()
+            with trace.span('http', page=page) as span:
+                response = self._request('POST', url, headers=headers, json=query)
+                span.set(status=response.status_code)
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}: {response.text}")
             
-            result['logs'].append(f"📡 Response status: {response.status_code}")
+            # runQuery returns one entry per result; entries without a
+            # 'document' key only carry a readTime (e.g. empty result)
+            documents = [entry['document'] for entry in response.json() if 'document' in entry]
+            yield documents
             
-            if response.status_code == 200:
-                data = response.json()
-                result['logs'].append(f"📊 Raw response keys: {list(data.keys())}")
+            if len(documents) < page_size:
+                return
+            structured_query['startAt'] = {
+                'values': [{'referenceValue': documents[-1]['name']}],
+                'before': False
+            }
+    
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """
+        Send a request over the pooled session, retrying 429/503 with jittered backoff
+        
+        Raises:
+            CircuitOpenError: If the circuit breaker is open
+        """
+        kwargs.setdefault('timeout', 10)
+        trial = self.breaker.before_call() if self.breaker is not None else False
+        
+        try:
+            for attempt in range(self.max_retries + 1):
+                with self._connection_slots:
+                    self._count_http('requests')
+                    try:
+                        response = self.session.request(method, url, **kwargs)
+                    except requests.exceptions.RequestException:
+                        self._count_http('errors')
+                        raise
                 
-                if 'documents' in data:
-                    documents = data['documents']
-                    result['logs'].append(f"📋 Found {len(documents)} total documents")
-                    
-                    user_devices = []
-                    for doc in documents:
-                        try:
-                            # Extract document data
-                            doc_data = self._parse_document(doc)
-                            if doc_data and doc_data.get('userId') == user_id:
-                                user_devices.append(doc_data)
-                                result['logs'].append(f"✅ Found device: {doc_data.get('deviceId', 'Unknown')}")
-                        except Exception as e:
-                            result['logs'].append(f"⚠️ Error parsing document: {e}")
-                    
-                    result['devices'] = user_devices
-                    result['success'] = True
-                    result['logs'].append(f"🎉 Successfully found {len(user_devices)} devices for user {user_id}")
-                else:
-                    result['logs'].append("📋 No documents field in response")
-                    result['success'] = True  # Empty collection is valid
-            else:
-                result['error'] = f"HTTP {response.status_code}: {response.text}"
-                result['logs'].append(f"❌ Request failed: {result['error']}")
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_retries:
+                    break
                 
-        except requests.exceptions.Timeout:
-            result['error'] = "Request timeout after 10 seconds"
-            result['logs'].append("⏰ Request timed out")
-        except Exception as e:
-            result['error'] = str(e)
-            result['logs'].append(f"❌ Exception: {e}")
+                self._count_http('retries')
+                time.sleep(self._retry_delay(response, attempt))
+        except BaseException as e:
+            # Anything, including an interrupted greenlet, must give back a half-open trial
+            if self.breaker is not None:
+                self.breaker.record(e, trial)
+            raise
         
-        return result
+        if self.breaker is not None:
+            if response.status_code in RETRYABLE_STATUS_CODES or response.status_code >= 500:
+                self.breaker.record_failure(RuntimeError(f"HTTP {response.status_code}"), trial)
+            else:
+                self.breaker.record_success(trial)
+        return response
+    
+    def _retry_delay(self, response: requests.Response, attempt: int) -> float:
+        """Honour Retry-After when present, otherwise use full-jitter exponential backoff"""
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+    
+    def get_http_stats(self) -> Dict:
+        """Return HTTP request and retry counters"""
+        with self._stats_lock:
+            return dict(self._http_stats)
+    
+    def _count_http(self, counter: str):
+        with self._stats_lock:
+            self._http_stats[counter] += 1
+    
+    def _auth_headers(self) -> Dict:
+        """Build request headers with a bearer token"""
+        token = self.get_access_token()
+        if not token:
+            raise RuntimeError("Failed to get access token")
+        return {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+    
+    def _build_structured_query(self, collection: str, filters: Optional[Dict] = None,
+                                field_mask: Optional[List[str]] = None) -> Dict:
+        """Build a runQuery body for a collection with equality filters and an optional projection"""
+        structured_query = {'from': [{'collectionId': collection}]}
+        
+        if field_mask:
+            structured_query['select'] = {'fields': [{'fieldPath': path} for path in field_mask]}
+        
+        field_filters = [
+            {
+                'fieldFilter': {
+                    'field': {'fieldPath': field},
+                    'op': 'EQUAL',
+                    'value': self._encode_value(value)
+                }
+            }
+            for field, value in (filters or {}).items()
+        ]
+        
+        if len(field_filters) == 1:
+            structured_query['where'] = field_filters[0]
+        elif field_filters:
+            structured_query['where'] = {
+                'compositeFilter': {'op': 'AND', 'filters': field_filters}
+            }
+        
+        return {'structuredQuery': structured_query}
+    
+    def _encode_value(self, value) -> Dict:
+        """Encode a Python value as a Firestore REST value"""
+        if value is None:
+            return {'nullValue': None}
+        if isinstance(value, bool):
+            return {'booleanValue': value}
+        if isinstance(value, int):
+            return {'integerValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
     
     def _parse_document(self, doc: Dict) -> Optional[Dict]:
         """Parse Firestore document format to regular dict"""
         try:
             if 'fields' not in doc:
                 return None
-            
-            parsed = {}
-            fields = doc['fields']
-            
-            for key, value in fields.items():
-                if 'stringValue' in value:
-                    parsed[key] = value['stringValue']
-                elif 'integerValue' in value:
-                    parsed[key] = int(value['integerValue'])
-                elif 'doubleValue' in value:
-                    parsed[key] = float(value['doubleValue'])
-                elif 'booleanValue' in value:
-                    parsed[key] = value['booleanValue']
-                elif 'timestampValue' in value:
-                    parsed[key] = value['timestampValue']
-                elif 'mapValue' in value and 'fields' in value['mapValue']:
-                    # Handle nested objects (like deviceInfo)
-                    parsed[key] = self._parse_document({'fields': value['mapValue']['fields']})
-                elif 'arrayValue' in value:
-                    # Handle arrays
-                    parsed[key] = [self._parse_value(item) for item in value['arrayValue'].get('values', [])]
-            
-            return parsed
+            return decode_fields(doc['fields'])
         except Exception as e:
             logger.error(f"Error parsing document: {e}")
             return None
+
+def _decode_timestamp(raw: str) -> datetime:
+    """Decode an RFC 3339 timestamp; Firestore sends UTC with up to nanosecond precision"""
+    try:
+        # Python 3.11+ parses RFC 3339 directly, truncating past microseconds
+        return datetime.fromisoformat(raw)
+    except ValueError:
+        pass
+    value = raw[:-1] if raw.endswith('Z') else raw
+    main, _, fraction = value.partition('.')
+    parsed = datetime.fromisoformat(main)
+    if fraction:
+        parsed = parsed.replace(microsecond=int(fraction[:6].ljust(6, '0')))
+    return parsed.replace(tzinfo=timezone.utc)
+
+def _decode_geo_point(raw: Dict) -> Dict:
+    # Zero coordinates are omitted from the JSON encoding
+    return {'latitude': raw.get('latitude', 0.0), 'longitude': raw.get('longitude', 0.0)}
+
+# Decoders for every scalar Firestore value type, keyed by the JSON value tag.
+# mapValue and arrayValue are expanded iteratively in decode_fields.
+_SCALAR_DECODERS = {
+    'nullValue': lambda raw: None,
+    'booleanValue': bool,
+    'integerValue': int,
+    'doubleValue': float,
+    'timestampValue': _decode_timestamp,
+    'stringValue': str,
+    'bytesValue': base64.b64decode,
+    'referenceValue': str,
+    'geoPointValue': _decode_geo_point,
+}
+
+def decode_fields(fields: Dict) -> Dict:
+    """
+    Decode a Firestore REST 'fields' mapping into plain Python values
+    
+    Nested maps and arrays are walked with an explicit stack, so deeply
+    nested documents cannot hit the recursion limit. Scalars are decoded
+    in place; only containers go on the stack.
+    """
+    decoded = {}
+    # Each entry is (container, iterable of (key or index, encoded value));
+    # a container is inserted into its parent before it is filled, so keys
+    # keep their original order
+    stack = [(decoded, fields.items())]
     
-    def _parse_value(self, value: Dict):
-        """Parse individual Firestore value"""
-        if 'stringValue' in value:
-            return value['stringValue']
-        elif 'integerValue' in value:
-            return int(value['integerValue'])
-        elif 'doubleValue' in value:
-            return float(value['doubleValue'])
-        elif 'booleanValue' in value:
-            return value['booleanValue']
-        elif 'timestampValue' in value:
-            return value['timestampValue']
-        elif 'mapValue' in value:
-            return self._parse_document({'fields': value['mapValue']['fields']})
-        return value
+    while stack:
+        target, items = stack.pop()
+        for key, value in items:
+            kind, raw = next(iter(value.items()), (None, None))
+            if kind is None:
+                continue
+            decoder = _SCALAR_DECODERS.get(kind)
+            if decoder is not None:
+                target[key] = decoder(raw)
+            elif kind == 'mapValue':
+                child = target[key] = {}
+                stack.append((child, raw.get('fields', {}).items()))
+            elif kind == 'arrayValue':
+                values = raw.get('values', [])
+                child = target[key] = [None] * len(values)
+                stack.append((child, enumerate(values)))
+            else:
+                target[key] = raw
+    
+    return decoded
+
+def json_safe(value):
+    """
+    Copy of decoded values in the form routes return them
+
+    decode_fields yields datetime and bytes, which Flask would render as
+    RFC 822 dates (dropping sub-second precision) or refuse; timestamps
+    become RFC 3339 strings as Firestore sends them and bytes become base64.
+    """
+    if isinstance(value, dict):
+        return {key: json_safe(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [json_safe(item) for item in value]
+    if isinstance(value, datetime):
+        return value.isoformat().replace('+00:00', 'Z')
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    return value
 
 # Global instance
 rest_client = None
@@ -169,6 +540,7 @@ def get_rest_client():
         # Initialize with your project details - using the correct project ID from service account
         rest_client = FirebaseRestClient(
             project_id="unilocator-368db",  # Fixed: matches service account file
-            service_account_path="service-account-key.json"
+            service_account_path="service-account-key.json",
+            breaker=firestore_breaker
         )
     return rest_client
@@ -9,86 +9,85 @@ import os
 import logging
 import string
 import secrets
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import threading
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from .device_cache import device_list_cache, invalidate_user_devices
+from .concurrency import fan_out
+from .tracing import Trace
+from .firestore_executor import firestore_executor, Deadline
+from .code_index import active_code_index
+from .bulk_writer import bulk_writer
+from .device_mirror import get_mirrored_devices
+from .circuit_breaker import CircuitBreaker, CircuitOpenError, firestore_breaker
+from google.api_core.exceptions import AlreadyExists
 
-# Global Firebase Admin SDK instance
+# Global Firebase Admin SDK instance, created on first use
 _db = None
+_init_lock = threading.Lock()
+
+# Attempts per redemption; the transaction is re-run when a concurrent
+# redemption of the same code commits first
+REDEEM_MAX_ATTEMPTS = 5
+
+# Seconds a redemption may take, including retries
+REDEEM_TIMEOUT_SECONDS = 15.0
+
+# Codes drawn before giving up when each one is already taken, and seconds
+# to wait for each code's create()
+CODE_MAX_ATTEMPTS = 5
+CODE_WRITE_TIMEOUT_SECONDS = 5.0
 
 def initialize_firebase():
-    """Initialize Firebase Admin SDK"""
+    """
+    Initialize Firebase Admin SDK
+    
+    Only loads credentials and builds the Firestore client, which makes no
+    network calls; connectivity is checked separately by the background
+    health monitor in firebase_health.
+    """
     global _db
     
     if _db is not None:
         return _db
     
-    try:
-        # Path to service account key
-        service_account_path = os.path.join(
-            os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 
-            'service-account-key.json'
-        )
-        
-        if not os.path.exists(service_account_path):
-            raise FileNotFoundError(f"Service account key not found at {service_account_path}")
-        
-        # Check if Firebase app is already initialized
-        try:
-            firebase_admin.get_app()
-            logging.info("Firebase app already initialized")
-        except ValueError:
-            # Initialize Firebase Admin SDK
-            cred = credentials.Certificate(service_account_path)
-            firebase_admin.initialize_app(cred)
-            logging.info("Firebase Admin SDK initialized")
-        
-        # Initialize Firestore client with custom timeout settings
-        from google.api_core import retry
-        from google.api_core import exceptions
-        import time
-        
-        # Initialize Firestore with default settings first
-        _db = firestore.client()
+    with _init_lock:
+        if _db is not None:
+            return _db
         
-        # Test the connection with a simple operation and timeout
         try:
-            # Simple test with timeout
-            start_time = time.time()
-            test_collection = _db.collection('connection_test')
+            # Path to service account key
+            service_account_path = os.path.join(
+                os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 
+                'service-account-key.json'
+            )
             
-            # Try a simple document creation and deletion to test connectivity
-            test_doc_ref = test_collection.document('test_connection')
-            test_doc_ref.set({
-                'test': True,
-                'timestamp': firestore.SERVER_TIMESTAMP
-            })
+            if not os.path.exists(service_account_path):
+                raise FileNotFoundError(f"Service account key not found at {service_account_path}")
             
-            # Delete the test document
-            test_doc_ref.delete()
+            # Check if Firebase app is already initialized
+            try:
+                firebase_admin.get_app()
+                logging.info("Firebase app already initialized")
+            except ValueError:
+                # Initialize Firebase Admin SDK
+                cred = credentials.Certificate(service_account_path)
+                firebase_admin.initialize_app(cred)
+                logging.info("Firebase Admin SDK initialized")
             
-            elapsed = time.time() - start_time
-            logging.info(f"Firebase Firestore connection verified in {elapsed:.2f} seconds")
+            _db = firestore.client()
+            
+            logging.info("Firebase Admin SDK initialized successfully")
+            return _db
             
         except Exception as e:
-            elapsed = time.time() - start_time
-            logging.warning(f"Firestore connection test failed after {elapsed:.2f} seconds: {e}")
-            # Continue anyway, maybe it will work for actual operations
-        
-        logging.info("Firebase Admin SDK initialized successfully")
-        return _db
-        
-    except Exception as e:
-        logging.error(f"Failed to initialize Firebase: {e}")
-        raise
+            logging.error(f"Failed to initialize Firebase: {e}")
+            raise
 
 def get_firestore_db():
-    """Get Firestore database instance"""
-    global _db
-    
+    """Get Firestore database instance, initializing it on first use"""
     if _db is None:
-        _db = initialize_firebase()
-    
+        return initialize_firebase()
     return _db
 
 def generate_device_code(user_id, user_email):
@@ -103,53 +102,242 @@ def generate_device_code(user_id, user_email):
         str: Generated 8-character device code (XXXX-XXXX format)
     """
     try:
-        # Generate unique 8-character code in XXXX-XXXX format first
-        chars = string.ascii_uppercase + string.digits
-        code_part1 = ''.join(secrets.choice(chars) for _ in range(4))
-        code_part2 = ''.join(secrets.choice(chars) for _ in range(4))
-        device_code = f"{code_part1}-{code_part2}"
+        return reserve_device_code(user_id, user_email)
         
-        logging.info(f"Generated device code: {device_code} for user: {user_id}")
+    except Exception as e:
+        logging.error(f"Error generating device code: {e}")
+        # Generate a simple fallback code if everything fails
+        fallback_code = new_device_code()
+        logging.warning(f"Returning fallback code: {fallback_code}")
+        return fallback_code
+
+def new_device_code():
+    """Random 8-character code in XXXX-XXXX format"""
+    chars = string.ascii_uppercase + string.digits
+    return ''.join(secrets.choice(chars) for _ in range(4)) + '-' + ''.join(secrets.choice(chars) for _ in range(4))
+
+def reserve_device_code(user_id, user_email, timeout=CODE_WRITE_TIMEOUT_SECONDS):
+    """
+    Generate a code no one else holds, store it and add it to the active-code index
+    
+    The code's document is written with create(), so an existing code is
+    never overwritten; when the generated code is taken, another is drawn.
+    If Firestore does not answer within the timeout (or the breaker is
+    open), the create is queued on the bulk writer and the code is returned
+    anyway; the queued create still refuses to overwrite.
+    
+    Args:
+        user_id (str): Firebase UID of the code owner
+        user_email (str): Email of the code owner
+        timeout (float): Seconds to wait for each Firestore create
+        
+    Returns:
+        str: The reserved code
+        
+    Raises:
+        RuntimeError: If every attempt drew a code that was already taken
+    """
+    for attempt in range(CODE_MAX_ATTEMPTS):
+        device_code = new_device_code()
+        if active_code_index.get(device_code) is not None:
+            continue
         
-        # Try Firebase write-only operations (no reads to avoid timeout)
         try:
-            # Use write-only approach in background thread
-            import threading
-            
-            def firebase_write_operations():
-                try:
-                    success = store_device_code_write_only(device_code, user_id, user_email)
-                    if success:
-                        logging.info(f"[FIREBASE-WRITE] Device code {device_code} stored successfully")
-                    else:
-                        logging.warning(f"[FIREBASE-WRITE] Failed to store {device_code}")
-                except Exception as e:
-                    logging.error(f"[FIREBASE-WRITE] Error storing {device_code}: {e}")
-            
-            # Run Firebase write operations in background
-            firebase_thread = threading.Thread(target=firebase_write_operations)
-            firebase_thread.daemon = True
-            firebase_thread.start()
-            
-            # Wait max 5 seconds for Firebase write (writes are fast)
-            firebase_thread.join(timeout=5.0)
-            
-            if firebase_thread.is_alive():
-                logging.warning(f"[FIREBASE-WRITE] Write operation for {device_code} timed out, but code is still valid")
-            
+            # The deadline is passed to the RPC so it stops when we stop waiting
+            stored = firestore_executor.run(
+                lambda deadline: store_device_code_write_only(device_code, user_id, user_email, timeout=deadline.remaining()),
+                timeout=timeout
+            )
+        except AlreadyExists:
+            logging.warning(f"[FIREBASE-WRITE] Code {device_code} is already taken; drawing another")
+            continue
+        except (FuturesTimeoutError, CircuitOpenError) as e:
+            logging.warning(f"[FIREBASE-WRITE] Storing {device_code} did not finish ({e}); queued instead")
+            stored = False
         except Exception as e:
-            logging.error(f"[FIREBASE-WRITE] Firebase error (code still valid): {e}")
+            logging.error(f"[FIREBASE-WRITE] Firebase error storing {device_code}: {e}; queued instead")
+            stored = False
         
-        # Always return the generated code, regardless of Firebase success/failure
+        if not stored:
+            queue_device_code(device_code, user_id, user_email)
+        logging.info(f"Generated device code: {device_code} for user: {user_id}")
+        active_code_index.add(device_code, user_id, user_email, datetime.now() + timedelta(hours=24))
         return device_code
+    
+    raise RuntimeError(f"No free device code after {CODE_MAX_ATTEMPTS} attempts")
+
+def device_code_doc_id(device_code):
+    """
+    Document id of a code in user_device_codes: the code itself, e.g. 'AB12-CD34'
+    
+    Returns:
+        str: The id, or None if the input cannot be a device code
+    """
+    if not device_code:
+        return None
+    doc_id = device_code.strip().upper()
+    if not doc_id or '/' in doc_id or doc_id.startswith('__'):
+        return None
+    return doc_id
+
+def device_code_ref(db, device_code):
+    """Document reference for a device code, or None if the code is malformed"""
+    doc_id = device_code_doc_id(device_code)
+    if doc_id is None:
+        return None
+    return db.collection('user_device_codes').document(doc_id)
+
+def get_device_code(device_code, timeout=None):
+    """
+    Look up a device code with a single document read
+    
+    Args:
+        device_code (str): Code in XXXX-XXXX format
+        timeout (float): Deadline for the read
+        
+    Returns:
+        dict: The code document, or None if it does not exist
+    """
+    doc_ref = device_code_ref(get_firestore_db(), device_code)
+    if doc_ref is None:
+        return None
+    snapshot = doc_ref.get(timeout=timeout)
+    return snapshot.to_dict() if snapshot.exists else None
+
+class _RedemptionRejected(Exception):
+    """A code that cannot be redeemed; carries the user-facing reason"""
+
+def _code_expired(expires_at):
+    if not expires_at:
+        return False
+    now = datetime.now(timezone.utc) if expires_at.tzinfo else datetime.now()
+    return expires_at < now
+
+@firestore.transactional
+def _redeem_in_transaction(transaction, db, input_code, connecting_user_id, connecting_user_email, deadline):
+    # Read the code inside the transaction so a concurrent redemption of the
+    # same code makes this commit fail and the attempt start again
+    code_ref = device_code_ref(db, input_code)
+    if code_ref is None:
+        raise _RedemptionRejected('Invalid or expired code')
+    
+    code_doc = code_ref.get(transaction=transaction, timeout=deadline.remaining())
+    code_data = code_doc.to_dict() if code_doc.exists else None
+    
+    if not code_data or not code_data.get('isActive'):
+        raise _RedemptionRejected('Invalid or expired code')
+    
+    # Check if code is expired
+    if _code_expired(code_data.get('expiresAt')):
+        transaction.update(code_doc.reference, {'isActive': False})
+        return {'success': False, 'error': 'Code has expired'}
+    
+    # Check usage limit
+    usage_count = code_data.get('usageCount', 0)
+    max_usage = code_data.get('maxUsage', 1)
+    if usage_count >= max_usage:
+        raise _RedemptionRejected('Code has reached maximum usage')
+    
+    # Don't allow self-connection
+    if code_data['userId'] == connecting_user_id:
+        raise _RedemptionRejected('Cannot connect to your own device')
+    
+    device_id = f"device_{secrets.token_hex(8)}"
+    connection_data = {
+        'deviceId': device_id,
+        'deviceCode': input_code,
+        'ownerId': code_data['userId'],
+        'ownerEmail': code_data.get('userEmail', 'Unknown'),
+        'connectedUserId': connecting_user_id,
+        'connectedUserEmail': connecting_user_email,
+        'connectionType': 'MANUAL_CODE',
+        'isActive': True,
+        'status': 'active',
+        'nickname': 'Connected Device',
+        'permissions': {
+            'viewLocation': True,
+            'receiveAlerts': True,
+            'viewBattery': True,
+            'viewDeviceInfo': True
+        },
+        'connectedAt': firestore.SERVER_TIMESTAMP,
+        'lastAccessed': firestore.SERVER_TIMESTAMP
+    }
+    
+    # Connection and code consumption commit together or not at all
+    transaction.create(db.collection('device_connections').document(), connection_data)
+    transaction.update(code_doc.reference, {
+        'usageCount': usage_count + 1,
+        'isActive': usage_count + 1 < max_usage,
+        'lastUsed': firestore.SERVER_TIMESTAMP
+    })
+    
+    return {
+        'success': True,
+        'message': 'Device connected successfully',
+        'deviceId': device_id,
+        'ownerId': code_data['userId'],
+        'ownerEmail': connection_data['ownerEmail']
+    }
+
+def redeem_device_code(input_code, connecting_user_id, connecting_user_email, timeout=REDEEM_TIMEOUT_SECONDS):
+    """
+    Redeem a device code and create the connection in one Firestore transaction
+    
+    The code is read, checked and consumed in the same transaction that adds
+    the device_connections document, so two users redeeming the same code at
+    once cannot both succeed. Contended transactions are retried up to
+    REDEEM_MAX_ATTEMPTS times within the timeout.
+    
+    Args:
+        input_code (str): The 8-character code entered by user
+        connecting_user_id (str): Firebase UID of the connecting user
+        connecting_user_email (str): Email of the connecting user
+        timeout (float): Seconds to wait for the redemption, retries included
         
+    Returns:
+        dict: Result with success, error and timeout; on success also
+        message, deviceId and ownerEmail
+    """
+    code_key = device_code_doc_id(input_code)
+    if code_key is None:
+        return {'success': False, 'error': 'Invalid or expired code', 'timeout': False}
+    
+    # First tier: codes generated or recently read by this process are
+    # indexed locally, so some rejections need no Firestore round trip
+    indexed = active_code_index.get(code_key)
+    if indexed is not None and indexed['userId'] == connecting_user_id:
+        return {'success': False, 'error': 'Cannot connect to your own device', 'timeout': False}
+    
+    def redeem(deadline):
+        db = get_firestore_db()
+        transaction = db.transaction(max_attempts=REDEEM_MAX_ATTEMPTS)
+        return _redeem_in_transaction(transaction, db, input_code, connecting_user_id, connecting_user_email, deadline)
+    
+    try:
+        result = firestore_executor.run(redeem, timeout=timeout)
+    except FuturesTimeoutError:
+        logging.warning(f"[REDEEM] Redemption of {input_code} timed out after {timeout} seconds")
+        return {'success': False, 'error': 'Verification timeout', 'timeout': True}
+    except CircuitOpenError:
+        logging.warning(f"[REDEEM] Firestore circuit open; failing fast for {input_code}")
+        return {'success': False, 'error': 'Firebase temporarily unavailable', 'timeout': False, 'unavailable': True}
+    except _RedemptionRejected as e:
+        logging.info(f"[REDEEM] Code {input_code} rejected: {e}")
+        if str(e) != 'Cannot connect to your own device':
+            active_code_index.discard(code_key)
+        return {'success': False, 'error': str(e), 'timeout': False}
     except Exception as e:
-        logging.error(f"Error generating device code: {e}")
-        # Generate a simple fallback code if everything fails
-        fallback_chars = string.ascii_uppercase + string.digits
-        fallback_code = ''.join(secrets.choice(fallback_chars) for _ in range(4)) + '-' + ''.join(secrets.choice(fallback_chars) for _ in range(4))
-        logging.warning(f"Returning fallback code: {fallback_code}")
-        return fallback_code
+        logging.error(f"[REDEEM] Redemption error for {input_code}: {e}")
+        return {'success': False, 'error': f'Verification failed: {str(e)}', 'timeout': False}
+    
+    result['timeout'] = False
+    active_code_index.discard(code_key)
+    if result['success']:
+        owner_id = result.pop('ownerId')
+        logging.info(f"[REDEEM] Device connection created: {result['deviceId']} for users {owner_id} and {connecting_user_id}")
+        invalidate_user_devices(owner_id, connecting_user_id)
+    return result
 
 def verify_device_code(input_code, connecting_user_id, connecting_user_email):
     """
@@ -163,217 +351,235 @@ def verify_device_code(input_code, connecting_user_id, connecting_user_email):
     Returns:
         dict: Result with success status and message
     """
-    try:
-        db = get_firestore_db()
-        
-        # Find active code
-        codes_query = db.collection('user_device_codes').where('deviceCode', '==', input_code).where('isActive', '==', True).limit(1)
-        codes = codes_query.get()
-        
-        if not codes:
-            return {'success': False, 'error': 'Invalid or expired code'}
-        
-        code_doc = codes[0]
-        code_data = code_doc.to_dict()
-        
-        # Check if code is expired
-        if code_data['expiresAt'] < datetime.now():
-            # Mark as inactive
-            code_doc.reference.update({'isActive': False})
-            return {'success': False, 'error': 'Code has expired'}
-        
-        # Check usage limit
-        if code_data['usageCount'] >= code_data['maxUsage']:
-            return {'success': False, 'error': 'Code has reached maximum usage'}
-        
-        # Don't allow self-connection
-        if code_data['userId'] == connecting_user_id:
-            return {'success': False, 'error': 'Cannot connect to your own device'}
-        
-        # Generate unique device ID
-        device_id = f"device_{secrets.token_hex(8)}"
-        
-        # Create connection in device_connections collection
-        connection_data = {
-            'deviceId': device_id,
-            'deviceCode': input_code,
-            'ownerId': code_data['userId'],
-            'ownerEmail': code_data['userEmail'],
-            'connectedUserId': connecting_user_id,
-            'connectedUserEmail': connecting_user_email,
-            'connectionType': 'MANUAL_CODE',  # Will be updated to QR_CODE if from QR
-            'isActive': True,
-            'nickname': 'Connected Device',
-            'permissions': {
-                'viewLocation': True,
-                'receiveAlerts': True,
-                'viewBattery': True,
-                'viewDeviceInfo': True
-            },
-            'connectedAt': firestore.SERVER_TIMESTAMP,
-            'lastAccessed': firestore.SERVER_TIMESTAMP
-        }
-        
-        # Add connection
-        db.collection('device_connections').add(connection_data)
-        
-        # Update code usage count and mark as inactive (one-time use)
-        code_doc.reference.update({
-            'usageCount': firestore.Increment(1),
-            'isActive': False
-        })
-        
-        logging.info(f"Device connection created: {device_id} for users {code_data['userId']} and {connecting_user_id}")
-        
-        return {
-            'success': True, 
-            'message': 'Device connected successfully',
-            'deviceId': device_id,
-            'ownerEmail': code_data['userEmail']
-        }
-        
-    except Exception as e:
-        logging.error(f"Error verifying device code: {e}")
+    result = redeem_device_code(input_code, connecting_user_id, connecting_user_email)
+    timed_out = result.pop('timeout')
+    if not result['success'] and (timed_out or result['error'].startswith('Verification failed')):
         return {'success': False, 'error': 'Internal server error'}
+    return result
 
-def get_user_devices(user_id):
+def get_user_devices(user_id, timeout=10):
     """
     Get all device connections for a user (both owned and connected)
     
     Args:
         user_id (str): Firebase UID of the user
+        timeout (float): Overall deadline for both lookups
         
     Returns:
-        list: List of device connections
+        list: Device connections, newest first, each with 'id' and 'role'
     """
     try:
         db = get_firestore_db()
+        connections = db.collection('device_connections')
+        deadline = Deadline(timeout)
+        
+        # Owned and connected lookups are independent; run them side by side
+        # under one deadline shared by both RPCs
+        results = fan_out({
+            'owner': lambda: connections.where('ownerId', '==', user_id).where('isActive', '==', True).get(timeout=deadline.remaining()),
+            'connected': lambda: connections.where('connectedUserId', '==', user_id).where('isActive', '==', True).get(timeout=deadline.remaining())
+        }, timeout=deadline.remaining())
+        
+        # A document matching both lookups is listed once, as owned
+        devices = {}
+        for role in ('owner', 'connected'):
+            if not results[role]['success']:
+                continue
+            for doc in results[role]['value']:
+                if doc.id in devices:
+                    continue
+                device_data = doc.to_dict()
+                device_data['id'] = doc.id
+                device_data['role'] = role
+                devices[doc.id] = device_data
+        
+        return sorted(devices.values(), key=_connection_sort_key)
         
-        devices = []
-        
-        # Get devices owned by user
-        owned_devices = db.collection('device_connections').where('ownerId', '==', user_id).where('isActive', '==', True).get()
-        for doc in owned_devices:
-            device_data = doc.to_dict()
-            device_data['id'] = doc.id
-            device_data['role'] = 'owner'
-            devices.append(device_data)
+    except Exception as e:
+        logging.error(f"Error getting user devices: {e}")
+        return []
+
+def _connection_sort_key(device):
+    # Newest connection first; connections without a timestamp last; id breaks ties
+    connected_at = device.get('connectedAt')
+    if not isinstance(connected_at, datetime):
+        return (1, 0.0, device['id'])
+    return (0, -connected_at.timestamp(), device['id'])
+
+def batch_get_documents(doc_paths, field_mask=None):
+    """
+    Fetch many known documents in a single batchGet round trip
+    
+    Args:
+        doc_paths (list): Document paths, e.g. 'device_connections/abc'
+        field_mask (list): Optional field paths to return instead of whole documents
         
-        # Get devices connected to by user
-        connected_devices = db.collection('device_connections').where('connectedUserId', '==', user_id).where('isActive', '==', True).get()
-        for doc in connected_devices:
-            device_data = doc.to_dict()
-            device_data['id'] = doc.id
-            device_data['role'] = 'connected'
-            devices.append(device_data)
+    Returns:
+        dict: Path -> document data, or None when the document does not exist,
+        in the order the paths were given
+    """
+    results = {path: None for path in doc_paths}
+    if not doc_paths:
+        return results
+    
+    try:
+        db = get_firestore_db()
+        refs = [db.document(path) for path in doc_paths]
         
-        return devices
+        for snapshot in db.get_all(refs, field_paths=field_mask):
+            if snapshot.exists:
+                data = snapshot.to_dict()
+                data['id'] = snapshot.id
+                results[snapshot.reference.path] = data
         
     except Exception as e:
-        logging.error(f"Error getting user devices: {e}")
-        return []
+        logging.error(f"Error batch-fetching documents: {e}")
+    
+    return results
 
-def store_device_code_write_only(device_code, user_id, user_email):
+def store_device_code_write_only(device_code, user_id, user_email, timeout=None):
     """
     Store device code using WRITE-ONLY operations (no reads)
     This works around the Firebase read timeout issue
+    
+    Raises:
+        AlreadyExists: If the code is already stored, e.g. for another user
     """
     try:
         db = get_firestore_db()
         
-        # Use write-only operations with timestamp-based document ID
-        expiration_time = datetime.now() + timedelta(hours=24)
-        doc_data = {
-            'deviceCode': device_code,
-            'userId': user_id,
-            'userEmail': user_email,
-            'generatedAt': firestore.SERVER_TIMESTAMP,
-            'expiresAt': expiration_time,
-            'isActive': True,
-            'maxUsage': 1,
-            'usageCount': 0,
-            'qrCodeData': f'unilocator://connect?code={device_code}&user={user_id}&email={user_email}'
-        }
+        # Keyed by the code itself so lookups are a single document get()
+        doc_ref = device_code_ref(db, device_code)
         
-        # Use a predictable document ID based on device code and timestamp
-        doc_id = f"{device_code}_{int(datetime.now().timestamp())}"
-        
-        # Write-only operation - no reading/checking required
-        doc_ref = db.collection('user_device_codes').document(doc_id)
-        doc_ref.set(doc_data)
+        # create() fails instead of overwriting a code someone else holds
+        doc_ref.create(_device_code_document(device_code, user_id, user_email), timeout=timeout)
         
         logging.info(f"[FIREBASE-WRITE-ONLY] Device code {device_code} stored successfully")
         return True
         
+    except AlreadyExists:
+        raise
     except Exception as e:
         logging.error(f"[FIREBASE-WRITE-ONLY] Failed to store {device_code}: {e}")
         return False
+
+def queue_device_code(device_code, user_id, user_email, callback=None):
     """
-    Store device code in Firebase (designed for background execution)
+    Create a device code's document through the bulk writer without waiting for it
+    
+    The write is a create(), so a code that is already stored is left alone
+    and the callback gets the AlreadyExists error.
     
     Args:
-        device_code (str): The generated device code
-        user_id (str): Firebase UID of the user
-        user_email (str): Email of the user
-    """
-    try:
-        import signal
-        import threading
-        
-        def timeout_handler(signum, frame):
-            raise TimeoutError("Firebase operation timed out")
-        
-        def store_with_timeout():
-            try:
-                db = get_firestore_db()
-                
-                logging.info(f"[FIREBASE-ASYNC] Storing code {device_code} for user {user_id}")
-                
-                # Skip deactivating existing codes to avoid timeout issues
-                # (We can implement this later with better timeout handling)
-                
-                # Store new code directly
-                expiration_time = datetime.now() + timedelta(hours=24)
-                doc_data = {
-                    'deviceCode': device_code,
-                    'userId': user_id,
-                    'userEmail': user_email,
-                    'generatedAt': firestore.SERVER_TIMESTAMP,
-                    'expiresAt': expiration_time,
-                    'isActive': True,
-                    'maxUsage': 1,
-                    'usageCount': 0,
-                    'qrCodeData': f'unilocator://connect?code={device_code}&user={user_id}&email={user_email}'
-                }
-                
-                # Simple add operation without complex queries
-                doc_ref = db.collection('user_device_codes').add(doc_data)
-                logging.info(f"[FIREBASE-ASYNC] Successfully stored code {device_code} in Firebase")
-                return True
-                
-            except Exception as e:
-                logging.error(f"[FIREBASE-ASYNC] Failed to store code {device_code}: {e}")
-                return False
+        device_code (str): Code in XXXX-XXXX format
+        user_id (str): Firebase UID of the code owner
+        user_email (str): Email of the code owner
+        callback (callable): Called as callback(success, error) once the
+            write is committed or has finally failed
         
-        # Set a 30-second timeout for Firebase operations
-        result = []
-        
-        def worker():
-            result.append(store_with_timeout())
-        
-        thread = threading.Thread(target=worker, daemon=True)
-        thread.start()
-        thread.join(timeout=30)  # 30 second timeout
+    Returns:
+        bool: False if the write could not be queued
+    """
+    doc_id = device_code_doc_id(device_code)
+    if doc_id is None:
+        return False
+    return bulk_writer.create(f'user_device_codes/{doc_id}', _device_code_document(device_code, user_id, user_email), callback=callback)
+
+def mirror_device_location(device_code, latitude, longitude, callback=None):
+    """
+    Mirror a device's latest location into device_locations/{device_code}
+    
+    Repeated updates for the same device between flushes are coalesced
+    into a single write.
+    
+    Returns:
+        bool: False if the write could not be queued
+    """
+    if not device_code or '/' in device_code:
+        return False
+    return bulk_writer.set(f'device_locations/{device_code}', {
+        'deviceCode': device_code,
+        'latitude': latitude,
+        'longitude': longitude,
+        'updatedAt': firestore.SERVER_TIMESTAMP
+    }, merge=True, callback=callback)
+
+def _device_code_document(device_code, user_id, user_email):
+    return {
+        'deviceCode': device_code,
+        'userId': user_id,
+        'userEmail': user_email,
+        'generatedAt': firestore.SERVER_TIMESTAMP,
+        'expiresAt': datetime.now() + timedelta(hours=24),
+        'isActive': True,
+        'maxUsage': 1,
+        'usageCount': 0,
+        'qrCodeData': f'unilocator://connect?code={device_code}&user={user_id}&email={user_email}'
+    }
+
+def backfill_device_code_ids(dry_run=False, batch_size=400):
+    """
+    Move user_device_codes documents stored under legacy ids to the code itself
+    
+    Older code paths wrote codes under '{code}_{timestamp}' or random add()
+    ids. Each code is rewritten to its deterministic id and the legacy
+    documents are deleted. When several documents hold the same code, the
+    active one (then the most recently generated) wins.
+    
+    Args:
+        dry_run (bool): Only count what would change
+        batch_size (int): Writes per commit (Firestore allows up to 500)
         
-        if thread.is_alive():
-            logging.warning(f"[FIREBASE-ASYNC] Storage operation for code {device_code} timed out after 30 seconds")
-        elif result and result[0]:
-            logging.info(f"[FIREBASE-ASYNC] Code {device_code} stored successfully")
+    Returns:
+        dict: Counts of scanned, migrated, deleted and skipped documents
+    """
+    db = get_firestore_db()
+    collection = db.collection('user_device_codes')
+    stats = {'scanned': 0, 'migrated': 0, 'deleted': 0, 'skipped': 0}
+    
+    # Group every legacy document under the id it should have
+    legacy = {}
+    canonical = {}
+    for doc in collection.stream():
+        stats['scanned'] += 1
+        doc_id = device_code_doc_id((doc.to_dict() or {}).get('deviceCode'))
+        if doc_id is None:
+            stats['skipped'] += 1
+        elif doc.id == doc_id:
+            canonical[doc_id] = doc
         else:
-            logging.error(f"[FIREBASE-ASYNC] Failed to store code {device_code}")
-            
-    except Exception as e:
-        logging.error(f"[FIREBASE-ASYNC] Error in async storage for code {device_code}: {e}")
+            legacy.setdefault(doc_id, []).append(doc)
+    
+    def rank(doc):
+        data = doc.to_dict()
+        generated_at = data.get('generatedAt')
+        return (bool(data.get('isActive')), generated_at.timestamp() if generated_at else 0)
+    
+    batch = db.batch()
+    pending = 0
+    for doc_id, docs in legacy.items():
+        winner = max(docs + ([canonical[doc_id]] if doc_id in canonical else []), key=rank)
+        if winner.id != doc_id:
+            stats['migrated'] += 1
+            if not dry_run:
+                batch.set(collection.document(doc_id), winner.to_dict())
+                pending += 1
+        for doc in docs:
+            stats['deleted'] += 1
+            if not dry_run:
+                batch.delete(doc.reference)
+                pending += 1
+        
+        if pending >= batch_size:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    
+    if pending:
+        batch.commit()
+    
+    logging.info(f"[BACKFILL-CODES] {'Dry run: ' if dry_run else ''}{stats}")
+    return stats
 
 def test_firebase_connection():
     """Test Firebase connectivity with detailed diagnostics"""
@@ -428,39 +634,20 @@ def test_firebase_connection():
             logging.error(f"[FIREBASE-TEST] ❌ Write operation failed: {e}")
             return test_results
         
-        # Test 3: Read operation with timeout using threading
+        # Test 3: Read operation with timeout on the shared executor
         logging.info("[FIREBASE-TEST] Step 3: Testing read operation...")
         try:
-            import threading
-            
-            read_result = {'success': False, 'data': None, 'error': None}
-            
-            def read_operation():
-                try:
-                    doc_data = doc_ref[1].get().to_dict()
-                    read_result['success'] = True
-                    read_result['data'] = doc_data
-                except Exception as e:
-                    read_result['error'] = str(e)
-            
-            # Start read operation in background thread
-            read_thread = threading.Thread(target=read_operation)
-            read_thread.daemon = True
-            read_thread.start()
-            
             # Wait maximum 10 seconds for read operation
-            read_thread.join(timeout=10.0)
-            
-            if read_thread.is_alive():
-                test_results['errors'].append("Read operation timed out after 10 seconds")
-                logging.error("[FIREBASE-TEST] ❌ Read operation timed out after 10 seconds")
-            elif read_result['success']:
-                test_results['read_success'] = True
-                logging.info(f"[FIREBASE-TEST] ✅ Read operation successful: {read_result['data'].get('message', 'N/A')}")
-            elif read_result['error']:
-                test_results['errors'].append(f"Read failed: {read_result['error']}")
-                logging.error(f"[FIREBASE-TEST] ❌ Read operation failed: {read_result['error']}")
+            doc_data = firestore_executor.run(
+                lambda deadline: doc_ref[1].get(timeout=deadline.remaining()).to_dict(),
+                timeout=10.0
+            )
+            test_results['read_success'] = True
+            logging.info(f"[FIREBASE-TEST] ✅ Read operation successful: {doc_data.get('message', 'N/A')}")
                 
+        except FuturesTimeoutError:
+            test_results['errors'].append("Read operation timed out after 10 seconds")
+            logging.error("[FIREBASE-TEST] ❌ Read operation timed out after 10 seconds")
         except exceptions.DeadlineExceeded:
             test_results['errors'].append("Read operation timed out (DeadlineExceeded)")
             logging.error("[FIREBASE-TEST] ❌ Read operation timed out (DeadlineExceeded)")
@@ -471,33 +658,17 @@ def test_firebase_connection():
         # Test 4: Delete operation with timeout
         logging.info("[FIREBASE-TEST] Step 4: Testing delete operation...")
         try:
-            delete_result = {'success': False, 'error': None}
-            
-            def delete_operation():
-                try:
-                    doc_ref[1].delete()
-                    delete_result['success'] = True
-                except Exception as e:
-                    delete_result['error'] = str(e)
-            
-            # Start delete operation in background thread
-            delete_thread = threading.Thread(target=delete_operation)
-            delete_thread.daemon = True
-            delete_thread.start()
-            
             # Wait maximum 10 seconds for delete operation
-            delete_thread.join(timeout=10.0)
-            
-            if delete_thread.is_alive():
-                test_results['errors'].append("Delete operation timed out after 10 seconds")
-                logging.error("[FIREBASE-TEST] ❌ Delete operation timed out after 10 seconds")
-            elif delete_result['success']:
-                test_results['delete_success'] = True
-                logging.info("[FIREBASE-TEST] ✅ Delete operation successful")
-            elif delete_result['error']:
-                test_results['errors'].append(f"Delete failed: {delete_result['error']}")
-                logging.error(f"[FIREBASE-TEST] ❌ Delete operation failed: {delete_result['error']}")
+            firestore_executor.run(
+                lambda deadline: doc_ref[1].delete(timeout=deadline.remaining()),
+                timeout=10.0
+            )
+            test_results['delete_success'] = True
+            logging.info("[FIREBASE-TEST] ✅ Delete operation successful")
                 
+        except FuturesTimeoutError:
+            test_results['errors'].append("Delete operation timed out after 10 seconds")
+            logging.error("[FIREBASE-TEST] ❌ Delete operation timed out after 10 seconds")
         except exceptions.DeadlineExceeded:
             test_results['errors'].append("Delete operation timed out (DeadlineExceeded)")
             logging.error("[FIREBASE-TEST] ❌ Delete operation timed out (DeadlineExceeded)")
@@ -520,7 +691,6 @@ def test_firebase_connection():
 def verify_device_code_mobile_safe(input_code, connecting_user_id, connecting_user_email):
     """
     Mobile-safe device code verification with timeout handling
-    Uses background threads to prevent hanging and provides fallback responses
     
     Args:
         input_code (str): The 8-character code entered by user
@@ -530,249 +700,23 @@ def verify_device_code_mobile_safe(input_code, connecting_user_id, connecting_us
     Returns:
         dict: Result with success status and message
     """
-    import threading
-    import time
-    
-    verification_result = {
-        'success': False, 
-        'error': 'Verification timeout',
-        'timeout': True
-    }
-    
-    def verify_operation():
-        try:
-            db = get_firestore_db()
-            
-            # Find active code with timeout protection
-            codes_query = db.collection('user_device_codes').where('deviceCode', '==', input_code).where('isActive', '==', True).limit(1)
-            codes = codes_query.get()
-            
-            if not codes:
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Invalid or expired code',
-                    'timeout': False
-                })
-                return
-            
-            code_doc = codes[0]
-            code_data = code_doc.to_dict()
-            
-            # Check if code is expired
-            if code_data['expiresAt'] < datetime.now():
-                code_doc.reference.update({'isActive': False})
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Code has expired',
-                    'timeout': False
-                })
-                return
-            
-            # Check usage limit
-            if code_data['usageCount'] >= code_data['maxUsage']:
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Code has reached maximum usage',
-                    'timeout': False
-                })
-                return
-            
-            # Don't allow self-connection
-            if code_data['userId'] == connecting_user_id:
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Cannot connect to your own device',
-                    'timeout': False
-                })
-                return
-            
-            # Generate unique device ID
-            device_id = f"device_{secrets.token_hex(8)}"
-            
-            # Create connection in device_connections collection
-            connection_data = {
-                'deviceId': device_id,
-                'deviceCode': input_code,
-                'ownerId': code_data['userId'],
-                'ownerEmail': code_data['userEmail'],
-                'connectedUserId': connecting_user_id,
-                'connectedUserEmail': connecting_user_email,
-                'connectedAt': firestore.SERVER_TIMESTAMP,
-                'status': 'active'
-            }
-            
-            # Store connection
-            db.collection('device_connections').add(connection_data)
-            
-            # Update code usage
-            code_doc.reference.update({
-                'usageCount': code_data['usageCount'] + 1,
-                'lastUsed': firestore.SERVER_TIMESTAMP
-            })
-            
-            verification_result.update({
-                'success': True,
-                'message': 'Device connected successfully',
-                'deviceId': device_id,
-                'ownerEmail': code_data['userEmail'],
-                'timeout': False
-            })
-            
-        except Exception as e:
-            logging.error(f"[MOBILE-VERIFY] Verification error: {e}")
-            verification_result.update({
-                'success': False,
-                'error': f'Verification failed: {str(e)}',
-                'timeout': False
-            })
-    
-    # Run verification in background thread with timeout
-    verify_thread = threading.Thread(target=verify_operation)
-    verify_thread.daemon = True
-    verify_thread.start()
-    
-    # Wait maximum 15 seconds for verification
-    verify_thread.join(timeout=15.0)
-    
-    if verify_thread.is_alive():
-        logging.warning(f"[MOBILE-VERIFY] Verification for {input_code} timed out after 15 seconds")
-        return {
-            'success': False,
-            'error': 'Verification timeout - please try again',
-            'timeout': True,
-            'retry_suggested': True
-        }
-    
-    return verification_result
+    result = redeem_device_code(input_code, connecting_user_id, connecting_user_email)
+    if result['timeout']:
+        result.update({'error': 'Verification timeout - please try again', 'retry_suggested': True})
+    elif result.get('unavailable'):
+        result['retry_suggested'] = True
+    return result
 
 def verify_device_code_safe(input_code, connecting_user_id, connecting_user_email):
     """
     Timeout-safe device code verification for Android app
-    Uses background threads to prevent hanging on Firebase reads
     """
-    import threading
-    import time
-    
-    verification_result = {
-        'success': False, 
-        'error': 'Verification timeout',
-        'timeout': True
-    }
-    
-    def verify_operation():
-        try:
-            db = get_firestore_db()
-            
-            logging.info(f"[VERIFY-SAFE] Searching for code: {input_code}")
-            
-            # Find active code with simpler query
-            codes_query = db.collection('user_device_codes').where('deviceCode', '==', input_code).where('isActive', '==', True).limit(1)
-            codes = codes_query.get()
-            
-            if not codes:
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Invalid or expired code',
-                    'timeout': False
-                })
-                return
-            
-            code_doc = codes[0]
-            code_data = code_doc.to_dict()
-            
-            logging.info(f"[VERIFY-SAFE] Found code: {input_code}, owner: {code_data.get('userId')}")
-            
-            # Check if code is expired
-            if code_data.get('expiresAt') and code_data['expiresAt'] < datetime.now():
-                # Mark as inactive
-                code_doc.reference.update({'isActive': False})
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Code has expired',
-                    'timeout': False
-                })
-                return
-            
-            # Check usage limit
-            usage_count = code_data.get('usageCount', 0)
-            max_usage = code_data.get('maxUsage', 1)
-            if usage_count >= max_usage:
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Code has reached maximum usage',
-                    'timeout': False
-                })
-                return
-            
-            # Don't allow self-connection
-            if code_data['userId'] == connecting_user_id:
-                verification_result.update({
-                    'success': False, 
-                    'error': 'Cannot connect to your own device',
-                    'timeout': False
-                })
-                return
-            
-            # Generate unique device ID
-            device_id = f"device_{secrets.token_hex(8)}"
-            
-            # Create connection in device_connections collection
-            connection_data = {
-                'deviceId': device_id,
-                'deviceCode': input_code,
-                'ownerId': code_data['userId'],
-                'ownerEmail': code_data['userEmail'],
-                'connectedUserId': connecting_user_id,
-                'connectedUserEmail': connecting_user_email,
-                'connectedAt': firestore.SERVER_TIMESTAMP,
-                'status': 'active'
-            }
-            
-            # Store connection
-            db.collection('device_connections').add(connection_data)
-            
-            # Update code usage
-            code_doc.reference.update({
-                'usageCount': usage_count + 1,
-                'lastUsed': firestore.SERVER_TIMESTAMP
-            })
-            
-            logging.info(f"[VERIFY-SAFE] Successfully connected device for code: {input_code}")
-            
-            verification_result.update({
-                'success': True,
-                'message': 'Device connected successfully',
-                'deviceId': device_id,
-                'ownerEmail': code_data['userEmail'],
-                'timeout': False
-            })
-            
-        except Exception as e:
-            logging.error(f"[VERIFY-SAFE] Verification error: {e}")
-            verification_result.update({
-                'success': False,
-                'error': f'Verification failed: {str(e)}',
-                'timeout': False
-            })
-    
-    # Run verification in background thread with timeout
-    verify_thread = threading.Thread(target=verify_operation)
-    verify_thread.daemon = True
-    verify_thread.start()
-    
-    # Wait maximum 15 seconds for verification
-    verify_thread.join(timeout=15.0)
-    
-    if verify_thread.is_alive():
-        logging.warning(f"[VERIFY-SAFE] Verification for {input_code} timed out after 15 seconds")
-        return {
-            'success': False,
-            'error': 'Verification timeout - Firebase read taking too long',
-            'timeout': True,
-            'retry_suggested': True
-        }
-    
-    return verification_result
+    result = redeem_device_code(input_code, connecting_user_id, connecting_user_email)
+    if result['timeout']:
+        result.update({'error': 'Verification timeout - Firebase read taking too long', 'retry_suggested': True})
+    elif result.get('unavailable'):
+        result['retry_suggested'] = True
+    return result
 
 def query_firebase_with_timeout(collection, field, value, timeout_seconds=10):
     """
@@ -781,35 +725,25 @@ def query_firebase_with_timeout(collection, field, value, timeout_seconds=10):
     """
     try:
         db = get_firestore_db()
-        result = {'data': None, 'error': None, 'completed': False}
         
-        def query_worker():
-            try:
-                logging.info(f"[FIREBASE-TIMEOUT] Starting query: {collection}.{field} == {value}")
-                query = db.collection(collection).where(field, '==', value)
-                docs = query.stream()
-                doc_list = list(docs)
-                result['data'] = doc_list
-                result['completed'] = True
-                logging.info(f"[FIREBASE-TIMEOUT] Query completed, found {len(doc_list)} documents")
-            except Exception as e:
-                logging.error(f"[FIREBASE-TIMEOUT] Query error: {e}")
-                result['error'] = str(e)
-                result['completed'] = True
+        def query_worker(deadline):
+            logging.info(f"[FIREBASE-TIMEOUT] Starting query: {collection}.{field} == {value}")
+            query = db.collection(collection).where(field, '==', value)
+            doc_list = list(query.stream(timeout=deadline.remaining()))
+            logging.info(f"[FIREBASE-TIMEOUT] Query completed, found {len(doc_list)} documents")
+            return doc_list
         
-        # Run query in separate thread with timeout
-        thread = threading.Thread(target=query_worker, daemon=True)
-        thread.start()
-        thread.join(timeout=timeout_seconds)
-        
-        if not result['completed']:
+        # Run query on the shared executor; the deadline also bounds the RPC
+        try:
+            docs = firestore_executor.run(query_worker, timeout=timeout_seconds)
+        except FuturesTimeoutError:
             logging.error(f"[FIREBASE-TIMEOUT] Query timed out after {timeout_seconds}s")
             return False, None, f"Firebase query timed out after {timeout_seconds} seconds"
+        except Exception as e:
+            logging.error(f"[FIREBASE-TIMEOUT] Query error: {e}")
+            return False, None, str(e)
         
-        if result['error']:
-            return False, None, result['error']
-        
-        return True, result['data'], None
+        return True, docs, None
         
     except Exception as e:
         logging.error(f"[FIREBASE-TIMEOUT] Timeout wrapper error: {e}")
@@ -820,82 +754,33 @@ def verify_device_code_with_timeout(device_code, user_id, user_email, timeout_se
     Verify device code with timeout protection
     Returns: (success, result_data, error_message)
     """
-    try:
-        logging.info(f"[VERIFY-TIMEOUT] Starting verification for code: {device_code}")
-        
-        # First query: find active device codes
-        success, docs, error = query_firebase_with_timeout(
-            'user_device_codes', 'deviceCode', device_code, timeout_seconds
-        )
-        
-        if not success:
-            return False, None, error or "Failed to query device codes"
-        
-        if not docs:
-            return False, None, "Invalid or expired device code"
-        
-        # Check if active
-        active_docs = [doc for doc in docs if doc.to_dict().get('isActive') == True]
-        if not active_docs:
-            return False, None, "Device code is not active"
-        
-        device_doc = active_docs[0]
-        device_data = device_doc.to_dict()
-        
-        owner_id = device_data.get('userId')
-        owner_email = device_data.get('userEmail', 'Unknown')
-        
-        # Prevent self-connection
-        if owner_id == user_id:
-            return False, None, "Cannot connect to your own device"
-        
-        # Create connection in Firebase (with timeout protection)
-        device_id = f"device_{secrets.token_hex(8)}"
-        
-        def create_connection():
-            try:
-                db = get_firestore_db()
-                connection_data = {
-                    'deviceId': device_id,
-                    'deviceCode': device_code,
-                    'ownerId': owner_id,
-                    'ownerEmail': owner_email,
-                    'connectedUserId': user_id,
-                    'connectedUserEmail': user_email,
-                    'connectedAt': firestore.SERVER_TIMESTAMP,
-                    'status': 'active'
-                }
-                db.collection('device_connections').add(connection_data)
-                return True
-            except Exception as e:
-                logging.error(f"[VERIFY-TIMEOUT] Failed to create connection: {e}")
-                return False
-        
-        # Create connection in background (non-blocking)
-        connection_thread = threading.Thread(target=create_connection, daemon=True)
-        connection_thread.start()
-        
-        return True, {
-            'deviceId': device_id,
-            'ownerEmail': owner_email,
-            'message': 'Device connected successfully'
-        }, None
-        
-    except Exception as e:
-        logging.error(f"[VERIFY-TIMEOUT] Verification error: {e}")
-        return False, None, str(e)
+    logging.info(f"[VERIFY-TIMEOUT] Starting verification for code: {device_code}")
+    
+    result = redeem_device_code(device_code, user_id, user_email, timeout=timeout_seconds)
+    if not result['success']:
+        return False, None, result['error']
+    
+    return True, {
+        'deviceId': result['deviceId'],
+        'ownerEmail': result['ownerEmail'],
+        'message': result['message']
+    }, None
 
 def fetch_user_devices_debug(user_id):
     """
     Fetch all devices for a specific user from Firebase user_devices collection
-    with detailed debug information
+    with a full trace of every phase
     
     Args:
         user_id (str): Firebase UID of the user
         
     Returns:
-        dict: Detailed response with devices data and debug info
+        dict: Detailed response with devices data, the structured trace and
+        its rendered lines under 'steps'
     """
+    from google.cloud.firestore_v1.base_query import FieldFilter
+    
+    trace = Trace('admin_fetch_user_devices')
     debug_info = {
         'timestamp': datetime.now().isoformat(),
         'user_id': user_id,
@@ -910,94 +795,54 @@ def fetch_user_devices_debug(user_id):
     }
     
     try:
-        debug_info['steps'].append(f"[1] Starting device fetch for user: {user_id}")
-        
-        # Get Firestore database
-        db = get_firestore_db()
-        debug_info['steps'].append("[2] ✅ Firestore database connection established")
+        with trace.span('connect'):
+            db = get_firestore_db()
         debug_info['firestore_connection'] = True
         
-        # Reference to user_devices collection
         user_devices_ref = db.collection('user_devices')
-        debug_info['steps'].append("[3] ✅ Referenced user_devices collection")
-        
-        # First, let's try to get a simple document count to test the collection
-        try:
-            debug_info['steps'].append("[3.1] Testing collection access...")
-            # Get first document to test collection access
-            test_docs = user_devices_ref.limit(1).stream()
-            test_count = sum(1 for _ in test_docs)
-            debug_info['steps'].append(f"[3.1] ✅ Collection accessible, test returned {test_count} documents")
-        except Exception as test_error:
-            debug_info['steps'].append(f"[3.1] ❌ Collection access test failed: {test_error}")
-            debug_info['collection_exists'] = False
-        
-        # Query devices for this specific user - using updated syntax
-        debug_info['steps'].append(f"[4] Querying devices where userId == '{user_id}'")
-        
-        # Get all documents in user_devices collection that match the user (new syntax)
-        from google.cloud.firestore_v1.base_query import FieldFilter
-        import time
         
-        start_query_time = time.time()
-        query = user_devices_ref.where(filter=FieldFilter("userId", "==", user_id))
+        # Probe collection access with a single document before the real query
+        with trace.span('probe') as span:
+            try:
+                span.set(documents=sum(1 for _ in user_devices_ref.limit(1).stream(timeout=10)))
+            except Exception as probe_error:
+                span.set(error=str(probe_error))
         
-        debug_info['steps'].append("[4.1] Executing Firestore query...")
-        docs = query.stream()
+        with trace.span('query', user_id=user_id) as span:
+            query = user_devices_ref.where(filter=FieldFilter("userId", "==", user_id))
+            docs = list(query.stream(timeout=10))
+            span.set(documents=len(docs))
         
         devices_list = []
-        doc_count = 0
-        
-        # Process documents with timeout
-        query_timeout = 10  # 10 seconds timeout
-        
-        for doc in docs:
-            current_time = time.time()
-            if current_time - start_query_time > query_timeout:
-                debug_info['steps'].append(f"[4.ERROR] Query timeout after {query_timeout} seconds")
-                break
+        with trace.span('decode', documents=len(docs)):
+            for doc in docs:
+                device_data = doc.to_dict()
+                device_data['firebase_doc_id'] = doc.id
+                devices_list.append(device_data)
                 
-            doc_count += 1
-            device_data = doc.to_dict()
-            device_id = doc.id
-            
-            debug_info['steps'].append(f"[4.{doc_count}] Found device document: {device_id}")
-            
-            # Add document ID to device data
-            device_data['firebase_doc_id'] = device_id
-            devices_list.append(device_data)
-            
-            # Log device details
-            device_info = device_data.get('deviceInfo', {})
-            device_name = device_info.get('deviceName', 'Unknown')
-            device_model = device_info.get('deviceModel', 'Unknown')
-            is_active = device_data.get('isActive', False)
-            last_seen = device_data.get('lastSeenAt', 'Never')
-            
-            debug_info['steps'].append(f"    📱 Device: {device_name} ({device_model})")
-            debug_info['steps'].append(f"    🔋 Active: {is_active}, Last Seen: {last_seen}")
-        
-        query_elapsed = time.time() - start_query_time
-        debug_info['steps'].append(f"[4.COMPLETE] Query completed in {query_elapsed:.2f} seconds")
-        
-        debug_info['document_count'] = doc_count
+                device_info = device_data.get('deviceInfo', {})
+                trace.event(
+                    "Found device",
+                    id=doc.id,
+                    name=device_info.get('deviceName', 'Unknown'),
+                    model=device_info.get('deviceModel', 'Unknown'),
+                    active=device_data.get('isActive', False),
+                    last_seen=device_data.get('lastSeenAt', 'Never')
+                )
+        
+        debug_info['document_count'] = len(devices_list)
         debug_info['devices'] = devices_list
         debug_info['collection_exists'] = True
-        
-        if doc_count == 0:
-            debug_info['steps'].append("[5] ⚠️ No devices found for this user")
-        else:
-            debug_info['steps'].append(f"[5] ✅ Successfully fetched {doc_count} device(s)")
-        
         debug_info['success'] = True
         
     except Exception as e:
         error_msg = str(e)
         debug_info['error'] = error_msg
-        debug_info['steps'].append(f"[ERROR] ❌ Failed to fetch devices: {error_msg}")
+        trace.event("Failed to fetch devices", error=error_msg)
         logging.error(f"Firebase device fetch error: {error_msg}")
     
-    debug_info['steps'].append(f"[FINAL] Operation completed at {datetime.now().strftime('%H:%M:%S')}")
+    debug_info['trace'] = trace.to_dict()
+    debug_info['steps'] = trace.render()
     
     return debug_info
 
@@ -1011,12 +856,27 @@ def fetch_user_devices(user_id):
     Returns:
         list: List of device dictionaries
     """
+    mirrored = get_mirrored_devices(user_id)
+    if mirrored is not None:
+        return mirrored
+    
+    cached = device_list_cache.get(user_id, 'admin')
+    if cached is not None:
+        return cached
+    
+    # Firestore is failing: an expired list beats an empty one
+    if firestore_breaker.state == CircuitBreaker.OPEN:
+        stale = device_list_cache.get(user_id, 'admin', allow_stale=True)
+        if stale is not None:
+            return stale
+    
     try:
+        generation = device_list_cache.generation(user_id)
         db = get_firestore_db()
         user_devices_ref = db.collection('user_devices')
         from google.cloud.firestore_v1.base_query import FieldFilter
         query = user_devices_ref.where(filter=FieldFilter("userId", "==", user_id))
-        docs = query.stream()
+        docs = firestore_breaker.call(lambda: list(query.stream(timeout=10)))
         
         devices = []
         for doc in docs:
@@ -1024,6 +884,7 @@ def fetch_user_devices(user_id):
             device_data['firebase_doc_id'] = doc.id
             devices.append(device_data)
         
+        device_list_cache.set(user_id, 'admin', devices, generation)
         return devices
         
     except Exception as e:
@@ -0,0 +1,183 @@
+"""
+Shared bounded executor for Firestore work in UniLocator
+Replaces ad-hoc threads with one pool, per-call deadlines and gauges
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from .circuit_breaker import firestore_breaker
+
+# Worker threads doing Firestore calls, and how many more calls may wait for one
+MAX_WORKERS = int(os.environ.get('FIRESTORE_EXECUTOR_WORKERS', 8))
+MAX_QUEUE = int(os.environ.get('FIRESTORE_EXECUTOR_QUEUE', 64))
+
+
+class ExecutorSaturatedError(RuntimeError):
+    """Raised when the executor's queue is full and new work is rejected"""
+
+
+class Deadline:
+    """Absolute deadline for one unit of work, shared with the gRPC calls it makes"""
+
+    __slots__ = ('expires_at',)
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        """Seconds left, suitable for a gRPC ``timeout=`` argument"""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires_at
+
+
+class FirestoreExecutor:
+    """
+    Bounded thread pool for blocking Firestore calls
+
+    Work is submitted as ``fn(deadline)``; the function should pass
+    ``deadline.remaining()`` as the ``timeout`` of each Firestore call so a
+    call that outlives its caller stops on its own instead of holding a worker.
+    Work still queued when its deadline passes is cancelled without running.
+    With a circuit breaker, work is refused while the breaker is open and each
+    outcome is recorded on it; submit only Firestore calls here, or pass
+    guarded=False for calls that go through the breaker on their own.
+    """
+
+    def __init__(self, max_workers=MAX_WORKERS, max_queue=MAX_QUEUE, breaker=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.breaker = breaker
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='firestore')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'timed_out': 0, 'cancelled': 0}
+
+    def submit(self, fn, timeout, guarded=True):
+        """
+        Schedule fn(deadline) and return its Future without waiting
+
+        Args:
+            fn (callable): Work taking a Deadline
+            timeout (float): Seconds until the deadline
+            guarded (bool): Check and record the circuit breaker for this work
+
+        Raises:
+            ExecutorSaturatedError: If the workers and queue are all in use
+            CircuitOpenError: If the circuit breaker is open
+        """
+        if not self._slots.acquire(blocking=False):
+            self._count('rejected')
+            raise ExecutorSaturatedError("Firestore executor is saturated")
+        
+        breaker = self.breaker if guarded else None
+        trial = False
+        if breaker is not None:
+            try:
+                trial = breaker.before_call()
+            except Exception:
+                self._slots.release()
+                raise
+
+        deadline = Deadline(timeout)
+        with self._lock:
+            self._queued += 1
+            self._stats['submitted'] += 1
+
+        def run():
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+            try:
+                if deadline.expired:
+                    self._count('cancelled')
+                    error = FuturesTimeoutError("Deadline expired before the work started")
+                    self._record(breaker, error, trial)
+                    raise error
+                try:
+                    result = fn(deadline)
+                except BaseException as e:
+                    # BaseExceptions are recorded too, so a trial slot is never leaked
+                    if isinstance(e, Exception):
+                        self._count('failed')
+                    self._record(breaker, e, trial)
+                    raise
+                self._count('completed')
+                self._record(breaker, None, trial)
+                return result
+            finally:
+                with self._lock:
+                    self._active -= 1
+                self._slots.release()
+
+        try:
+            future = self._executor.submit(run)
+        except BaseException as e:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            self._record(breaker, e, trial)
+            raise
+        future.deadline = deadline
+        future.breaker = breaker
+        future.trial = trial
+        return future
+
+    def run(self, fn, timeout):
+        """
+        Run fn(deadline) on the pool and wait for its result until the deadline
+
+        Raises:
+            concurrent.futures.TimeoutError: If the work does not finish in time; queued work is cancelled
+            ExecutorSaturatedError: If the workers and queue are all in use
+        """
+        future = self.submit(fn, timeout)
+        try:
+            return future.result(timeout=future.deadline.remaining())
+        except FuturesTimeoutError:
+            self.cancel(future)
+            self._count('timed_out')
+            logging.warning(f"[FIRESTORE-EXECUTOR] Work timed out after {timeout}s")
+            raise
+
+    def cancel(self, future):
+        """Cancel work that has not started yet; returns True if it was cancelled"""
+        if not future.cancel():
+            return False
+        # Never started, so its wrapper will not release the slot
+        with self._lock:
+            self._queued -= 1
+        self._slots.release()
+        self._count('cancelled')
+        # Work that waited past its deadline in the queue is a sign of a slow backend
+        self._record(future.breaker, FuturesTimeoutError("Cancelled before it started"), future.trial)
+        return True
+
+    def stats(self):
+        """Queue depth, active workers and lifetime counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queue_depth'] = self._queued
+            stats['active_workers'] = self._active
+        stats['max_workers'] = self.max_workers
+        stats['max_queue'] = self.max_queue
+        return stats
+
+    def _record(self, breaker, error, trial):
+        if breaker is not None:
+            breaker.record(error, trial)
+
+    def _count(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+
+# Global instance used for all Firestore work in the process
+firestore_executor = FirestoreExecutor(breaker=firestore_breaker)
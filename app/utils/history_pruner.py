@@ -0,0 +1,114 @@
+"""
+Background retention for telemetry history in UniLocator
+Deletes telemetry_history rows older than the retention window in batches
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from .database import db_connection
+from .telemetry import prune_history
+
+# Days of history kept; 0 (the default) keeps everything and disables the pruner
+RETENTION_DAYS = int(os.environ.get('TELEMETRY_HISTORY_RETENTION_DAYS', 0))
+
+# Seconds between prune runs
+PRUNE_INTERVAL_SECONDS = float(os.environ.get('TELEMETRY_HISTORY_PRUNE_INTERVAL_SECONDS', 3600))
+
+# Rows deleted per transaction; writers get the lock back between batches
+PRUNE_BATCH_SIZE = int(os.environ.get('TELEMETRY_HISTORY_PRUNE_BATCH_SIZE', 5000))
+
+_state_lock = threading.Lock()
+_state = {
+    'runs': 0,
+    'total_deleted': 0,
+    'last_run_at': None,
+    'last_deleted': 0,
+    'last_cutoff_day': None,
+    'last_duration_ms': None,
+    'last_error': None,
+    'retention_days': RETENTION_DAYS
+}
+_pruner_thread = None
+
+
+def prune_expired_history(retention_days=None, batch_size=None, db_path=None):
+    """
+    Run one retention pass over telemetry_history
+
+    Args:
+        retention_days (int): Days to keep (default RETENTION_DAYS); 0 keeps everything
+        batch_size (int): Rows deleted per transaction
+        db_path (str): SQLite file; defaults to the configured database
+
+    Returns:
+        dict: Rows deleted, the cutoff day (None when nothing expires),
+        duration and any error
+    """
+    retention_days = RETENTION_DAYS if retention_days is None else retention_days
+    if retention_days <= 0:
+        return {'deleted': 0, 'cutoff_day': None, 'duration_ms': 0.0, 'error': None}
+
+    batch_size = batch_size or PRUNE_BATCH_SIZE
+    cutoff_day = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+
+    deleted = 0
+    error = None
+    start = time.perf_counter()
+
+    try:
+        while True:
+            with db_connection(db_path) as conn:
+                batch = prune_history(conn, cutoff_day, limit=batch_size)
+            deleted += batch
+            if batch < batch_size:
+                break
+    except Exception as e:
+        error = str(e)
+        logging.error(f"[HISTORY-PRUNE] Prune failed after {deleted} rows: {e}")
+
+    duration_ms = round((time.perf_counter() - start) * 1000, 2)
+    result = {'deleted': deleted, 'cutoff_day': cutoff_day, 'duration_ms': duration_ms, 'error': error}
+
+    with _state_lock:
+        _state['runs'] += 1
+        _state['total_deleted'] += deleted
+        _state['last_run_at'] = datetime.now().isoformat()
+        _state['last_deleted'] = deleted
+        _state['last_cutoff_day'] = cutoff_day
+        _state['last_duration_ms'] = duration_ms
+        _state['last_error'] = error
+        _state['retention_days'] = retention_days
+
+    logging.info(f"[HISTORY-PRUNE] Deleted {deleted} history rows before {cutoff_day} ({duration_ms} ms)")
+    return result
+
+
+def get_pruner_stats():
+    """Return counters and the result of the latest prune"""
+    with _state_lock:
+        return dict(_state)
+
+
+def start_history_pruner(interval=None):
+    """Start the background prune loop once per process; returns immediately"""
+    global _pruner_thread
+
+    if RETENTION_DAYS <= 0:
+        return None
+
+    with _state_lock:
+        if _pruner_thread is not None and _pruner_thread.is_alive():
+            return _pruner_thread
+
+        def prune_loop():
+            while True:
+                time.sleep(interval or PRUNE_INTERVAL_SECONDS)
+                prune_expired_history()
+
+        _pruner_thread = threading.Thread(target=prune_loop, name='history-pruner', daemon=True)
+        _pruner_thread.start()
+        return _pruner_thread
@@ -0,0 +1,206 @@
+"""
+Device ownership cache for UniLocator
+Bounded LRU with a short TTL so telemetry writes skip the ownership query
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class DeviceOwnerCache:
+    """
+    LRU + TTL map of device_code -> owners from connected_devices
+
+    A code can be connected by more than one user, so each entry is the set
+    of owning user ids. Only devices that exist are cached: an unknown code
+    is looked up again on every call, so a device connected by another
+    worker process is accepted immediately. This process invalidates entries
+    itself when devices are connected or removed; changes made by other
+    worker processes are picked up once the entry expires, so ttl_seconds
+    bounds how long another worker can act on a removed ownership.
+
+    Invalidations are stamped on the device codes and owners they touch, so
+    a query result is only discarded for the devices an invalidation could
+    have made stale.
+    """
+
+    def __init__(self, max_entries=10000, ttl_seconds=5.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # device_code -> (stored_at, frozenset of user ids)
+        self._by_owner = {}  # user_id -> set of cached device codes
+        # Generation of the last invalidation per code and per owner, for
+        # recently invalidated ones; all others are at the floor
+        self._code_stamps = OrderedDict()
+        self._owner_stamps = OrderedDict()
+        self._stamp_floor = 0
+        self._generation = 0  # bumped by every invalidation
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'expirations': 0, 'evictions': 0, 'invalidations': 0}
+
+    def get_many(self, device_codes):
+        """Return {device_code: owners} for the codes that are cached and fresh"""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for code in device_codes:
+                entry = self._entries.get(code)
+                if entry is not None and now - entry[0] > self.ttl_seconds:
+                    self._remove(code)
+                    self._stats['expirations'] += 1
+                    entry = None
+                if entry is None:
+                    self._stats['misses'] += 1
+                    continue
+                self._entries.move_to_end(code)
+                self._stats['hits'] += 1
+                found[code] = entry[1]
+        return found
+
+    @property
+    def generation(self):
+        """Read before querying the database and pass to set_many()"""
+        return self._generation
+
+    def set_many(self, owners, generation=None):
+        """
+        Store {device_code: owners}, evicting the least recently used past the size limit
+
+        Pass the generation read before querying the database; a device is
+        not stored if it, or one of the owners loaded for it, was invalidated
+        in between, since the row may predate the change.
+        """
+        if self.max_entries <= 0:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            for code, user_ids in owners.items():
+                if generation is not None and self._stale(code, user_ids, generation):
+                    continue
+                self._remove(code)
+                self._entries[code] = (now, frozenset(user_ids))
+                for user_id in user_ids:
+                    self._by_owner.setdefault(user_id, set()).add(code)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def invalidate(self, *device_codes):
+        """Drop the given devices"""
+        with self._lock:
+            self._generation += 1
+            self._stamp(self._code_stamps, device_codes)
+            for code in device_codes:
+                if self._remove(code):
+                    self._stats['invalidations'] += 1
+
+    def invalidate_owner(self, *user_ids):
+        """Drop every device owned by the given users"""
+        with self._lock:
+            self._generation += 1
+            self._stamp(self._owner_stamps, user_ids)
+            codes = set()
+            for user_id in user_ids:
+                codes.update(self._by_owner.get(user_id, ()))
+            for code in codes:
+                self._remove(code)
+            self._stats['invalidations'] += len(codes)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._stamp_floor = self._generation
+            self._code_stamps.clear()
+            self._owner_stamps.clear()
+            self._entries.clear()
+            self._by_owner.clear()
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['max_entries'] = self.max_entries
+        stats['ttl_seconds'] = self.ttl_seconds
+        return stats
+
+    def _stale(self, code, user_ids, generation):
+        # Caller holds the lock
+        floor = self._stamp_floor
+        if self._code_stamps.get(code, floor) > generation:
+            return True
+        return any(self._owner_stamps.get(user_id, floor) > generation for user_id in user_ids)
+
+    def _stamp(self, stamps, keys):
+        # Caller holds the lock. Forgetting the oldest stamps raises the floor
+        # past them, so queries that started before those invalidations are
+        # still discarded.
+        for key in keys:
+            stamps[key] = self._generation
+            stamps.move_to_end(key)
+        while len(stamps) > max(self.max_entries, 1024):
+            _, stamp = stamps.popitem(last=False)
+            self._stamp_floor = max(self._stamp_floor, stamp)
+
+    def _remove(self, code):
+        # Caller holds the lock; returns whether the code was cached
+        entry = self._entries.pop(code, None)
+        if entry is None:
+            return False
+        for user_id in entry[1]:
+            codes = self._by_owner.get(user_id)
+            if codes is not None:
+                codes.discard(code)
+                if not codes:
+                    del self._by_owner[user_id]
+        return True
+
+
+# Global instance used by telemetry ingestion
+device_owner_cache = DeviceOwnerCache(
+    max_entries=int(os.environ.get('OWNER_CACHE_MAX_ENTRIES', 10000)),
+    ttl_seconds=float(os.environ.get('OWNER_CACHE_TTL_SECONDS', 5))
+)
+
+
+def lookup_device_owners(db, device_codes):
+    """
+    Owners of each device, from the cache or one query for the misses
+
+    Args:
+        db: SQLite connection
+        device_codes (list): Codes to look up
+
+    Returns:
+        dict: device_code -> frozenset of user ids; unknown codes are absent
+    """
+    owners = device_owner_cache.get_many(device_codes)
+    missing = [code for code in device_codes if code not in owners]
+    if missing:
+        generation = device_owner_cache.generation
+        placeholders = ','.join('?' * len(missing))
+        rows = db.execute(
+            f'SELECT device_code, user_id FROM connected_devices WHERE device_code IN ({placeholders})',
+            missing
+        ).fetchall()
+        loaded = {}
+        for row in rows:
+            loaded.setdefault(row[0], set()).add(row[1])
+        device_owner_cache.set_many(loaded, generation)
+        owners.update({code: frozenset(user_ids) for code, user_ids in loaded.items()})
+    return owners
+
+
+def invalidate_device_owners(device_codes=(), user_ids=()):
+    """Invalidate cached ownership after devices are connected or removed"""
+    codes = [code for code in device_codes if code]
+    if codes:
+        device_owner_cache.invalidate(*codes)
+    users = [user_id for user_id in user_ids if user_id]
+    if users:
+        device_owner_cache.invalidate_owner(*users)
@@ -0,0 +1,391 @@
+"""
+Device telemetry ingestion and history for UniLocator
+Applies batches of location, battery and network reports in one transaction
+and keeps an append-only history for time-range queries
+"""
+
+import math
+import os
+import time
+from datetime import datetime, timezone
+
+from .owner_cache import lookup_device_owners
+
+# Largest batch accepted in one request
+MAX_REPORTS_PER_BATCH = 500
+
+# Device clocks may run ahead a little; later timestamps are rejected
+MAX_CLOCK_SKEW_SECONDS = 24 * 3600
+
+# Longest network label (e.g. 'wifi', '5g') stored per report
+MAX_NETWORK_LENGTH = 32
+
+# Latest-state value kinds and the report keys each one carries
+REPORT_KINDS = (
+    ('location', ('lat', 'lng')),
+    ('battery', ('battery',)),
+    ('network', ('network',))
+)
+
+# Largest page returned by a history query
+MAX_HISTORY_PAGE = 5000
+
+# Append-only history. Rows are logically partitioned by (device_code, day);
+# the index covers trail queries, which read (device_code, ts) ranges, and the
+# day index serves retention deletes.
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS telemetry_history (
+    id INTEGER PRIMARY KEY,
+    device_code TEXT NOT NULL,
+    day TEXT NOT NULL,
+    ts REAL NOT NULL,
+    latitude REAL,
+    longitude REAL,
+    battery INTEGER,
+    network TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_telemetry_history_device_ts
+    ON telemetry_history (device_code, ts, id, latitude, longitude, battery, network);
+CREATE INDEX IF NOT EXISTS idx_telemetry_history_day
+    ON telemetry_history (day);
+"""
+
+_schema_ready = set()
+
+
+def ensure_history_schema(db):
+    """Create the history table and indexes once per database file"""
+    path = db.execute('PRAGMA database_list').fetchone()[2]
+    if path and path in _schema_ready:
+        return
+    db.executescript(HISTORY_SCHEMA)
+    if path:
+        _schema_ready.add(path)
+
+
+def _parse_ts(value, index):
+    # Epoch seconds (or milliseconds) from the device; server time if absent
+    if value is None:
+        return time.time()
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError(f'Report {index} has an invalid ts')
+    try:
+        ts = float(value)
+    except ValueError:
+        raise ValueError(f'Report {index} has an invalid ts')
+    if not math.isfinite(ts) or ts <= 0:
+        raise ValueError(f'Report {index} has an invalid ts')
+    ts = ts / 1000.0 if ts > 1e11 else ts
+    if ts > time.time() + MAX_CLOCK_SKEW_SECONDS:
+        raise ValueError(f'Report {index} has a ts in the future')
+    return ts
+
+
+def _parse_number(value, name, low, high, index):
+    # JSON numbers only: bools, strings, lists and objects are rejected
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f'Report {index} has a non-numeric {name}')
+    if not math.isfinite(value) or not low <= value <= high:
+        raise ValueError(f'Report {index} has {name} outside {low}..{high}')
+    return value
+
+
+def parse_reports(payload):
+    """
+    Normalise a request body into a list of reports
+
+    Accepts a single report object, a list of reports, or {'reports': [...]}.
+    Each report has a device_code and any of lat/lng, battery and network.
+    Values are checked before anything is buffered: lat/lng are finite
+    numbers within range, battery a whole percentage, network a short
+    string and ts a finite epoch time.
+
+    Raises:
+        ValueError: If the body or a report is malformed
+    """
+    if isinstance(payload, dict) and 'reports' in payload:
+        payload = payload['reports']
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list) or not payload:
+        raise ValueError('Expected a report or a non-empty list of reports')
+    if len(payload) > MAX_REPORTS_PER_BATCH:
+        raise ValueError(f'At most {MAX_REPORTS_PER_BATCH} reports per batch')
+
+    reports = []
+    for index, raw in enumerate(payload):
+        if not isinstance(raw, dict) or not raw.get('device_code'):
+            raise ValueError(f'Report {index} has no device_code')
+        report = {'device_code': str(raw['device_code']), 'ts': _parse_ts(raw.get('ts'), index)}
+        if raw.get('lat') is not None or raw.get('lng') is not None:
+            if raw.get('lat') is None or raw.get('lng') is None:
+                raise ValueError(f'Report {index} needs both lat and lng')
+            report['lat'] = float(_parse_number(raw['lat'], 'lat', -90, 90, index))
+            report['lng'] = float(_parse_number(raw['lng'], 'lng', -180, 180, index))
+        if raw.get('battery') is not None:
+            battery = _parse_number(raw['battery'], 'battery', 0, 100, index)
+            if battery != int(battery):
+                raise ValueError(f'Report {index} has a fractional battery')
+            report['battery'] = int(battery)
+        if raw.get('network') is not None:
+            network = raw['network']
+            if not isinstance(network, str) or not network or len(network) > MAX_NETWORK_LENGTH:
+                raise ValueError(f'Report {index} has an invalid network')
+            report['network'] = network
+        if len(report) == 2:
+            raise ValueError(f'Report {index} has no location, battery or network')
+        reports.append(report)
+    return reports
+
+
+def absorb_report(state, report):
+    """
+    Fold a report into {device_code: {kind: (values, ts)}}
+
+    The value with the newest ts wins, and the later report on a tie, so
+    reports that arrive out of order cannot roll a device back. The direct
+    and buffered write paths both use this rule.
+
+    Returns:
+        int: Values of the report that met one already held for the device
+    """
+    device = state.setdefault(report['device_code'], {})
+    ts = report['ts']
+    met = 0
+    for kind, keys in REPORT_KINDS:
+        if report.get(keys[0]) is None:
+            continue
+        current = device.get(kind)
+        if current is not None:
+            met += 1
+            if current[1] > ts:
+                continue
+        device[kind] = (tuple(report[key] for key in keys), ts)
+    return met
+
+
+def ingest_reports(db, user_id, reports, buffer=None):
+    """
+    Apply telemetry reports for devices owned by user_id
+
+    Ownership comes from the owner cache, with one query for the devices it
+    does not hold. Every report is appended to the history; for the
+    latest-state columns only the newest value of each kind per device is
+    kept (see absorb_report) and last_seen is the server's receive time.
+    Each kind is written with a single executemany, all in one transaction.
+    With a buffer, accepted reports are handed to it for a later group
+    commit instead; they are written directly only if the buffer refuses them.
+    The newest location per device is then mirrored to Firestore (see
+    mirror_locations).
+
+    Args:
+        db: SQLite connection
+        user_id (str): Owner the devices must belong to
+        reports (list): Reports from parse_reports, oldest first
+        buffer (TelemetryBuffer): Optional group-commit buffer
+
+    Returns:
+        dict: accepted count, rejected device codes and rows updated per kind
+    """
+    codes = sorted({report['device_code'] for report in reports})
+    owners = lookup_device_owners(db, codes)
+    owned = {code for code, user_ids in owners.items() if user_id in user_ids}
+
+    accepted = [report for report in reports if report['device_code'] in owned]
+    latest = {}
+    for report in accepted:
+        absorb_report(latest, report)
+    updates = {kind: [] for kind, _ in REPORT_KINDS}
+    for code, kinds in latest.items():
+        for kind, (values, _) in kinds.items():
+            updates[kind].append(values + (code,))
+    locations, batteries, networks = updates['location'], updates['battery'], updates['network']
+
+    result = {
+        'accepted': len(accepted),
+        'rejected': [code for code in codes if code not in owned],
+        'updated': {'location': len(locations), 'battery': len(batteries), 'network': len(networks)}
+    }
+    if buffer is not None and buffer.add(accepted):
+        mirror_locations(locations)
+        return result
+
+    if accepted:
+        ensure_history_schema(db)
+
+    try:
+        append_history(db, accepted)
+        if locations:
+            db.executemany(
+                '''UPDATE connected_devices
+                   SET last_latitude = ?, last_longitude = ?, last_seen = CURRENT_TIMESTAMP
+                   WHERE device_code = ?''',
+                locations
+            )
+        if batteries:
+            db.executemany(
+                '''UPDATE connected_devices
+                   SET last_battery = ?, last_seen = CURRENT_TIMESTAMP
+                   WHERE device_code = ?''',
+                batteries
+            )
+        if networks:
+            db.executemany(
+                '''UPDATE connected_devices
+                   SET last_network = ?, last_seen = CURRENT_TIMESTAMP
+                   WHERE device_code = ?''',
+                networks
+            )
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    mirror_locations(locations)
+    return result
+
+
+def mirror_locations(locations):
+    """
+    Queue (lat, lng, device_code) rows for the Firestore device_locations mirror
+
+    Does nothing unless FIRESTORE_TELEMETRY_MIRROR is true. Writes go
+    through the bulk writer, which coalesces repeated updates per device.
+    """
+    if not locations or os.environ.get('FIRESTORE_TELEMETRY_MIRROR', 'false').lower() != 'true':
+        return
+    from .firebase_utils import mirror_device_location
+    for lat, lng, code in locations:
+        mirror_device_location(code, lat, lng)
+
+
+def append_history(db, reports):
+    """Append reports to the history; the caller commits"""
+    if not reports:
+        return
+    db.executemany(
+        '''INSERT INTO telemetry_history (device_code, day, ts, latitude, longitude, battery, network)
+           VALUES (?, ?, ?, ?, ?, ?, ?)''',
+        [(
+            report['device_code'],
+            datetime.fromtimestamp(report['ts'], timezone.utc).strftime('%Y-%m-%d'),
+            report['ts'],
+            report.get('lat'),
+            report.get('lng'),
+            report.get('battery'),
+            report.get('network')
+        ) for report in reports]
+    )
+
+
+def query_history(db, device_code, start=None, end=None, limit=500, cursor=None):
+    """
+    Read a device's history in time order, one page at a time
+
+    Args:
+        db: SQLite connection
+        device_code (str): Device to read
+        start (float): Inclusive lower bound, epoch seconds
+        end (float): Exclusive upper bound, epoch seconds
+        limit (int): Page size, at most MAX_HISTORY_PAGE
+        cursor (str): next_cursor from the previous page
+
+    Returns:
+        dict: 'points' (ts, lat, lng, battery, network) and 'next_cursor',
+        which is None on the last page
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    ensure_history_schema(db)
+    limit = max(1, min(int(limit), MAX_HISTORY_PAGE))
+
+    clauses = ['device_code = ?']
+    params = [device_code]
+    if cursor:
+        try:
+            cursor_ts, cursor_id = cursor.split(':')
+            params.extend([float(cursor_ts), int(cursor_id)])
+        except ValueError:
+            raise ValueError('Invalid cursor')
+        clauses.append('(ts, id) > (?, ?)')
+    elif start is not None:
+        clauses.append('ts >= ?')
+        params.append(float(start))
+    if end is not None:
+        clauses.append('ts < ?')
+        params.append(float(end))
+
+    rows = db.execute(
+        f'''SELECT id, ts, latitude, longitude, battery, network
+            FROM telemetry_history
+            WHERE {' AND '.join(clauses)}
+            ORDER BY ts, id
+            LIMIT ?''',
+        params + [limit + 1]
+    ).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f'{rows[-1][1]!r}:{rows[-1][0]}'
+
+    return {
+        'points': [
+            {'ts': row[1], 'lat': row[2], 'lng': row[3], 'battery': row[4], 'network': row[5]}
+            for row in rows
+        ],
+        'next_cursor': next_cursor
+    }
+
+
+def export_user_history(db, user_id):
+    """History points of every device user_id has connected, in time order"""
+    ensure_history_schema(db)
+    rows = db.execute(
+        '''SELECT device_code, ts, latitude, longitude, battery, network
+           FROM telemetry_history
+           WHERE device_code IN (SELECT device_code FROM connected_devices WHERE user_id = ?)
+           ORDER BY device_code, ts, id''',
+        (user_id,)
+    ).fetchall()
+    return [
+        {'device_code': row[0], 'ts': row[1], 'lat': row[2], 'lng': row[3], 'battery': row[4], 'network': row[5]}
+        for row in rows
+    ]
+
+
+def delete_user_history(db, user_id):
+    """
+    Delete the history of devices only user_id has connected; the caller commits
+
+    Run it before the user's connected_devices rows are removed. A device
+    another account still has connected keeps its history.
+    """
+    ensure_history_schema(db)
+    return db.execute(
+        '''DELETE FROM telemetry_history
+           WHERE device_code IN (SELECT device_code FROM connected_devices WHERE user_id = ?)
+             AND device_code NOT IN (SELECT device_code FROM connected_devices WHERE user_id != ?)''',
+        (user_id, user_id)
+    ).rowcount
+
+
+def prune_history(db, before_day, limit=None):
+    """
+    Delete history rows older than a 'YYYY-MM-DD' day; returns rows deleted
+
+    With a limit, at most that many rows are deleted in this transaction so
+    a large backlog can be worked off without holding the write lock for long.
+    """
+    ensure_history_schema(db)
+    if limit is None:
+        deleted = db.execute('DELETE FROM telemetry_history WHERE day < ?', (before_day,)).rowcount
+    else:
+        deleted = db.execute(
+            '''DELETE FROM telemetry_history
+               WHERE id IN (SELECT id FROM telemetry_history WHERE day < ? LIMIT ?)''',
+            (before_day, int(limit))
+        ).rowcount
+    db.commit()
+    return deleted
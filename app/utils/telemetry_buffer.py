@@ -0,0 +1,323 @@
+"""
+Group-commit buffer for device telemetry in UniLocator
+Absorbs latest-state updates per device in memory and writes them to SQLite
+in one transaction per flush instead of one commit per request
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+from .database import db_connection
+from .telemetry import absorb_report, append_history, ensure_history_schema
+
+BUFFER_ENABLED = os.environ.get('TELEMETRY_BUFFER_ENABLED', 'true').lower() == 'true'
+
+# Latest-state columns per report kind
+_COLUMNS = {
+    'location': ('last_latitude', 'last_longitude'),
+    'battery': ('last_battery',),
+    'network': ('last_network',)
+}
+
+
+def _last_seen(received_at):
+    # Same text format as CURRENT_TIMESTAMP, taken from when the server
+    # received the report rather than the flush time or the device clock
+    return datetime.fromtimestamp(received_at, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class TelemetryBuffer:
+    """
+    Latest-state buffer with time- and size-triggered group commits
+
+    add() keeps only the newest value of each kind per device, by the same
+    rule as the direct write path (telemetry.absorb_report), plus every
+    report for the append-only history. The buffer is flushed in a single
+    transaction when it holds max_reports reports or when its oldest report
+    has waited flush_interval seconds. latest() overlays buffered values,
+    including ones being flushed, so readers never see an older state than
+    was acknowledged. If the group commit fails, each device is written in
+    its own transaction so one bad row cannot hold back the rest; a device
+    that still fails is put back under any newer values and retried, and its
+    reports are dropped after max_attempts failed flushes.
+    """
+
+    def __init__(self, db_path=None, flush_interval=1.0, max_reports=1000, max_pending=50000, max_attempts=5):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_reports = max_reports
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self._state = {}  # device_code -> {kind: (values, ts)}
+        self._history = []  # (request seq, report, received at)
+        self._inflight = {}
+        self._attempts = {}  # device_code -> failed flushes so far
+        self._outstanding = {}  # request seq -> reports not yet committed
+        self._next_seq = 0
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._stats = {
+            'requests': 0, 'reports': 0, 'coalesced': 0, 'dropped': 0, 'dead_lettered': 0,
+            'flushes': 0, 'commits': 0, 'failed_flushes': 0, 'committed_requests': 0, 'rows_written': 0,
+            'last_flush_ms': None, 'max_flush_ms': None, 'total_flush_ms': 0.0
+        }
+
+    def add(self, reports):
+        """
+        Buffer reports from one request; they are durable after the next flush
+
+        Args:
+            reports (list): Accepted reports from parse_reports, oldest first
+
+        Returns:
+            bool: False if the buffer is closed or full and nothing was buffered
+        """
+        if not reports:
+            return True
+        with self._cond:
+            if self._closed or len(self._history) + len(reports) > self.max_pending:
+                self._stats['dropped'] += len(reports)
+                logging.warning(f"[TELEMETRY-BUFFER] Dropped {len(reports)} reports; buffer closed or full")
+                return False
+            seq = self._next_seq
+            self._next_seq += 1
+            self._outstanding[seq] = len(reports)
+            received_at = time.time()
+            for report in reports:
+                self._stats['coalesced'] += absorb_report(self._state, report)
+            self._history.extend((seq, report, received_at) for report in reports)
+            self._stats['requests'] += 1
+            self._stats['reports'] += len(reports)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._ensure_started()
+            self._cond.notify()
+        return True
+
+    def latest(self, device_code):
+        """Buffered (not yet committed) values for a device, e.g. {'location': (lat, lng)}"""
+        with self._cond:
+            merged = dict(self._inflight.get(device_code, {}))
+            merged.update(self._state.get(device_code, {}))
+        return {kind: values for kind, (values, _) in merged.items()}
+
+    def flush(self):
+        """Commit everything buffered so far on the calling thread"""
+        while self._flush_once(force=True):
+            pass
+
+    def close(self):
+        """Stop the background thread after flushing what is buffered"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+        self.flush()
+
+    def stats(self):
+        """Commits saved, flush latency and buffer depth"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending_reports'] = len(self._history)
+            stats['pending_devices'] = len(self._state)
+        total_ms = stats.pop('total_flush_ms')
+        stats['avg_flush_ms'] = round(total_ms / stats['flushes'], 2) if stats['flushes'] else None
+        # Without the buffer every committed request would have had its own commit
+        stats['commits_saved'] = max(0, stats['committed_requests'] - stats['commits'])
+        stats['enabled'] = True
+        stats['flush_interval'] = self.flush_interval
+        stats['max_reports'] = self.max_reports
+        stats['max_attempts'] = self.max_attempts
+        return stats
+
+    def _ensure_started(self):
+        # Caller holds the condition
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='telemetry-buffer', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._due():
+                    self._cond.wait(timeout=self._wait_time())
+                if self._closed:
+                    return
+            if not self._flush_once(force=False):
+                # Failed flush; back off for one interval before retrying
+                time.sleep(self.flush_interval)
+
+    def _due(self):
+        # Caller holds the condition
+        if self._oldest is None:
+            return False
+        return (len(self._history) >= self.max_reports
+                or time.monotonic() - self._oldest >= self.flush_interval)
+
+    def _wait_time(self):
+        # Caller holds the condition
+        if self._oldest is None:
+            return None
+        return max(0.0, self.flush_interval - (time.monotonic() - self._oldest))
+
+    def _flush_once(self, force):
+        """Commit the buffer; returns True if everything taken from it was written"""
+        with self._flush_lock:
+            with self._cond:
+                if self._oldest is None or not (force or self._due()):
+                    return False
+                state, history = self._state, self._history
+                self._state, self._history, self._oldest = {}, [], None
+                self._inflight = state
+
+            start = time.perf_counter()
+            failed = {}
+            try:
+                rows = self._write(state, history)
+                commits = 1
+            except Exception as e:
+                logging.warning(f"[TELEMETRY-BUFFER] Group commit of {len(history)} reports failed: {e}; "
+                                f"writing {len(state)} devices one by one")
+                rows, commits, failed = self._write_each(state, history)
+            elapsed_ms = round((time.perf_counter() - start) * 1000, 2)
+
+            with self._cond:
+                self._inflight = {}
+                self._stats['flushes'] += 1
+                self._stats['last_flush_ms'] = elapsed_ms
+                self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'] or 0, elapsed_ms)
+                self._stats['total_flush_ms'] += elapsed_ms
+                self._stats['commits'] += commits
+                self._stats['rows_written'] += rows
+                for device_code in state:
+                    if device_code not in failed:
+                        self._attempts.pop(device_code, None)
+                for seq, report, _ in history:
+                    if report['device_code'] not in failed:
+                        self._settle(seq)
+                if not failed:
+                    return True
+
+                self._stats['failed_flushes'] += 1
+                self._requeue(state, history, failed)
+                return False
+
+    def _write_each(self, state, history):
+        """Write each device in its own transaction; returns rows, commits and {device_code: error}"""
+        reports_by_device = {}
+        for entry in history:
+            reports_by_device.setdefault(entry[1]['device_code'], []).append(entry)
+
+        rows = commits = 0
+        failed = {}
+        for device_code, kinds in state.items():
+            try:
+                rows += self._write({device_code: kinds}, reports_by_device.get(device_code, []))
+                commits += 1
+            except Exception as e:
+                failed[device_code] = e
+        return rows, commits, failed
+
+    def _requeue(self, state, history, failed):
+        # Caller holds the condition; merged back by the newest-ts rule
+        requeued = []
+        for device_code, error in failed.items():
+            entries = [entry for entry in history if entry[1]['device_code'] == device_code]
+            attempts = self._attempts.get(device_code, 0) + 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(device_code, None)
+                for seq, _, _ in entries:
+                    self._outstanding.pop(seq, None)
+                self._stats['dead_lettered'] += len(entries)
+                logging.error(f"[TELEMETRY-BUFFER] Dropped {len(entries)} reports for {device_code} "
+                              f"after {attempts} failed flushes: {error}")
+                continue
+
+            self._attempts[device_code] = attempts
+            logging.error(f"[TELEMETRY-BUFFER] Flush of {len(entries)} reports for {device_code} failed "
+                          f"(attempt {attempts} of {self.max_attempts}): {error}")
+            device = self._state.setdefault(device_code, {})
+            for kind, entry in state[device_code].items():
+                # On a tie the value buffered since is the later report and wins
+                current = device.get(kind)
+                if current is None or current[1] < entry[1]:
+                    device[kind] = entry
+            requeued.extend(entries)
+
+        self._history[:0] = requeued
+        if requeued and self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def _settle(self, seq):
+        # Caller holds the condition; a request counts once all its reports are committed
+        remaining = self._outstanding.get(seq)
+        if remaining is None:
+            return
+        if remaining > 1:
+            self._outstanding[seq] = remaining - 1
+        else:
+            del self._outstanding[seq]
+            self._stats['committed_requests'] += 1
+
+    def _write(self, state, history):
+        received = {}
+        for _, report, received_at in history:
+            code = report['device_code']
+            received[code] = max(received.get(code, 0.0), received_at)
+
+        updates = {kind: [] for kind in _COLUMNS}
+        for device_code, kinds in state.items():
+            last_seen = _last_seen(received[device_code])
+            for kind, (values, _) in kinds.items():
+                updates[kind].append(values + (last_seen, device_code))
+
+        # An uncommitted transaction is rolled back when the connection returns to the pool
+        with db_connection(self.db_path) as conn:
+            ensure_history_schema(conn)
+            append_history(conn, [report for _, report, _ in history])
+            rows = len(history)
+            for kind, params in updates.items():
+                if not params:
+                    continue
+                assignments = ', '.join(f'{column} = ?' for column in _COLUMNS[kind])
+                conn.executemany(
+                    f'UPDATE connected_devices SET {assignments}, last_seen = ? WHERE device_code = ?',
+                    params
+                )
+                rows += len(params)
+            conn.commit()
+            return rows
+
+
+# Global instance; None when TELEMETRY_BUFFER_ENABLED=false
+telemetry_buffer = TelemetryBuffer(
+    flush_interval=float(os.environ.get('TELEMETRY_BUFFER_FLUSH_INTERVAL_SECONDS', 1.0)),
+    max_reports=int(os.environ.get('TELEMETRY_BUFFER_MAX_REPORTS', 1000)),
+    max_pending=int(os.environ.get('TELEMETRY_BUFFER_MAX_PENDING', 50000)),
+    max_attempts=int(os.environ.get('TELEMETRY_BUFFER_MAX_ATTEMPTS', 5))
+) if BUFFER_ENABLED else None
+
+if telemetry_buffer is not None:
+    # Commit what is still buffered when the process exits normally
+    atexit.register(telemetry_buffer.close)
+
+
+def get_buffered_state(device_code):
+    """Buffered values for a device, empty when the buffer is off"""
+    if telemetry_buffer is None:
+        return {}
+    return telemetry_buffer.latest(device_code)
+
+
+def get_buffer_stats():
+    if telemetry_buffer is None:
+        return {'enabled': False}
+    return telemetry_buffer.stats()
@@ -0,0 +1,123 @@
+"""
+Opt-in request tracing for UniLocator
+Records timed spans and events only when a caller asks for a trace
+"""
+
+import time
+from datetime import datetime
+
+
+class Span:
+    """A timed phase of a traced operation"""
+
+    __slots__ = ('name', 'start', 'duration', 'attrs')
+
+    def __init__(self, name, start, attrs):
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc is not None:
+            self.attrs['error'] = str(exc)
+        return False
+
+
+class Trace:
+    """
+    Collects spans and events for one operation
+
+    Pass a Trace into a traced function to record what it did; pass nothing
+    (or NULL_TRACE) and the function does no bookkeeping at all.
+    """
+
+    enabled = True
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = datetime.now()
+        self._origin = time.perf_counter()
+        self._records = []  # Spans and events in the order they started
+
+    def span(self, name, **attrs):
+        span = Span(name, time.perf_counter(), attrs)
+        self._records.append(span)
+        return span
+
+    def event(self, message, **attrs):
+        self._records.append((time.perf_counter(), message, attrs))
+
+    def to_dict(self):
+        """Structured form for JSON responses"""
+        spans = []
+        events = []
+        for record in self._records:
+            if isinstance(record, Span):
+                spans.append({
+                    'name': record.name,
+                    'offset_ms': round((record.start - self._origin) * 1000, 2),
+                    'duration_ms': round(record.duration * 1000, 2) if record.duration is not None else None,
+                    **record.attrs
+                })
+            else:
+                at, message, attrs = record
+                events.append({'offset_ms': round((at - self._origin) * 1000, 2), 'message': message, **attrs})
+        return {
+            'name': self.name,
+            'started_at': self.started_at.isoformat(),
+            'total_ms': round((time.perf_counter() - self._origin) * 1000, 2),
+            'spans': spans,
+            'events': events
+        }
+
+    def render(self):
+        """Human-readable lines for the debug panels"""
+        lines = []
+        for record in self._records:
+            if isinstance(record, Span):
+                offset = (record.start - self._origin) * 1000
+                duration = f"{record.duration * 1000:.1f} ms" if record.duration is not None else "running"
+                details = ''.join(f", {key}={value}" for key, value in record.attrs.items())
+                lines.append(f"[{offset:8.1f} ms] {record.name} ({duration}{details})")
+            else:
+                at, message, attrs = record
+                details = ''.join(f", {key}={value}" for key, value in attrs.items())
+                lines.append(f"[{(at - self._origin) * 1000:8.1f} ms] {message}{details}")
+        return lines
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+class _NullTrace:
+    """Stand-in used when tracing is off; every call is a no-op"""
+
+    enabled = False
+    _span = _NullSpan()
+
+    def span(self, name, **attrs):
+        return self._span
+
+    def event(self, message, **attrs):
+        pass
+
+
+NULL_TRACE = _NullTrace()
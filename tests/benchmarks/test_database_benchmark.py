@@ -0,0 +1,137 @@
+"""
+Mixed dashboard reads and telemetry writes under concurrency: a connection
+per call (rollback journal, the previous hard-coded sqlite3.connect) versus
+the pooled WAL connections from utils/database.py
+
+Opt-in: python -m pytest tests/benchmarks --run-benchmarks -s
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import pytest
+
+from app.utils.database import ConnectionPool
+from app.utils.telemetry import append_history, ensure_history_schema
+
+USERS = 200
+DEVICES_PER_USER = 5
+READERS = 8
+WRITERS = 2
+SECONDS = 2.0
+
+SCHEMA = """
+CREATE TABLE connected_devices (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    device_code TEXT NOT NULL,
+    device_name TEXT,
+    connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen TIMESTAMP,
+    last_latitude REAL,
+    last_longitude REAL,
+    last_battery INTEGER,
+    last_network TEXT
+);
+CREATE INDEX idx_connected_devices_user ON connected_devices (user_id);
+CREATE INDEX idx_connected_devices_code ON connected_devices (device_code);
+"""
+
+
+def _create(path):
+    with closing(sqlite3.connect(path)) as conn:
+        conn.executescript(SCHEMA)
+        ensure_history_schema(conn)
+        conn.executemany(
+            'INSERT INTO connected_devices (user_id, device_code, device_name) VALUES (?, ?, ?)',
+            [(f'user-{index % USERS}', f'DEV{index:05}', f'Phone {index}')
+             for index in range(USERS * DEVICES_PER_USER)]
+        )
+        conn.commit()
+
+
+def _dashboard_read(conn, worker, count):
+    # Same query as main._load_local_devices
+    user_id = f'user-{(worker * 7919 + count) % USERS}'
+    conn.execute(
+        '''SELECT device_code, device_name, connected_at
+           FROM connected_devices WHERE user_id = ? ORDER BY connected_at DESC''',
+        (user_id,)
+    ).fetchall()
+
+
+def _telemetry_write(conn, worker, count):
+    # One device report: history row plus the latest-state update, one commit
+    code = f'DEV{(worker * 104729 + count) % (USERS * DEVICES_PER_USER):05}'
+    append_history(conn, [{'device_code': code, 'ts': time.time(), 'lat': 52.5, 'lng': 13.4, 'battery': count % 100}])
+    conn.execute(
+        '''UPDATE connected_devices
+           SET last_latitude = ?, last_longitude = ?, last_battery = ?, last_seen = CURRENT_TIMESTAMP
+           WHERE device_code = ?''',
+        (52.5, 13.4, count % 100, code)
+    )
+    conn.commit()
+
+
+def _run(connection, seconds=SECONDS):
+    """Run readers and writers for a fixed time; ops/s per role, read p99 and max, lock errors"""
+    stop = threading.Event()
+    results = {'read': [], 'write': []}
+    errors = []
+    lock = threading.Lock()
+
+    def worker(role, operation, index):
+        latencies = []
+        count = 0
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with connection() as conn:
+                    operation(conn, index, count)
+            except sqlite3.OperationalError as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            latencies.append(time.perf_counter() - start)
+            count += 1
+        with lock:
+            results[role].extend(latencies)
+
+    threads = [threading.Thread(target=worker, args=('read', _dashboard_read, i)) for i in range(READERS)]
+    threads += [threading.Thread(target=worker, args=('write', _telemetry_write, i)) for i in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    reads = sorted(results['read']) or [float('nan')]
+    p99 = reads[int(len(reads) * 0.99)] * 1000
+    return len(results['read']) / seconds, len(results['write']) / seconds, p99, reads[-1] * 1000, len(errors)
+
+
+@pytest.mark.benchmark
+def test_mixed_read_write_concurrency(tmp_path):
+    per_call_path = os.path.join(tmp_path, 'per-call.db')
+    pooled_path = os.path.join(tmp_path, 'pooled.db')
+    _create(per_call_path)
+    _create(pooled_path)
+
+    def per_call():
+        return closing(sqlite3.connect(per_call_path, timeout=5.0))
+
+    pool = ConnectionPool(pooled_path, size=READERS + WRITERS)
+
+    print(f"\n{READERS} dashboard readers and {WRITERS} telemetry writers for {SECONDS:.0f}s, "
+          f"{USERS * DEVICES_PER_USER} devices")
+    for label, connection in (('connection per call', per_call), ('pooled WAL connections', pool.connection)):
+        reads, writes, p99, worst, errors = _run(connection)
+        print(f"  {label:<24} {reads:8.0f} reads/s {writes:7.0f} writes/s  "
+              f"read p99 {p99:7.2f} ms, max {worst:7.2f} ms  {errors} lock errors")
+
+    with pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM telemetry_history').fetchone()[0] > 0
@@ -0,0 +1,96 @@
+"""
+Per-document decode cost for realistic user_devices payloads
+
+Opt-in: python -m pytest tests/benchmarks --run-benchmarks -s
+"""
+
+import time
+
+import pytest
+
+from app.utils.firebase_rest import decode_fields
+
+DOCUMENTS = 20000
+
+
+def _user_device(index):
+    return {
+        'deviceId': {'stringValue': f'DEV{index:06}'},
+        'userId': {'stringValue': f'user-{index % 500}'},
+        'deviceName': {'stringValue': f'Pixel {index}'},
+        'deviceModel': {'stringValue': 'Pixel 8'},
+        'deviceType': {'stringValue': 'android'},
+        'androidVersion': {'stringValue': '14'},
+        'appVersion': {'stringValue': '2.3.1'},
+        'isActive': {'booleanValue': index % 3 != 0},
+        'batteryLevel': {'integerValue': str(index % 100)},
+        'registeredAt': {'timestampValue': '2024-01-02T03:04:05.123456789Z'},
+        'lastSeenAt': {'timestampValue': '2024-06-30T23:59:59.5Z'},
+        'lastLocation': {'mapValue': {'fields': {
+            'latitude': {'doubleValue': 52.52 + index * 1e-6},
+            'longitude': {'doubleValue': 13.405},
+            'accuracy': {'doubleValue': 12.5}
+        }}},
+        'deviceInfo': {'mapValue': {'fields': {
+            'brand': {'stringValue': 'google'},
+            'manufacturer': {'stringValue': 'Google'},
+            'product': {'stringValue': 'shiba'},
+            'sensors': {'arrayValue': {'values': [
+                {'stringValue': 'gps'}, {'stringValue': 'accelerometer'}, {'stringValue': 'gyroscope'}
+            ]}}
+        }}},
+        'fcmToken': {'nullValue': None},
+    }
+
+
+def _recursive_decode(fields):
+    # The previous decoder: an if/elif chain per value and a recursive call per map
+    parsed = {}
+    for key, value in fields.items():
+        if 'stringValue' in value:
+            parsed[key] = value['stringValue']
+        elif 'integerValue' in value:
+            parsed[key] = int(value['integerValue'])
+        elif 'doubleValue' in value:
+            parsed[key] = float(value['doubleValue'])
+        elif 'booleanValue' in value:
+            parsed[key] = value['booleanValue']
+        elif 'timestampValue' in value:
+            parsed[key] = value['timestampValue']
+        elif 'mapValue' in value and 'fields' in value['mapValue']:
+            parsed[key] = _recursive_decode(value['mapValue']['fields'])
+        elif 'arrayValue' in value:
+            parsed[key] = [_recursive_value(item) for item in value['arrayValue'].get('values', [])]
+    return parsed
+
+
+def _recursive_value(value):
+    if 'stringValue' in value:
+        return value['stringValue']
+    if 'mapValue' in value:
+        return _recursive_decode(value['mapValue']['fields'])
+    return value
+
+
+def _per_document_us(decode, documents):
+    start = time.perf_counter()
+    for fields in documents:
+        decode(fields)
+    return (time.perf_counter() - start) / len(documents) * 1e6
+
+
+@pytest.mark.benchmark
+def test_decode_cost_per_document():
+    documents = [_user_device(index) for index in range(DOCUMENTS)]
+    decode_fields(documents[0])  # warm up
+
+    table_us = _per_document_us(decode_fields, documents)
+    recursive_us = _per_document_us(_recursive_decode, documents)
+
+    print(f"\n{DOCUMENTS} user_devices documents, {len(documents[0])} fields each")
+    print(f"  table-driven decode_fields: {table_us:.2f} us/doc (all types, timestamps as datetime)")
+    print(f"  previous recursive parser:  {recursive_us:.2f} us/doc (drops null/geo/bytes/reference, raw timestamps)")
+
+    decoded = decode_fields(documents[0])
+    assert decoded['deviceInfo']['sensors'] == ['gps', 'accelerometer', 'gyroscope']
+    assert decoded['registeredAt'].microsecond == 123456
@@ -0,0 +1,81 @@
+"""
+Telemetry ingestion throughput: three calls per report versus batched reports
+
+Opt-in: python -m pytest tests/benchmarks --run-benchmarks -s
+"""
+
+import time
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+from app.utils import telemetry_buffer
+
+DEVICES = 20
+ROUNDS = 25
+
+
+@pytest.fixture
+def phone(app, client, db, monkeypatch):
+    # Direct transactions only; the group-commit buffer would hide the per-request cost
+    monkeypatch.setattr(telemetry_buffer, 'telemetry_buffer', None)
+    db.executemany(
+        'INSERT INTO connected_devices (user_id, device_code, device_name) VALUES (?, ?, ?)',
+        [('user-1', f'DEV{index:03}', f'Phone {index}') for index in range(DEVICES)]
+    )
+    db.commit()
+    with app.app_context():
+        token = create_access_token(identity='user-1')
+    return client, {'Authorization': f'Bearer {token}'}
+
+
+def _report(index, round_):
+    return {'device_code': f'DEV{index:03}', 'ts': time.time(), 'lat': 52.0 + round_ * 1e-4,
+            'lng': 13.0, 'battery': 100 - round_ % 100, 'network': 'wifi'}
+
+
+def _three_calls(client, headers):
+    for round_ in range(ROUNDS):
+        for index in range(DEVICES):
+            report = _report(index, round_)
+            code = report['device_code']
+            for path, body in (
+                (f'/devices/location/{code}', {'lat': report['lat'], 'lng': report['lng']}),
+                (f'/devices/battery/{code}', {'battery': report['battery']}),
+                (f'/devices/network/{code}', {'network': report['network']})
+            ):
+                assert client.post(path, json=body, headers=headers).status_code == 200
+
+
+def _one_call_per_report(client, headers):
+    for round_ in range(ROUNDS):
+        for index in range(DEVICES):
+            response = client.post('/devices/telemetry', json=_report(index, round_), headers=headers)
+            assert response.status_code == 200
+
+
+def _one_batch_per_round(client, headers):
+    for round_ in range(ROUNDS):
+        reports = [_report(index, round_) for index in range(DEVICES)]
+        response = client.post('/devices/telemetry', json={'reports': reports}, headers=headers)
+        assert response.status_code == 200
+
+
+@pytest.mark.benchmark
+def test_ingest_throughput(phone, db):
+    client, headers = phone
+    total = DEVICES * ROUNDS
+
+    print(f"\n{total} reports (location, battery, network) from {DEVICES} devices, buffer off")
+    for label, run in (
+        ('three calls per report', _three_calls),
+        ('/devices/telemetry per report', _one_call_per_report),
+        (f'/devices/telemetry, {DEVICES} per batch', _one_batch_per_round)
+    ):
+        start = time.perf_counter()
+        run(client, headers)
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<34} {total / elapsed:8.0f} reports/s")
+
+    row = db.execute("SELECT last_battery, last_network FROM connected_devices WHERE device_code = 'DEV000'").fetchone()
+    assert row == (100 - (ROUNDS - 1), 'wifi')
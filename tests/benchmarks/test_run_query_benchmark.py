@@ -0,0 +1,145 @@
+"""
+Fetching one user's devices from a 100k-document user_devices collection:
+a filtered runQuery versus listing the whole collection and filtering locally
+
+A local HTTP stand-in for the Firestore REST API serves the documents, so
+request count, bytes on the wire, JSON parsing and decoding are all real.
+
+Opt-in: python -m pytest tests/benchmarks --run-benchmarks -s
+"""
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from app.utils.firebase_rest import FirebaseRestClient
+
+DOCUMENTS = 100000
+USERS = 2000
+ROOT = 'projects/bench/databases/(default)/documents'
+
+
+def _document(index):
+    return {
+        'name': f'{ROOT}/user_devices/dev{index:06}',
+        'fields': {
+            'deviceId': {'stringValue': f'DEV{index:06}'},
+            'userId': {'stringValue': f'user-{index % USERS}'},
+            'deviceName': {'stringValue': f'Pixel {index}'},
+            'deviceModel': {'stringValue': 'Pixel 8'},
+            'isActive': {'booleanValue': True},
+            'batteryLevel': {'integerValue': str(index % 100)},
+            'registeredAt': {'timestampValue': '2024-01-02T03:04:05.123456Z'},
+            'lastLocation': {'mapValue': {'fields': {
+                'latitude': {'doubleValue': 52.52},
+                'longitude': {'doubleValue': 13.405}
+            }}}
+        },
+        'createTime': '2024-01-02T03:04:05.123456Z',
+        'updateTime': '2024-01-02T03:04:05.123456Z'
+    }
+
+
+class _FirestoreStandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        documents = [_document(index) for index in range(DOCUMENTS)]
+        self.encoded = [json.dumps(doc).encode() for doc in documents]
+        self.names = [doc['name'] for doc in documents]
+        self.by_user = {}
+        for position, doc in enumerate(documents):
+            self.by_user.setdefault(doc['fields']['userId']['stringValue'], []).append(position)
+        self.requests = 0
+        self.bytes_sent = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # List: pageSize documents from the pageToken offset
+        params = parse_qs(urlparse(self.path).query)
+        size = int(params['pageSize'][0])
+        offset = int(params.get('pageToken', ['0'])[0])
+        page = self.server.encoded[offset:offset + size]
+        body = b'{"documents": [' + b', '.join(page) + b']'
+        if offset + size < DOCUMENTS:
+            body += f', "nextPageToken": "{offset + size}"'.encode()
+        self._send(body + b'}')
+
+    def do_POST(self):
+        # runQuery: userId equality filter, __name__ order, startAt cursor and limit
+        query = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['structuredQuery']
+        user_id = query['where']['fieldFilter']['value']['stringValue']
+        positions = self.server.by_user.get(user_id, [])
+        if 'startAt' in query:
+            after = query['startAt']['values'][0]['referenceValue']
+            positions = [p for p in positions if self.server.names[p] > after]
+        page = [self.server.encoded[p] for p in positions[:query['limit']]]
+        read_time = b'"readTime": "2024-01-02T03:04:05Z"'
+        entries = [b'{"document": ' + doc + b', ' + read_time + b'}' for doc in page] or [b'{' + read_time + b'}']
+        self._send(b'[' + b', '.join(entries) + b']')
+
+    def _send(self, body):
+        self.server.requests += 1
+        self.server.bytes_sent += len(body)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture(scope='module')
+def firestore():
+    server = _FirestoreStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def rest_client(firestore, monkeypatch):
+    client = FirebaseRestClient('bench', '/nonexistent/service-account.json')
+    client.base_url = f'http://127.0.0.1:{firestore.server_address[1]}/v1/{ROOT}'
+    monkeypatch.setattr(client, '_auth_headers', lambda: {'Content-Type': 'application/json'})
+    return client
+
+
+def _measure(firestore, fetch):
+    firestore.requests = firestore.bytes_sent = 0
+    start = time.perf_counter()
+    devices = fetch()
+    return devices, time.perf_counter() - start, firestore.requests, firestore.bytes_sent
+
+
+@pytest.mark.benchmark
+def test_run_query_against_full_listing(firestore, rest_client):
+    user_id = 'user-7'
+
+    queried, query_s, query_requests, query_bytes = _measure(
+        firestore, lambda: list(rest_client.iter_documents('user_devices', {'userId': user_id}))
+    )
+    listed, list_s, list_requests, list_bytes = _measure(
+        firestore, lambda: [doc for doc in rest_client.iter_documents('user_devices')
+                            if doc.get('userId') == user_id]
+    )
+
+    print(f"\n{DOCUMENTS} user_devices documents, {len(queried)} belong to {user_id}")
+    print(f"  runQuery (userId filter): {query_s * 1000:9.1f} ms, {query_requests:4} requests, "
+          f"{query_bytes / 1024:10.1f} KiB")
+    print(f"  list + filter locally:    {list_s * 1000:9.1f} ms, {list_requests:4} requests, "
+          f"{list_bytes / 1024:10.1f} KiB")
+
+    assert [doc['deviceId'] for doc in queried] == [doc['deviceId'] for doc in listed]
+    assert len(queried) == DOCUMENTS // USERS
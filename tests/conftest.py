@@ -0,0 +1,83 @@
+"""
+Shared fixtures: an app bound to a throwaway SQLite file
+"""
+
+import os
+import tempfile
+
+# Must be set before app.config is imported; Config reads it once
+os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(prefix='unilocator-tests-'), 'unilocator.db')
+
+import pytest
+
+from app import create_app
+from app.utils.database import db_connection
+from app.utils.owner_cache import device_owner_cache
+from app.utils.telemetry import ensure_history_schema
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    firebase_uid TEXT PRIMARY KEY,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS pending_devices (
+    device_code TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS connected_devices (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    device_code TEXT NOT NULL,
+    device_name TEXT,
+    connected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_seen TIMESTAMP,
+    last_latitude REAL,
+    last_longitude REAL,
+    last_battery INTEGER,
+    last_network TEXT
+);
+"""
+
+
+def pytest_addoption(parser):
+    parser.addoption('--run-benchmarks', action='store_true',
+                     help='Also run the opt-in benchmarks in tests/benchmarks')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: opt-in performance benchmark, run with --run-benchmarks')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--run-benchmarks'):
+        return
+    skip = pytest.mark.skip(reason='benchmark; run with --run-benchmarks')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(scope='session')
+def app():
+    app = create_app()
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture
+def db(app):
+    """Pooled connection to an empty schema"""
+    with app.app_context():
+        with db_connection() as conn:
+            conn.executescript(SCHEMA)
+            ensure_history_schema(conn)
+            for table in ('users', 'pending_devices', 'connected_devices', 'telemetry_history'):
+                conn.execute(f'DELETE FROM {table}')
+            conn.commit()
+            device_owner_cache.clear()
+            yield conn
+
+
+@pytest.fixture
+def client(app, db):
+    return app.test_client()
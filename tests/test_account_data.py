@@ -0,0 +1,43 @@
+"""
+Account data export and deletion
+"""
+
+import json
+import time
+
+from app.utils.telemetry import append_history
+
+
+def _login(client, user_id):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+
+def _connect(db, *rows):
+    db.executemany('INSERT INTO connected_devices (user_id, device_code, device_name) VALUES (?, ?, ?)', rows)
+    append_history(db, [
+        {'device_code': code, 'ts': time.time(), 'lat': 1.0, 'lng': 2.0} for code in {row[1] for row in rows}
+    ])
+    db.commit()
+
+
+def test_export_includes_devices_and_history(client, db):
+    _connect(db, ('user-1', 'MINE', 'Pixel'), ('user-2', 'THEIRS', 'Tab'))
+    _login(client, 'user-1')
+
+    response = client.get('/download-data')
+
+    assert response.status_code == 200
+    export = json.loads(response.data)
+    assert [device[2] for device in export['devices']] == ['MINE']
+    assert [(point['device_code'], point['lat']) for point in export['telemetry_history']] == [('MINE', 1.0)]
+
+
+def test_deleting_an_account_purges_history_of_its_own_devices(client, db):
+    _connect(db, ('user-1', 'MINE', 'Pixel'), ('user-1', 'SHARED', 'Car'), ('user-2', 'SHARED', 'Car'))
+    _login(client, 'user-1')
+
+    assert client.post('/delete-account').get_json()['success'] is True
+
+    remaining = db.execute('SELECT DISTINCT device_code FROM telemetry_history').fetchall()
+    assert remaining == [('SHARED',)]
@@ -0,0 +1,66 @@
+"""
+Circuit breaker trial slots and what the Firestore executor guards
+"""
+
+import pytest
+
+from app.utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.utils.firestore_executor import FirestoreExecutor
+
+
+def _half_open_breaker():
+    breaker = CircuitBreaker('test', failure_threshold=1, recovery_timeout=0.0)
+    breaker.record_failure(ConnectionError('down'))
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    return breaker
+
+
+def _interrupted():
+    raise KeyboardInterrupt
+
+
+def test_interrupted_trial_call_releases_its_slot():
+    breaker = _half_open_breaker()
+
+    with pytest.raises(KeyboardInterrupt):
+        breaker.call(_interrupted)
+
+    # No verdict on Firestore, but the next call is admitted as a trial again
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.call(lambda: 'ok') == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_interrupted_executor_trial_releases_its_slot():
+    breaker = _half_open_breaker()
+    executor = FirestoreExecutor(max_workers=1, breaker=breaker)
+
+    with pytest.raises(KeyboardInterrupt):
+        executor.run(lambda deadline: _interrupted(), timeout=5)
+
+    assert executor.run(lambda deadline: 'ok', timeout=5) == 'ok'
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_refusal_further_down_is_not_a_success():
+    breaker = _half_open_breaker()
+    inner = CircuitBreaker('inner', failure_threshold=1, recovery_timeout=60.0)
+    inner.record_failure(ConnectionError('down'))
+
+    with pytest.raises(CircuitOpenError):
+        breaker.call(inner.call, lambda: 'unreachable')
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+
+
+def test_unguarded_work_runs_while_the_breaker_is_open():
+    breaker = CircuitBreaker('test', failure_threshold=1, recovery_timeout=60.0)
+    breaker.record_failure(ConnectionError('down'))
+    executor = FirestoreExecutor(max_workers=1, breaker=breaker)
+
+    with pytest.raises(CircuitOpenError):
+        executor.run(lambda deadline: 'guarded', timeout=5)
+
+    assert executor.submit(lambda deadline: 'self-guarded', timeout=5, guarded=False).result() == 'self-guarded'
+    assert breaker.state == CircuitBreaker.OPEN
+
@@ -0,0 +1,37 @@
+"""
+Active-code index warm-up from Firestore
+"""
+
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from app.utils import code_index, firebase_utils
+
+
+class _Query:
+    def __init__(self, documents, filters=()):
+        self.documents = documents
+        self.filters = list(filters)
+
+    def where(self, filter):
+        return _Query(self.documents, self.filters + [(filter.field_path, filter.op_string, filter.value)])
+
+    def stream(self, timeout=None):
+        _Query.last = self
+        return [SimpleNamespace(to_dict=lambda data=data: data) for data in self.documents]
+
+
+def test_warm_up_only_streams_unexpired_codes(monkeypatch):
+    expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+    documents = [{'deviceCode': 'WARM-0001', 'userId': 'user-1', 'expiresAt': expires_at}]
+    db = SimpleNamespace(collection=lambda name: _Query(documents))
+    monkeypatch.setattr(firebase_utils, 'get_firestore_db', lambda: db)
+    code_index.active_code_index.clear()
+
+    assert code_index.warm_active_code_index() == 1
+
+    (active, expiry) = _Query.last.filters
+    assert active == ('isActive', '==', True)
+    assert expiry[:2] == ('expiresAt', '>')
+    assert abs((expiry[2] - datetime.now(timezone.utc)).total_seconds()) < 60
+    assert code_index.active_code_index.get('WARM-0001')['userId'] == 'user-1'
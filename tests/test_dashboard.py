@@ -0,0 +1,57 @@
+"""
+Dashboard device sources
+"""
+
+from app.routes import main
+
+
+def _render(monkeypatch):
+    rendered = {}
+
+    def render_template(name, **context):
+        rendered.update(context)
+        return 'ok'
+
+    monkeypatch.setattr(main, 'render_template', render_template)
+    return rendered
+
+
+def _login(client):
+    with client.session_transaction() as session:
+        session['user_id'] = 'user-1'
+
+
+def test_local_devices_skip_firebase(client, db, monkeypatch):
+    db.execute("INSERT INTO connected_devices (user_id, device_code, device_name) VALUES ('user-1', 'ABC123', 'Pixel')")
+    db.commit()
+    rendered = _render(monkeypatch)
+    firebase_calls = []
+    monkeypatch.setattr(main, '_load_firebase_devices', lambda uid: firebase_calls.append(uid) or [])
+    _login(client)
+
+    assert client.get('/dashboard').status_code == 200
+    assert [device['code'] for device in rendered['devices']] == ['ABC123']
+    assert firebase_calls == []
+
+
+def test_firebase_is_the_fallback_without_local_devices(client, db, monkeypatch):
+    rendered = _render(monkeypatch)
+    monkeypatch.setattr(main, '_load_firebase_devices', lambda uid: [{'code': 'FB1', 'source': 'firebase'}])
+    _login(client)
+
+    assert client.get('/dashboard').status_code == 200
+    assert rendered['devices'] == [{'code': 'FB1', 'source': 'firebase'}]
+
+
+def test_local_devices_load_while_firestore_breaker_is_open(client, db, monkeypatch):
+    from app.utils.circuit_breaker import CircuitBreaker, firestore_breaker
+
+    db.execute("INSERT INTO connected_devices (user_id, device_code, device_name) VALUES ('user-1', 'ABC123', 'Pixel')")
+    db.commit()
+    monkeypatch.setattr(firestore_breaker, '_state', CircuitBreaker.OPEN)
+    monkeypatch.setattr(firestore_breaker, '_opened_at', float('inf'))
+    rendered = _render(monkeypatch)
+    _login(client)
+
+    assert client.get('/dashboard').status_code == 200
+    assert [device['code'] for device in rendered['devices']] == ['ABC123']
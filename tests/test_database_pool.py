@@ -0,0 +1,70 @@
+"""
+SQLite connection pool checkout, reuse and timeouts
+"""
+
+import os
+import threading
+
+import pytest
+
+from app.utils.database import ConnectionPool
+
+
+@pytest.fixture
+def pool(tmp_path):
+    return ConnectionPool(os.path.join(tmp_path, 'pool.db'), size=2, timeout=0.1)
+
+
+def test_connections_are_reused(pool):
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
+
+    assert first is second
+    assert pool.stats()['created'] == 1
+
+
+def test_connections_are_tuned(pool):
+    with pool.connection() as conn:
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert conn.execute('PRAGMA synchronous').fetchone()[0] == 1  # NORMAL
+
+
+def test_checkout_times_out_when_exhausted(pool):
+    held = [pool.acquire(), pool.acquire()]
+
+    with pytest.raises(TimeoutError):
+        pool.acquire()
+
+    stats = pool.stats()
+    assert stats['timeouts'] == 1
+    assert stats['in_use'] == 2
+    for conn in held:
+        pool.release(conn)
+
+
+def test_waiter_gets_a_released_connection(pool):
+    held = [pool.acquire(), pool.acquire()]
+    threading.Timer(0.02, pool.release, args=(held[0],)).start()
+
+    conn = pool.acquire()
+
+    assert conn is held[0]
+    assert pool.stats()['open'] == 2
+    pool.release(conn)
+    pool.release(held[1])
+
+
+def test_release_rolls_back_and_resets_rows(pool):
+    import sqlite3
+
+    with pool.connection() as conn:
+        conn.execute('CREATE TABLE items (name TEXT)')
+        conn.commit()
+        conn.row_factory = sqlite3.Row
+        conn.execute("INSERT INTO items VALUES ('uncommitted')")
+
+    with pool.connection() as conn:
+        assert conn.row_factory is None
+        assert conn.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
@@ -0,0 +1,51 @@
+"""
+Device list cache invalidation racing a Firestore fetch
+"""
+
+from app.utils import firebase_rest
+from app.utils.device_cache import DeviceListCache, device_list_cache, invalidate_user_devices
+
+
+def test_set_is_discarded_after_invalidation():
+    cache = DeviceListCache()
+    generation = cache.generation('user-1')
+    cache.invalidate('user-1')
+    cache.set('user-1', 'rest', [{'deviceName': 'old'}], generation)
+    assert cache.get('user-1', 'rest') is None
+
+    cache.set('user-1', 'rest', [{'deviceName': 'new'}], cache.generation('user-1'))
+    assert cache.get('user-1', 'rest') == [{'deviceName': 'new'}]
+
+
+def test_invalidating_another_user_keeps_the_fetch():
+    cache = DeviceListCache()
+    generation = cache.generation('user-1')
+    cache.invalidate('user-2')
+
+    cache.set('user-1', 'rest', [{'deviceName': 'mine'}], generation)
+    assert cache.get('user-1', 'rest') == [{'deviceName': 'mine'}]
+
+
+def test_forgotten_generations_still_discard_older_fetches():
+    cache = DeviceListCache(max_entries=1)
+    generation = cache.generation('user-1')
+    cache.invalidate('user-1')
+    cache.invalidate(*[f'other-{index}' for index in range(1024)])
+
+    cache.set('user-1', 'rest', [{'deviceName': 'old'}], generation)
+    assert cache.get('user-1', 'rest') is None
+
+
+def test_list_fetched_during_invalidation_is_not_cached(monkeypatch):
+    client = firebase_rest.FirebaseRestClient('test-project', '/nonexistent/service-account.json')
+
+    def iter_documents(collection, filters=None, field_mask=None, trace=None):
+        yield {'deviceName': 'removed meanwhile'}
+        # A device is removed while the fetch is still streaming
+        invalidate_user_devices('user-2')
+
+    monkeypatch.setattr(client, 'iter_documents', iter_documents)
+    device_list_cache.clear()
+
+    assert list(client.iter_user_devices('user-2')) == [{'deviceName': 'removed meanwhile'}]
+    assert device_list_cache.get('user-2', ('rest', None)) is None
@@ -0,0 +1,102 @@
+"""
+Device codes are created, never written over a code someone else holds
+"""
+
+import pytest
+from google.api_core import exceptions
+
+from app.utils import firebase_utils
+from app.utils.bulk_writer import FirestoreBulkWriter
+from app.utils.code_index import active_code_index
+
+
+class FakeFirestore:
+    def __init__(self, documents=None):
+        self.documents = dict(documents or {})  # path -> data
+
+    def collection(self, name):
+        return _Collection(self, name)
+
+    def document(self, path):
+        return _Reference(self, path)
+
+    def batch(self):
+        return _Batch(self)
+
+
+class _Collection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id):
+        return _Reference(self.db, f'{self.name}/{doc_id}')
+
+
+class _Reference:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+
+    def create(self, data, timeout=None):
+        if self.path in self.db.documents:
+            raise exceptions.AlreadyExists(f'Document already exists: {self.path}')
+        self.db.documents[self.path] = dict(data)
+
+
+class _Batch:
+    def __init__(self, db):
+        self.db = db
+        self.writes = []
+
+    def set(self, doc_ref, data, merge=False):
+        self.writes.append((doc_ref.path, data))
+
+    def commit(self, timeout=None):
+        for path, data in self.writes:
+            self.db.documents[path] = dict(data)
+
+
+@pytest.fixture
+def firestore(monkeypatch):
+    db = FakeFirestore({'user_device_codes/TAKE-N001': {'userId': 'someone-else'}})
+    monkeypatch.setattr(firebase_utils, 'get_firestore_db', lambda: db)
+    active_code_index.clear()
+    return db
+
+
+def test_taken_code_is_not_overwritten(firestore, monkeypatch):
+    codes = iter(['TAKE-N001', 'FREE-0002'])
+    monkeypatch.setattr(firebase_utils, 'new_device_code', lambda: next(codes))
+
+    code = firebase_utils.reserve_device_code('user-1', 'user@example.com')
+
+    assert code == 'FREE-0002'
+    assert firestore.documents['user_device_codes/TAKE-N001'] == {'userId': 'someone-else'}
+    assert firestore.documents['user_device_codes/FREE-0002']['userId'] == 'user-1'
+    assert active_code_index.get('FREE-0002')['userId'] == 'user-1'
+
+
+def test_gives_up_when_every_code_is_taken(firestore, monkeypatch):
+    monkeypatch.setattr(firebase_utils, 'new_device_code', lambda: 'TAKE-N001')
+
+    with pytest.raises(RuntimeError):
+        firebase_utils.reserve_device_code('user-1', 'user@example.com')
+    assert firestore.documents['user_device_codes/TAKE-N001'] == {'userId': 'someone-else'}
+
+
+def test_queued_create_leaves_an_existing_code_and_the_batch_alone(firestore):
+    writer = FirestoreBulkWriter(flush_interval=60)
+    results = {}
+
+    writer.create('user_device_codes/TAKE-N001', {'userId': 'user-1'},
+                  callback=lambda success, error: results.setdefault('create', (success, error)))
+    writer.set('device_locations/DEV1', {'latitude': 1.0},
+               callback=lambda success, error: results.setdefault('set', (success, error)))
+    writer.flush()
+
+    success, error = results['create']
+    assert not success and isinstance(error, exceptions.AlreadyExists)
+    assert results['set'] == (True, None)
+    assert firestore.documents['user_device_codes/TAKE-N001'] == {'userId': 'someone-else'}
+    assert writer.stats()['written'] == 1 and writer.stats()['failed'] == 1
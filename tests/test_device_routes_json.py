@@ -0,0 +1,62 @@
+"""
+Firestore devices returned by the API keep a JSON-safe form
+"""
+
+import base64
+from datetime import datetime, timezone
+
+import pytest
+
+from app.utils import firebase_rest
+
+
+class _FakeRestClient:
+    credentials = object()
+
+    def __init__(self, devices):
+        self.devices = devices
+
+    def iter_user_devices(self, user_id, field_mask=None, use_cache=True, trace=None):
+        return iter(self.devices)
+
+    def fetch_user_devices(self, user_id, field_mask=None, use_cache=True, trace=None):
+        return {'success': True, 'devices': list(self.devices), 'logs': [], 'error': None}
+
+
+@pytest.fixture
+def signed_in(client, monkeypatch):
+    device = firebase_rest.decode_fields({
+        'deviceId': {'stringValue': 'DEV1'},
+        'registeredAt': {'timestampValue': '2024-01-02T03:04:05.123456Z'},
+        'lastSeenAt': {'timestampValue': '2024-01-02T03:04:06Z'},
+        'pushKey': {'bytesValue': base64.b64encode(b'\x00\xff').decode()},
+    })
+    assert isinstance(device['registeredAt'], datetime)
+    monkeypatch.setattr(firebase_rest, 'get_rest_client', lambda: _FakeRestClient([device]))
+    with client.session_transaction() as session:
+        session['user_id'] = 'user-1'
+    return client
+
+
+def test_production_devices_keep_iso_timestamps(signed_in):
+    response = signed_in.post('/api/fetch-devices-production')
+
+    assert response.status_code == 200
+    device = response.get_json()['devices'][0]
+    assert device['connected_at'] == '2024-01-02T03:04:05.123456Z'
+    assert device['last_seen'] == '2024-01-02T03:04:06Z'
+
+
+def test_raw_devices_with_bytes_serialise(signed_in):
+    response = signed_in.post('/api/debug-device-data')
+
+    assert response.status_code == 200
+    assert response.get_json()['raw_devices'][0]['pushKey'] == base64.b64encode(b'\x00\xff').decode()
+
+
+def test_json_safe_walks_nested_values():
+    moment = datetime(2024, 1, 2, tzinfo=timezone.utc)
+
+    assert firebase_rest.json_safe({'a': [moment, {'b': b'\x01'}], 'c': 1}) == {
+        'a': ['2024-01-02T00:00:00Z', {'b': 'AQ=='}], 'c': 1
+    }
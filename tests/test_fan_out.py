@@ -0,0 +1,72 @@
+"""
+fan_out under gevent: overlap, deadline and circuit breaker
+"""
+
+import time
+
+import pytest
+
+gevent = pytest.importorskip('gevent')
+
+from app.utils import circuit_breaker, concurrency
+from app.utils.circuit_breaker import CircuitBreaker
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker('test', failure_threshold=1, recovery_timeout=60.0)
+    monkeypatch.setattr(circuit_breaker, 'firestore_breaker', breaker)
+    monkeypatch.setattr(concurrency, 'init_grpc_for_gevent', lambda: True)
+    return breaker
+
+
+def _slow(seconds, value):
+    def call():
+        gevent.sleep(seconds)
+        return value
+    return call
+
+
+def test_greenlets_overlap(breaker):
+    start = time.perf_counter()
+    results = concurrency._fan_out_greenlets({'a': _slow(0.2, 1), 'b': _slow(0.2, 2)}, timeout=5, guarded=True)
+
+    assert time.perf_counter() - start < 0.35
+    assert {name: result['value'] for name, result in results.items()} == {'a': 1, 'b': 2}
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_deadline_counts_as_a_backend_failure(breaker):
+    results = concurrency._fan_out_greenlets({'slow': _slow(5, None)}, timeout=0.05, guarded=True)
+    gevent.sleep(0)  # let the killed greenlet record its outcome
+
+    assert results['slow']['timeout'] is True
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_open_breaker_short_circuits_guarded_calls(breaker):
+    breaker.record_failure(ConnectionError('down'))
+    calls = []
+
+    results = concurrency._fan_out_greenlets({'read': lambda: calls.append(1)}, timeout=1, guarded=True)
+
+    assert results['read']['success'] is False
+    assert 'open' in results['read']['error']
+    assert calls == []
+
+
+def test_unguarded_calls_skip_the_breaker(breaker):
+    breaker.record_failure(ConnectionError('down'))
+
+    results = concurrency._fan_out_greenlets({'read': lambda: 'ok'}, timeout=1, guarded=False)
+
+    assert results['read']['value'] == 'ok'
+
+
+def test_calls_use_native_threads_without_grpc_support(breaker, monkeypatch):
+    import threading
+    monkeypatch.setattr(concurrency, 'init_grpc_for_gevent', lambda: False)
+
+    results = concurrency._fan_out_greenlets({'read': lambda: threading.get_ident()}, timeout=5, guarded=True)
+
+    assert results['read']['value'] != threading.get_ident()
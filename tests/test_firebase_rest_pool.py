@@ -0,0 +1,129 @@
+"""
+FirebaseRestClient connection pooling against a local HTTP stand-in
+"""
+
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils.firebase_rest import FirebaseRestClient
+
+
+class _StandIn(ThreadingHTTPServer):
+    """Keep-alive server that counts accepted connections and concurrent requests"""
+
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, statuses=()):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.delay = delay
+        self.statuses = list(statuses)  # served before falling back to 200
+        self.connections = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def get_request(self):
+        conn = super().get_request()
+        with self.lock:
+            self.connections += 1
+        return conn
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            status = server.statuses.pop(0) if server.statuses else 200
+        try:
+            time.sleep(server.delay)
+            body = json.dumps({'documents': [
+                {'name': 'devices/a', 'fields': {'deviceName': {'stringValue': 'Pixel'}}}
+            ]}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            if status == 429:
+                self.send_header('Retry-After', '0')
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in(request):
+    server = _StandIn(**getattr(request, 'param', {}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _client(server, pool_size):
+    client = FirebaseRestClient('test-project', '/nonexistent/service-account.json',
+                                pool_size=pool_size, backoff_base=0.0)
+    # Fresh token so no OAuth round trip is attempted
+    client.credentials = SimpleNamespace(token='token', expiry=datetime.utcnow() + timedelta(hours=1))
+    client.base_url = f"http://127.0.0.1:{server.server_address[1]}/v1/{client.documents_root}"
+    return client
+
+
+def test_sequential_requests_reuse_one_connection(stand_in):
+    client = _client(stand_in, pool_size=4)
+
+    for _ in range(20):
+        documents = list(client.iter_documents('devices'))
+        assert documents == [{'deviceName': 'Pixel'}]
+
+    assert stand_in.requests == 20
+    assert stand_in.connections == 1
+
+
+@pytest.mark.parametrize('stand_in', [{'delay': 0.05}], indirect=True)
+def test_concurrent_requests_stay_within_pool_size(stand_in):
+    client = _client(stand_in, pool_size=2)
+    errors = []
+
+    def worker():
+        try:
+            for _ in range(5):
+                list(client.iter_documents('devices'))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert stand_in.requests == 40
+    assert stand_in.max_in_flight <= 2
+    assert stand_in.connections <= 2
+
+
+@pytest.mark.parametrize('stand_in', [{'statuses': [429, 503]}], indirect=True)
+def test_overload_responses_are_retried_on_the_same_connection(stand_in):
+    client = _client(stand_in, pool_size=1)
+
+    assert list(client.iter_documents('devices')) == [{'deviceName': 'Pixel'}]
+    assert client.get_http_stats()['retries'] == 2
+    assert stand_in.connections == 1
@@ -0,0 +1,38 @@
+"""
+REST client runQuery filtering and paging
+"""
+
+from types import SimpleNamespace
+
+from app.utils.firebase_rest import FirebaseRestClient
+
+
+def _document(index):
+    return {'document': {'name': f'projects/p/databases/(default)/documents/user_devices/d{index:03}',
+                         'fields': {'deviceName': {'stringValue': f'device-{index}'}}}}
+
+
+def test_user_devices_are_filtered_and_paged_server_side(monkeypatch):
+    client = FirebaseRestClient('test-project', '/nonexistent/service-account.json')
+    monkeypatch.setattr(client, '_auth_headers', lambda: {})
+    bodies = []
+    pages = [[_document(i) for i in range(2)], [_document(2)]]
+
+    def request(method, url, **kwargs):
+        assert method == 'POST' and url.endswith(':runQuery')
+        bodies.append(kwargs['json']['structuredQuery'].copy())
+        return SimpleNamespace(status_code=200, json=lambda: pages[len(bodies) - 1])
+
+    monkeypatch.setattr(client, '_request', request)
+
+    documents = list(client.iter_documents('user_devices', {'userId': 'user-1'}, page_size=2,
+                                           field_mask=['deviceName']))
+
+    assert [doc['deviceName'] for doc in documents] == ['device-0', 'device-1', 'device-2']
+    first, second = bodies
+    assert first['where'] == {'fieldFilter': {'field': {'fieldPath': 'userId'}, 'op': 'EQUAL',
+                                              'value': {'stringValue': 'user-1'}}}
+    assert first['select'] == {'fields': [{'fieldPath': 'deviceName'}]}
+    assert first['limit'] == 2 and 'startAt' not in first
+    # The second page resumes after the last document of the first
+    assert second['startAt'] == {'values': [{'referenceValue': _document(1)['document']['name']}], 'before': False}
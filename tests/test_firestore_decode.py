@@ -0,0 +1,55 @@
+"""
+Table-driven Firestore REST value decoding
+"""
+
+import base64
+from datetime import datetime, timezone
+
+from app.utils.firebase_rest import decode_fields
+
+
+def test_decode_fields_types():
+    decoded = decode_fields({
+        'null': {'nullValue': None},
+        'flag': {'booleanValue': True},
+        'count': {'integerValue': '42'},
+        'ratio': {'doubleValue': 0.5},
+        'at': {'timestampValue': '2024-01-02T03:04:05.123456789Z'},
+        'name': {'stringValue': 'Pixel'},
+        'blob': {'bytesValue': base64.b64encode(b'\x00\x01').decode()},
+        'ref': {'referenceValue': 'projects/p/databases/(default)/documents/a/b'},
+        'where': {'geoPointValue': {'latitude': 1.5}},
+        'nested': {'mapValue': {'fields': {'list': {'arrayValue': {'values': [
+            {'integerValue': '1'}, {'mapValue': {'fields': {'x': {'stringValue': 'y'}}}}
+        ]}}}}},
+        'empty': {'arrayValue': {}},
+    })
+
+    assert decoded == {
+        'null': None,
+        'flag': True,
+        'count': 42,
+        'ratio': 0.5,
+        'at': datetime(2024, 1, 2, 3, 4, 5, 123456, tzinfo=timezone.utc),
+        'name': 'Pixel',
+        'blob': b'\x00\x01',
+        'ref': 'projects/p/databases/(default)/documents/a/b',
+        'where': {'latitude': 1.5, 'longitude': 0.0},
+        'nested': {'list': [1, {'x': 'y'}]},
+        'empty': [],
+    }
+
+
+def test_decode_fields_handles_nesting_past_the_recursion_limit():
+    value = {'stringValue': 'leaf'}
+    for _ in range(5000):
+        value = {'mapValue': {'fields': {'child': value}}}
+
+    decoded = decode_fields({'root': value})
+
+    depth = 0
+    node = decoded['root']
+    while isinstance(node, dict):
+        node = node['child']
+        depth += 1
+    assert depth == 5000 and node == 'leaf'
@@ -0,0 +1,103 @@
+"""
+Location history: who can write it, who can read it, and retention
+"""
+
+import time
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+from app.routes import api
+from app.utils.history_pruner import prune_expired_history
+from app.utils.telemetry import append_history
+
+
+@pytest.fixture
+def device(db, monkeypatch):
+    monkeypatch.setattr(api, 'telemetry_buffer', None)
+    db.execute("INSERT INTO connected_devices (user_id, device_code, device_name) VALUES ('user-1', 'MINE', 'Pixel')")
+    db.commit()
+    return 'MINE'
+
+
+def _history_count(db):
+    return db.execute('SELECT COUNT(*) FROM telemetry_history').fetchone()[0]
+
+
+def _login(client, user_id):
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+
+
+def test_unknown_device_location_is_not_recorded(client, db, device):
+    response = client.post('/api/location/NOT-CONNECTED', json={'lat': 1.0, 'lng': 2.0})
+
+    assert response.status_code == 404
+    assert _history_count(db) == 0
+
+
+def test_connected_device_location_is_recorded(client, db, device):
+    response = client.post(f'/api/location/{device}', json={'lat': 1.0, 'lng': 2.0})
+
+    assert response.status_code == 200
+    assert _history_count(db) == 1
+
+
+@pytest.mark.parametrize('body', [{'lat': 'nan', 'lng': 2.0}, {'lat': 95.0, 'lng': 2.0}, {'lat': {}, 'lng': 2.0}, ['x']])
+def test_invalid_location_is_rejected(client, db, device, body):
+    response = client.post(f'/api/location/{device}', json=body)
+
+    assert response.status_code == 400
+    assert _history_count(db) == 0
+
+
+def test_signed_in_caller_must_own_the_device(app, client, db, device):
+    with app.app_context():
+        token = create_access_token(identity='user-2')
+
+    response = client.post(f'/api/location/{device}', json={'lat': 1.0, 'lng': 2.0},
+                           headers={'Authorization': f'Bearer {token}'})
+
+    assert response.status_code == 403
+    assert _history_count(db) == 0
+
+
+def test_history_requires_a_session(client, db, device):
+    assert client.get(f'/get_location_history/{device}').status_code == 401
+
+
+def test_history_is_only_served_to_owners(client, db, device):
+    append_history(db, [{'device_code': device, 'ts': time.time(), 'lat': 1.0, 'lng': 2.0}])
+    db.commit()
+
+    _login(client, 'user-2')
+    assert client.get(f'/get_location_history/{device}').status_code == 404
+
+    _login(client, 'user-1')
+    response = client.get(f'/get_location_history/{device}')
+    assert response.status_code == 200
+    assert [(point['lat'], point['lng']) for point in response.get_json()['points']] == [(1.0, 2.0)]
+
+
+def test_prune_deletes_only_expired_days_in_batches(db):
+    now = time.time()
+    old = [{'device_code': 'A', 'ts': now - 40 * 86400 + i, 'battery': i} for i in range(5)]
+    append_history(db, old + [{'device_code': 'A', 'ts': now, 'battery': 99}])
+    db.commit()
+
+    result = prune_expired_history(retention_days=30, batch_size=2)
+
+    assert result['deleted'] == 5
+    assert result['error'] is None
+    assert db.execute('SELECT battery FROM telemetry_history').fetchall() == [(99,)]
+
+
+def test_zero_retention_keeps_everything(app, db):
+    append_history(db, [{'device_code': 'A', 'ts': time.time() - 400 * 86400, 'battery': 1}])
+    db.commit()
+
+    assert prune_expired_history(retention_days=0)['deleted'] == 0
+    output = app.test_cli_runner().invoke(args=['prune-telemetry-history', '--days', '0']).output
+
+    assert 'all history kept' in output
+    assert _history_count(db) == 1
@@ -0,0 +1,18 @@
+"""
+/api/metrics access
+"""
+
+
+def test_metrics_require_a_session(client):
+    assert client.get('/api/metrics').status_code == 401
+
+
+def test_metrics_do_not_expose_the_database_path(client, db):
+    with client.session_transaction() as session:
+        session['user_id'] = 'user-1'
+
+    response = client.get('/api/metrics')
+
+    assert response.status_code == 200
+    assert response.get_json()['sqlite_pool']
+    assert all('path' not in pool for pool in response.get_json()['sqlite_pool'])
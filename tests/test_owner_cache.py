@@ -0,0 +1,47 @@
+"""
+Device owner cache invalidation by device and by owner
+"""
+
+from app.utils.owner_cache import DeviceOwnerCache
+
+
+def test_invalidating_other_devices_keeps_the_query_result():
+    cache = DeviceOwnerCache()
+    generation = cache.generation
+    cache.invalidate('OTHER')
+    cache.invalidate_owner('user-2')
+
+    cache.set_many({'MINE': {'user-1'}}, generation)
+    assert cache.get_many(['MINE']) == {'MINE': frozenset({'user-1'})}
+
+
+def test_query_result_predating_an_invalidation_is_discarded():
+    cache = DeviceOwnerCache()
+    generation = cache.generation
+    cache.invalidate('CONNECTED')
+    # The owner disconnected every device while the query was running
+    cache.invalidate_owner('user-1')
+
+    cache.set_many({'CONNECTED': {'user-2'}, 'MINE': {'user-1'}, 'THEIRS': {'user-3'}}, generation)
+    assert cache.get_many(['CONNECTED', 'MINE', 'THEIRS']) == {'THEIRS': frozenset({'user-3'})}
+
+
+def test_invalidate_owner_drops_only_that_owners_devices():
+    cache = DeviceOwnerCache()
+    cache.set_many({'A': {'user-1'}, 'SHARED': {'user-1', 'user-2'}, 'B': {'user-2'}})
+
+    cache.invalidate_owner('user-1')
+
+    assert cache.get_many(['A', 'SHARED', 'B']) == {'B': frozenset({'user-2'})}
+    assert cache.stats()['invalidations'] == 2
+
+
+def test_evicted_devices_leave_the_owner_index():
+    cache = DeviceOwnerCache(max_entries=1)
+    cache.set_many({'A': {'user-1'}})
+    cache.set_many({'B': {'user-2'}})
+
+    cache.invalidate_owner('user-1')
+
+    assert cache.get_many(['B']) == {'B': frozenset({'user-2'})}
+    assert cache._by_owner == {'user-2': {'B'}}
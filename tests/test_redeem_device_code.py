@@ -0,0 +1,188 @@
+"""
+Device code redemption against a local fake of Firestore transactions
+
+The fake uses optimistic concurrency: a transaction records the version of
+every document it reads and its commit is aborted if any of them changed
+since, which is how contended Firestore transactions fail and get retried.
+"""
+
+import itertools
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions
+
+from app.utils import firebase_utils
+
+CODE = 'AB12-CD34'
+
+
+class FakeFirestore:
+    def __init__(self, read_latency=0.0):
+        self.read_latency = read_latency
+        self.documents = {}  # path -> (version, data)
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.round_trips = {'get': 0, 'commit': 0}
+
+    def collection(self, name):
+        return _Collection(self, name)
+
+    def transaction(self, max_attempts=5):
+        return _Transaction(self, max_attempts)
+
+    def count(self, kind):
+        with self.lock:
+            self.round_trips[kind] += 1
+
+    def documents_in(self, collection):
+        return {path: data for path, (_, data) in self.documents.items() if path.startswith(collection + '/')}
+
+
+class _Collection:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    def document(self, doc_id=None):
+        if doc_id is None:
+            doc_id = f'auto-{next(self.db.ids)}'
+        return _Reference(self.db, f'{self.name}/{doc_id}')
+
+
+class _Reference:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+
+    def get(self, transaction=None, timeout=None):
+        self.db.count('get')
+        with self.db.lock:
+            version, data = self.db.documents.get(self.path, (0, None))
+        if transaction is not None:
+            transaction.reads.setdefault(self.path, version)
+        time.sleep(self.db.read_latency)
+        return _Snapshot(self, data)
+
+
+class _Snapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _Transaction:
+    """The parts of firestore_v1.Transaction that @firestore.transactional drives"""
+
+    def __init__(self, db, max_attempts):
+        self.db = db
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+        self.reads = {}
+        self.writes = []
+
+    def _clean_up(self):
+        self._id = None
+        self.reads = {}
+        self.writes = []
+
+    def _begin(self, retry_id=None):
+        self._id = object()
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self):
+        self.db.count('commit')
+        with self.db.lock:
+            for path, version in self.reads.items():
+                if self.db.documents.get(path, (0, None))[0] != version:
+                    self._clean_up()
+                    raise exceptions.Aborted('Document changed since it was read')
+            for kind, reference, data in self.writes:
+                version, current = self.db.documents.get(reference.path, (0, None))
+                if kind == 'create':
+                    assert current is None, f'{reference.path} already exists'
+                    current = {}
+                self.db.documents[reference.path] = (version + 1, {**current, **data})
+        self._clean_up()
+        return []
+
+    def create(self, reference, data):
+        self.writes.append(('create', reference, data))
+
+    def update(self, reference, data):
+        self.writes.append(('update', reference, data))
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    db = FakeFirestore()
+    db.documents[f'user_device_codes/{CODE}'] = (1, {
+        'deviceCode': CODE,
+        'userId': 'owner',
+        'userEmail': 'owner@example.com',
+        'isActive': True,
+        'usageCount': 0,
+        'maxUsage': 1,
+    })
+    monkeypatch.setattr(firebase_utils, 'get_firestore_db', lambda: db)
+    firebase_utils.active_code_index.discard(CODE)
+    return db
+
+
+def test_concurrent_redemptions_succeed_exactly_once(fake_db):
+    fake_db.read_latency = 0.05  # widen the read-to-commit window
+    threads_count = 12
+    barrier = threading.Barrier(threads_count)
+    results = []
+
+    def redeem(index):
+        barrier.wait()
+        results.append(firebase_utils.redeem_device_code(CODE, f'phone-{index}', f'phone-{index}@example.com'))
+
+    threads = [threading.Thread(target=redeem, args=(index,)) for index in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    successes = [result for result in results if result['success']]
+    assert len(results) == threads_count
+    assert len(successes) == 1
+    assert {result['error'] for result in results if not result['success']} <= {
+        'Invalid or expired code', 'Code has reached maximum usage'
+    }
+
+    connections = fake_db.documents_in('device_connections')
+    assert len(connections) == 1
+    assert next(iter(connections.values()))['deviceId'] == successes[0]['deviceId']
+
+    code = fake_db.documents[f'user_device_codes/{CODE}'][1]
+    assert code['usageCount'] == 1
+    assert code['isActive'] is False
+    # At least one commit lost the race and was retried
+    assert fake_db.round_trips['commit'] > 1
+
+
+def test_redemption_is_one_read_and_one_commit(fake_db):
+    # The old flow was a query, an add() and an update(): three round trips
+    # with a window between the query and the update for a second redemption
+    result = firebase_utils.redeem_device_code(CODE, 'phone', 'phone@example.com')
+
+    assert result['success'] is True
+    assert fake_db.round_trips == {'get': 1, 'commit': 1}
+
+
+def test_rejected_redemption_writes_nothing(fake_db):
+    result = firebase_utils.redeem_device_code(CODE, 'owner', 'owner@example.com')
+
+    assert result == {'success': False, 'error': 'Cannot connect to your own device', 'timeout': False}
+    assert fake_db.documents_in('device_connections') == {}
+    assert fake_db.round_trips['commit'] == 0
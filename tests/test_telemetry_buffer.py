@@ -0,0 +1,123 @@
+"""
+Telemetry group-commit buffer
+"""
+
+import time
+
+from app.utils.telemetry_buffer import TelemetryBuffer
+
+
+def _report(code, ts, **values):
+    return {'device_code': code, 'ts': ts, **values}
+
+
+def test_newest_value_of_each_kind_wins(db):
+    buffer = TelemetryBuffer(flush_interval=60)
+    buffer.add([_report('A', 200, battery=50), _report('A', 100, battery=90, network='lte')])
+    buffer.add([_report('A', 150, lat=1.0, lng=2.0)])
+
+    # An older report arriving later does not overwrite a newer value
+    assert buffer.latest('A') == {'battery': (50,), 'network': ('lte',), 'location': (1.0, 2.0)}
+    buffer.close()
+
+
+def test_one_commit_per_flush(db):
+    db.execute("INSERT INTO connected_devices (user_id, device_code) VALUES ('user-1', 'A')")
+    db.commit()
+    buffer = TelemetryBuffer(flush_interval=60)
+    for ts in range(10):
+        buffer.add([_report('A', 100 + ts, battery=ts)])
+
+    buffer.flush()
+
+    stats = buffer.stats()
+    assert stats['commits'] == 1
+    assert stats['commits_saved'] == 9
+    assert stats['pending_reports'] == 0
+    assert db.execute("SELECT last_battery FROM connected_devices WHERE device_code = 'A'").fetchone()[0] == 9
+    assert db.execute('SELECT COUNT(*) FROM telemetry_history').fetchone()[0] == 10
+    buffer.close()
+
+
+def test_size_trigger_flushes_in_the_background(db):
+    db.execute("INSERT INTO connected_devices (user_id, device_code) VALUES ('user-1', 'A')")
+    db.commit()
+    buffer = TelemetryBuffer(flush_interval=60, max_reports=3)
+    buffer.add([_report('A', ts, battery=ts) for ts in range(1, 4)])
+
+    deadline = time.monotonic() + 5
+    while buffer.stats()['commits'] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert buffer.stats()['commits'] == 1
+    buffer.close()
+
+
+def test_full_buffer_refuses_reports(db):
+    buffer = TelemetryBuffer(flush_interval=60, max_pending=2)
+
+    assert buffer.add([_report('A', 1, battery=1), _report('A', 2, battery=2)]) is True
+    assert buffer.add([_report('A', 3, battery=3)]) is False
+    assert buffer.stats()['dropped'] == 1
+    buffer.close()
+
+
+def _failing_for(buffer, bad_code):
+    write = buffer._write
+
+    def flaky_write(state, history):
+        if bad_code in state:
+            raise RuntimeError('disk I/O error')
+        return write(state, history)
+
+    buffer._write = flaky_write
+
+
+def test_failed_group_commit_falls_back_to_each_device(db):
+    db.executemany("INSERT INTO connected_devices (user_id, device_code) VALUES ('user-1', ?)", [('GOOD',), ('BAD',)])
+    db.commit()
+    buffer = TelemetryBuffer(flush_interval=60, max_attempts=3)
+    _failing_for(buffer, 'BAD')
+    buffer.add([_report('GOOD', 1, battery=10), _report('BAD', 1, battery=20)])
+    buffer.add([_report('GOOD', 2, battery=11)])
+
+    buffer.flush()
+
+    assert db.execute("SELECT last_battery FROM connected_devices WHERE device_code = 'GOOD'").fetchone()[0] == 11
+    stats = buffer.stats()
+    assert stats['failed_flushes'] == 1
+    assert stats['pending_reports'] == 1
+    # Only the second request was fully committed, and it took its own commit
+    assert stats['committed_requests'] == 1
+    assert stats['commits_saved'] == 0
+    assert buffer.latest('BAD') == {'battery': (20,)}
+    buffer.close()
+
+
+def test_device_is_dropped_after_max_attempts(db):
+    buffer = TelemetryBuffer(flush_interval=60, max_attempts=3)
+    _failing_for(buffer, 'BAD')
+    buffer.add([_report('BAD', 1, battery=20), _report('BAD', 2, battery=21)])
+
+    for _ in range(3):
+        buffer.flush()
+
+    stats = buffer.stats()
+    assert stats['failed_flushes'] == 3
+    assert stats['dead_lettered'] == 2
+    assert stats['pending_reports'] == 0
+    assert stats['committed_requests'] == 0
+    assert stats['commits_saved'] == 0
+    assert buffer.latest('BAD') == {}
+    buffer.close()
+
+
+def test_newer_values_win_over_a_requeued_flush(db):
+    buffer = TelemetryBuffer(flush_interval=60, max_attempts=3)
+    _failing_for(buffer, 'BAD')
+    buffer.add([_report('BAD', 1, battery=20)])
+    buffer.flush()
+
+    buffer.add([_report('BAD', 5, battery=50)])
+
+    assert buffer.latest('BAD') == {'battery': (50,)}
+    buffer.close()
@@ -0,0 +1,194 @@
+"""
+Batched telemetry ingestion: ownership split and the /devices/telemetry route
+"""
+
+import time
+from datetime import datetime, timezone
+
+import pytest
+from flask_jwt_extended import create_access_token
+
+from app.utils import telemetry_buffer as buffer_module
+from app.utils.telemetry import ingest_reports, parse_reports, query_history
+from app.utils.telemetry_buffer import TelemetryBuffer
+
+
+@pytest.fixture
+def devices(db):
+    db.executemany(
+        'INSERT INTO connected_devices (user_id, device_code, device_name) VALUES (?, ?, ?)',
+        [('user-1', 'MINE-1', 'Pixel'), ('user-1', 'MINE-2', 'iPhone'), ('user-2', 'THEIRS', 'Galaxy')]
+    )
+    db.commit()
+    return db
+
+
+def _latest(db, code):
+    return db.execute(
+        'SELECT last_latitude, last_longitude, last_battery, last_network FROM connected_devices WHERE device_code = ?',
+        (code,)
+    ).fetchone()
+
+
+def test_only_owned_devices_are_applied(devices):
+    reports = parse_reports({'reports': [
+        {'device_code': 'MINE-1', 'lat': 1.0, 'lng': 2.0, 'ts': 100},
+        {'device_code': 'THEIRS', 'lat': 9.0, 'lng': 9.0, 'ts': 100},
+        {'device_code': 'MINE-1', 'lat': 3.0, 'lng': 4.0, 'battery': 80, 'ts': 200},
+        {'device_code': 'UNKNOWN', 'battery': 5, 'ts': 100},
+        {'device_code': 'MINE-2', 'network': 'wifi', 'ts': 150},
+    ]})
+
+    result = ingest_reports(devices, 'user-1', reports)
+
+    assert result == {
+        'accepted': 3,
+        'rejected': ['THEIRS', 'UNKNOWN'],
+        'updated': {'location': 1, 'battery': 1, 'network': 1}
+    }
+    assert tuple(_latest(devices, 'MINE-1')) == (3.0, 4.0, 80, None)
+    assert tuple(_latest(devices, 'MINE-2')) == (None, None, None, 'wifi')
+    assert tuple(_latest(devices, 'THEIRS')) == (None, None, None, None)
+    # Every accepted report is kept in the history, not just the latest
+    assert [point['ts'] for point in query_history(devices, 'MINE-1')['points']] == [100.0, 200.0]
+    assert query_history(devices, 'THEIRS')['points'] == []
+
+
+def test_route_splits_accepted_and_rejected(app, client, devices, monkeypatch):
+    monkeypatch.setattr(buffer_module, 'telemetry_buffer', None)
+    with app.app_context():
+        token = create_access_token(identity='user-1')
+
+    response = client.post('/devices/telemetry', headers={'Authorization': f'Bearer {token}'}, json=[
+        {'device_code': 'MINE-1', 'battery': 42},
+        {'device_code': 'THEIRS', 'battery': 1},
+    ])
+
+    assert response.status_code == 200
+    assert response.get_json()['accepted'] == 1
+    assert response.get_json()['rejected'] == ['THEIRS']
+    assert _latest(devices, 'MINE-1')[2] == 42
+
+
+def test_route_refuses_a_batch_with_no_owned_devices(app, client, devices, monkeypatch):
+    monkeypatch.setattr(buffer_module, 'telemetry_buffer', None)
+    with app.app_context():
+        token = create_access_token(identity='user-1')
+
+    response = client.post('/devices/telemetry', headers={'Authorization': f'Bearer {token}'},
+                           json={'device_code': 'THEIRS', 'battery': 1})
+
+    assert response.status_code == 403
+    assert _latest(devices, 'THEIRS')[2] is None
+
+
+@pytest.mark.parametrize('report', [
+    {'device_code': 'MINE-1', 'lat': 91.0, 'lng': 0.0},
+    {'device_code': 'MINE-1', 'lat': 0.0, 'lng': -180.5},
+    {'device_code': 'MINE-1', 'lat': '12.5', 'lng': 0.0},
+    {'device_code': 'MINE-1', 'lat': [1], 'lng': 0.0},
+    {'device_code': 'MINE-1', 'lat': True, 'lng': 0.0},
+    {'device_code': 'MINE-1', 'battery': 101},
+    {'device_code': 'MINE-1', 'battery': 50.5},
+    {'device_code': 'MINE-1', 'battery': {'level': 50}},
+    {'device_code': 'MINE-1', 'network': {'type': 'wifi'}},
+    {'device_code': 'MINE-1', 'network': 'x' * 100},
+    {'device_code': 'MINE-1', 'battery': 50, 'ts': 'nan'},
+    {'device_code': 'MINE-1', 'battery': 50, 'ts': 'inf'},
+    {'device_code': 'MINE-1', 'battery': 50, 'ts': 1e300},
+    {'device_code': 'MINE-1', 'battery': 50, 'ts': [1]},
+])
+def test_invalid_values_are_rejected(report):
+    with pytest.raises(ValueError):
+        parse_reports(report)
+
+
+def test_valid_values_are_normalised():
+    [report] = parse_reports({'device_code': 'MINE-1', 'lat': 45, 'lng': -120, 'battery': 80.0,
+                              'network': 'wifi', 'ts': 1700000000000})
+
+    assert report == {'device_code': 'MINE-1', 'ts': 1700000000.0, 'lat': 45.0, 'lng': -120.0,
+                      'battery': 80, 'network': 'wifi'}
+
+
+def test_route_rejects_malformed_reports(app, client, devices):
+    with app.app_context():
+        token = create_access_token(identity='user-1')
+
+    response = client.post('/devices/telemetry', headers={'Authorization': f'Bearer {token}'},
+                           json=[{'device_code': 'MINE-1', 'lat': 1.0}])
+
+    assert response.status_code == 400
+
+
+def test_buffered_reports_are_written_on_flush(devices):
+    buffer = TelemetryBuffer(flush_interval=60, max_reports=1000)
+    reports = parse_reports([
+        {'device_code': 'MINE-1', 'lat': 1.0, 'lng': 2.0, 'ts': 100},
+        {'device_code': 'MINE-1', 'lat': 5.0, 'lng': 6.0, 'ts': 300},
+    ])
+
+    result = ingest_reports(devices, 'user-1', reports, buffer=buffer)
+
+    assert result['accepted'] == 2
+    assert tuple(_latest(devices, 'MINE-1'))[:2] == (None, None)
+    assert buffer.latest('MINE-1') == {'location': (5.0, 6.0)}
+
+    buffer.flush()
+
+    assert tuple(_latest(devices, 'MINE-1'))[:2] == (5.0, 6.0)
+    assert len(query_history(devices, 'MINE-1')['points']) == 2
+    assert buffer.latest('MINE-1') == {}
+    buffer.close()
+
+
+def _row(db, code):
+    return db.execute(
+        '''SELECT last_latitude, last_longitude, last_battery, last_network, last_seen
+           FROM connected_devices WHERE device_code = ?''',
+        (code,)
+    ).fetchone()
+
+
+def test_direct_and_buffered_paths_store_the_same_row(devices):
+    # Out of order: the newest ts wins on both paths, and last_seen is the
+    # server's receive time rather than the device's (possibly wrong) clock
+    batch = [
+        {'lat': 1.0, 'lng': 1.0, 'battery': 10, 'ts': 2000},
+        {'lat': 2.0, 'lng': 2.0, 'battery': 20, 'network': 'lte', 'ts': 1000},
+        {'network': 'wifi', 'ts': 1000},
+    ]
+    direct = parse_reports([{'device_code': 'MINE-1', **report} for report in batch])
+    buffered = parse_reports([{'device_code': 'MINE-2', **report} for report in batch])
+    started = time.time()
+
+    ingest_reports(devices, 'user-1', direct)
+    buffer = TelemetryBuffer(flush_interval=60)
+    ingest_reports(devices, 'user-1', buffered, buffer=buffer)
+    buffer.flush()
+    buffer.close()
+
+    direct_row, buffered_row = _row(devices, 'MINE-1'), _row(devices, 'MINE-2')
+    assert tuple(direct_row)[:4] == tuple(buffered_row)[:4] == (1.0, 1.0, 10, 'wifi')
+    for row in (direct_row, buffered_row):
+        last_seen = datetime.strptime(str(row[4]), '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        assert abs(last_seen.timestamp() - started) < 5
+
+
+def test_newest_locations_are_mirrored_to_firestore(devices, monkeypatch):
+    from app.utils import firebase_utils
+
+    mirrored = []
+    monkeypatch.setenv('FIRESTORE_TELEMETRY_MIRROR', 'true')
+    monkeypatch.setattr(firebase_utils, 'mirror_device_location',
+                        lambda code, lat, lng, callback=None: mirrored.append((code, lat, lng)))
+    reports = parse_reports([
+        {'device_code': 'MINE-1', 'lat': 3.0, 'lng': 4.0, 'ts': 200},
+        {'device_code': 'MINE-1', 'lat': 1.0, 'lng': 2.0, 'ts': 100},
+        {'device_code': 'MINE-2', 'battery': 50, 'ts': 100},
+        {'device_code': 'THEIRS', 'lat': 9.0, 'lng': 9.0, 'ts': 100},
+    ])
+
+    ingest_reports(devices, 'user-1', reports)
+
+    assert mirrored == [('MINE-1', 3.0, 4.0)]